@@ -0,0 +1,4 @@
+"""
+Benchmarks for the hot paths of the topic modeling and stability code, using synthetic corpora 
+and ranking sets. Use run-benchmarks.py to run them and to compare results between commits.
+"""
@@ -0,0 +1,340 @@
+import glob, os, os.path, shutil, subprocess, sys, tempfile
+import logging as log
+import numpy as np
+from scipy import sparse as sp
+import benchmarks.generators as generators
+
+# --------------------------------------------------------------
+# Benchmark Definitions
+# --------------------------------------------------------------
+
+class Benchmark:
+	"""
+	A single benchmarked hot path. The setup function builds the input state for a dictionary of
+	parameters, and the run function is timed on that state. If a reference implementation is given,
+	the output of the run function is checked against its output using the compare function.
+	"""
+	def __init__( self, name, setup, run, reference = None, compare = None, scales = None ):
+		self.name = name
+		self.setup = setup
+		self.run = run
+		self.reference = reference
+		self.compare = compare or outputs_close
+		self.scales = scales or {}
+
+	def params( self, scale ):
+		return self.scales.get( scale, [] )
+
+def outputs_close( output, expected ):
+	if sp.issparse( output ):
+		output = output.toarray()
+	if sp.issparse( expected ):
+		expected = expected.toarray()
+	return np.allclose( np.asarray( output, dtype=np.float64 ), np.asarray( expected, dtype=np.float64 ) )
+
+# --------------------------------------------------------------
+# Ranking Similarity
+# --------------------------------------------------------------
+
+def setup_ranking_pair( params ):
+	( reference, all_rankings ) = generators.synthetic_rankings( params["k"], params["t"], 1, params.get( "overlap", 0.5 ) )
+	return { "rankings1" : reference, "rankings2" : all_rankings[0], "top" : params["t"] }
+
+def run_similarity_matrix( state ):
+	import unsupervised.rankings as rankings
+	return rankings.similarity_matrices( rankings.AverageJaccard(), state["rankings1"], state["rankings2"], [state["top"]] )[state["top"]]
+
+def reference_similarity_matrix( state ):
+	import unsupervised.rankings as rankings
+	return rankings.pairwise_similarity_matrix( rankings.AverageJaccard(), state["rankings1"], state["rankings2"] )
+
+def run_sparse_similarity_matrix( state ):
+	import unsupervised.rankings as rankings
+	return rankings.sparse_similarity_matrices( rankings.AverageJaccard(), state["rankings1"], state["rankings2"], [state["top"]] )[state["top"]]
+
+def run_sketch_similarity_matrix( state ):
+	import unsupervised.rankings as rankings
+	metric = rankings.SketchAverageJaccard( state["m"] )
+	return metric.similarity_matrices( state["sketch1"], state["sketch2"], [state["top"]] )[state["top"]]
+
+def setup_sketch_pair( params ):
+	import unsupervised.rankings as rankings
+	state = setup_ranking_pair( params )
+	metric = rankings.SketchAverageJaccard( params.get( "m", 64 ) )
+	state.update( { "m" : metric.m, "sketch1" : metric.sketch( state["rankings1"] ), "sketch2" : metric.sketch( state["rankings2"] ) } )
+	return state
+
+def compare_sketch_similarity( output, expected ):
+	# sketches only estimate the similarities, so the mean absolute error is checked
+	return np.abs( output - expected ).mean() < 0.02
+
+def setup_similarity_matrix( params ):
+	state = setup_ranking_pair( params )
+	state["S"] = run_similarity_matrix( state )
+	return state
+
+def run_assignment( state ):
+	import unsupervised.rankings as rankings
+	return rankings.sparse_hungarian_matching( sp.csr_matrix( state["S"] ) )[0]
+
+def reference_assignment( state ):
+	import unsupervised.rankings as rankings
+	return rankings.RankingSetAgreement( sparse_min_topics = None ).hungarian_matching( state["S"] )[0]
+
+def run_greedy_matching( state ):
+	import unsupervised.rankings as rankings
+	score = rankings.greedy_matching( state["S"] )[0]
+	return ( score, rankings.matching_upper_bound( state["S"], score ) )
+
+def compare_greedy_matching( output, expected ):
+	# the exact score must lie between the greedy score and its upper bound
+	return output[0] <= expected + 1e-9 and expected <= output[1] + 1e-9
+
+def setup_ranking_sets( params ):
+	( reference, all_rankings ) = generators.synthetic_rankings( params["k"], params["t"], params["r"], params.get( "overlap", 0.5 ) )
+	return { "all_rankings" : all_rankings, "top_values" : [params["t"]] }
+
+def run_diversity_batch( state ):
+	import unsupervised.validation as validation
+	scores = validation.DiversityValidator().evaluate_batch( state["all_rankings"], state["top_values"] )
+	return [sorted( s.items() ) for s in scores]
+
+def reference_diversity_batch( state ):
+	import unsupervised.rankings as rankings
+	k = len(state["all_rankings"][0])
+	upper = np.triu_indices( k, 1 )
+	all_scores = []
+	for test_rankings in state["all_rankings"]:
+		scores = []
+		for top in state["top_values"]:
+			trunc_rankings = rankings.truncate_term_rankings( test_rankings, top )
+			S = rankings.pairwise_similarity_matrix( rankings.AverageJaccard(), trunc_rankings, trunc_rankings )
+			scores.append( ( "div-%03d" % top, np.mean( 1.0 - S[upper] ) ) )
+		all_scores.append( scores )
+	return all_scores
+
+def compare_scores( output, expected ):
+	return all( a[0] == b[0] and abs( a[1] - b[1] ) < 1e-9 for x, y in zip( output, expected ) for a, b in zip( x, y ) )
+
+def run_ensemble( state ):
+	import unsupervised.ensemble as ensemble
+	e = ensemble.TopicEnsemble()
+	e.add_all( state["all_rankings"] )
+	return e.build_rankings( 10 )
+
+# --------------------------------------------------------------
+# Corpus Operations
+# --------------------------------------------------------------
+
+def setup_corpus( params ):
+	( X, terms, doc_ids ) = generators.synthetic_corpus( params["n"], params["m"], params.get( "density", 0.01 ) )
+	k = params.get( "k", 10 )
+	rng = np.random.RandomState( 1000 )
+	partition = generators.synthetic_partition( params["n"], k )
+	# documents without a cluster, such as unlabelled documents in a class partition
+	partition[rng.choice( params["n"], params["n"] // 20, replace = False )] = -1
+	return { "X" : X, "k" : k, "partition" : partition, "centres" : rng.rand( k, params["m"] ), "v" : np.asarray( X[0:k].sum( axis = 0 ) ).ravel() }
+
+def setup_coherence( params ):
+	state = setup_corpus( params )
+	rng = np.random.RandomState( 1000 )
+	# rankings of corpus term ids, as read from the ranking files of runs, whose top terms overlap
+	pool = rng.choice( params["m"], min( params["m"], 4 * params["k"] * params["t"] ), replace = False )
+	state["all_rankings"] = [[rng.choice( pool, params["t"], replace = False ) for i in range( params["k"] )] for r in range( params["r"] )]
+	return state
+
+def run_coherence( state ):
+	import unsupervised.validation as validation
+	term_ids = np.unique( np.concatenate( [ranking for rankings in state["all_rankings"] for ranking in rankings] ) )
+	validator = validation.CoherenceValidator( validation.build_cooccurrence_index( state["X"], term_ids ) )
+	return [validator.evaluate( rankings, [len(rankings[0])] ) for rankings in state["all_rankings"]]
+
+def reference_coherence( state ):
+	B = state["X"].tocsc()
+	n = float( B.shape[0] )
+	docs = [set( B.indices[B.indptr[i]:B.indptr[i+1]] ) for i in range( B.shape[1] )]
+	all_scores = []
+	for rankings in state["all_rankings"]:
+		topic_npmi, topic_umass = [], []
+		for ranking in rankings:
+			npmi, umass = [], []
+			for i in range( len(ranking) ):
+				for j in range( i+1, len(ranking) ):
+					D1, D2, D12 = len(docs[ranking[i]]), len(docs[ranking[j]]), len( docs[ranking[i]] & docs[ranking[j]] )
+					if D1 == 0 or D2 == 0:
+						continue
+					umass.append( np.log( ( D12 + 1.0 ) / D1 ) )
+					if D12 == 0:
+						npmi.append( -1.0 )
+					elif D12 == n:
+						npmi.append( 1.0 )
+					else:
+						npmi.append( np.log( ( D12 / n ) / ( ( D1 / n ) * ( D2 / n ) ) ) / -np.log( D12 / n ) )
+			if len(npmi) > 0:
+				topic_npmi.append( np.mean( npmi ) )
+				topic_umass.append( np.mean( umass ) )
+		top = len(rankings[0])
+		all_scores.append( { "npmi-%03d" % top : np.mean( topic_npmi ), "umass-%03d" % top : np.mean( topic_umass ) } )
+	return all_scores
+
+def compare_coherence( output, expected ):
+	return all( set( x ) == set( y ) and all( abs( x[key] - y[key] ) < 1e-9 for key in x ) for x, y in zip( output, expected ) )
+
+def run_cosine_distances( state ):
+	from unsupervised.sampling import RowSubset
+	# every other row, so that the view has to skip rows of the corpus
+	return RowSubset( state["X"], np.arange( 0, state["X"].shape[0], 2 ) ).cosine_distances( state["centres"] )
+
+def reference_cosine_distances( state ):
+	from unsupervised.skm import cdist_sparse
+	return cdist_sparse( state["X"][::2], state["centres"], metric = "cosine" )
+
+def run_build_centroids( state ):
+	import unsupervised.util
+	return unsupervised.util.build_centroids( state["X"], state["partition"], state["k"] )
+
+def reference_build_centroids( state ):
+	C = np.zeros( ( state["k"], state["X"].shape[1] ) )
+	for cluster_index in range( state["k"] ):
+		members = np.where( state["partition"] == cluster_index )[0]
+		if len(members) > 0:
+			C[cluster_index] = np.asarray( state["X"][members].mean( axis = 0 ) ).ravel()
+	return C
+
+def run_rank_vector_terms( state ):
+	import unsupervised.util
+	# ties may be broken differently, so the weights of the ranked terms are compared
+	return state["v"][unsupervised.util.rank_vector_terms( state["v"], 100 )]
+
+def reference_rank_vector_terms( state ):
+	return state["v"][np.argsort( state["v"] )[::-1][0:100]]
+
+def run_write_documents( state ):
+	from unsupervised.lda import MalletLDA
+	dir_tmp = tempfile.mkdtemp()
+	try:
+		# scale the weights to integer counts, as for a raw term frequency corpus
+		corpus_path = MalletLDA( "mallet" )._MalletLDA__write_documents( state["X"] * 10, dir_tmp )
+		return os.path.getsize( corpus_path )
+	finally:
+		shutil.rmtree( dir_tmp )
+
+def setup_unsorted_corpus( params ):
+	( X, terms, doc_ids ) = generators.synthetic_corpus( params["n"], params["m"], params.get( "density", 0.01 ) )
+	# shuffle the order of the terms in each row, so that the matrix is not in canonical form
+	rows = np.repeat( np.arange( X.shape[0] ), np.diff( X.indptr ) )
+	order = np.lexsort( ( np.random.RandomState( 1000 ).rand( X.nnz ), rows ) )
+	X = sp.csr_matrix( ( X.data[order], X.indices[order], X.indptr ), shape = X.shape )
+	return { "X" : X, "terms" : terms, "doc_ids" : doc_ids, "k" : params.get( "k", 5 ) }
+
+def reference_nmf_corpus( state, corpus_format ):
+	"""
+	Save the corpus in the specified format and run the reference NMF tool on it, returning the rankings.
+	"""
+	import text.util, unsupervised.util
+	repo_dir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+	dir_tmp = tempfile.mkdtemp()
+	devnull = open( os.devnull, "w" )
+	try:
+		corpus_path = text.util.save_corpus( os.path.join( dir_tmp, "corpus" ), state["X"], state["terms"], state["doc_ids"], None, corpus_format )
+		command = [sys.executable, os.path.join( repo_dir, "reference-nmf.py" ), corpus_path, "--kmin", str(state["k"]), "--kmax", str(state["k"]), "-o", os.path.join( dir_tmp, "out" )]
+		status = subprocess.call( command, cwd = repo_dir, stdout = devnull, stderr = devnull )
+		if status != 0:
+			log.warning( "%s exited with status %d" % ( " ".join( command ), status ) )
+			return None
+		return unsupervised.util.load_term_rankings( os.path.join( dir_tmp, "out", "nmf_k%02d" % state["k"], "ranks_reference.pkl" ) )[0]
+	finally:
+		devnull.close()
+		shutil.rmtree( dir_tmp )
+
+def run_binary_reference_nmf( state ):
+	return reference_nmf_corpus( state, "binary" )
+
+def reference_pkl_reference_nmf( state ):
+	return reference_nmf_corpus( state, "pkl" )
+
+def compare_rankings( output, expected ):
+	return not output is None and output == expected
+
+def setup_documents( params ):
+	return { "docs" : generators.synthetic_documents( params["n"], params.get( "words", 100 ), params.get( "vocabulary", 5000 ) ) }
+
+def run_preprocess( state ):
+	import text.util
+	( X, terms ) = text.util.preprocess( state["docs"], [], min_df = 3 )
+	return X.shape
+
+def setup_duplicate_documents( params ):
+	docs = generators.synthetic_documents( params["n"], params.get( "words", 100 ), params.get( "vocabulary", 5000 ) )
+	rng = np.random.RandomState( 1000 )
+	# append copies of some documents with one word changed
+	for i in rng.choice( params["n"], params["duplicates"], replace = False ):
+		words = docs[i].split()
+		words[rng.randint( len(words) )] = "changed"
+		docs.append( " ".join( words ) )
+	return { "docs" : docs }
+
+def run_near_duplicates( state ):
+	import text.util
+	( duplicate_of, similarities ) = text.util.find_near_duplicates( text.util.minhash_signatures( state["docs"] ), 0.8 )
+	return int( np.sum( duplicate_of >= 0 ) )
+
+# --------------------------------------------------------------
+# Startup
+# --------------------------------------------------------------
+
+def cli_scripts():
+	repo_dir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+	return sorted( os.path.basename( path ) for path in glob.glob( os.path.join( repo_dir, "*.py" ) ) )
+
+def setup_startup( params ):
+	repo_dir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+	return { "command" : [sys.executable, os.path.join( repo_dir, params["script"] ), "--help"], "cwd" : repo_dir }
+
+def run_startup( state ):
+	# the tools import all of their modules before parsing options, so --help measures the startup cost
+	devnull = open( os.devnull, "w" )
+	try:
+		status = subprocess.call( state["command"], cwd = state["cwd"], stdout = devnull, stderr = devnull )
+	finally:
+		devnull.close()
+	if status != 0:
+		log.warning( "%s exited with status %d" % ( " ".join( state["command"] ), status ) )
+	return status
+
+# --------------------------------------------------------------
+
+all_benchmarks = [
+	Benchmark( "rankings.similarity_matrix", setup_ranking_pair, run_similarity_matrix, reference_similarity_matrix,
+		scales = { "small" : [{"k":10,"t":20}, {"k":50,"t":20}], "medium" : [{"k":50,"t":50}, {"k":100,"t":50}], "large" : [{"k":200,"t":100}] } ),
+	Benchmark( "rankings.sparse_similarity_matrix", setup_ranking_pair, run_sparse_similarity_matrix, run_similarity_matrix,
+		scales = { "small" : [{"k":100,"t":20}], "medium" : [{"k":300,"t":20}], "large" : [{"k":500,"t":50}] } ),
+	Benchmark( "rankings.sketch_similarity_matrix", setup_sketch_pair, run_sketch_similarity_matrix, run_similarity_matrix, compare_sketch_similarity,
+		scales = { "small" : [{"k":20,"t":200}], "medium" : [{"k":50,"t":500}], "large" : [{"k":100,"t":1000}] } ),
+	Benchmark( "rankings.assignment", setup_similarity_matrix, run_assignment, reference_assignment,
+		scales = { "small" : [{"k":10,"t":20}, {"k":30,"t":20}], "medium" : [{"k":60,"t":20}], "large" : [{"k":100,"t":20}] } ),
+	Benchmark( "rankings.greedy_matching", setup_similarity_matrix, run_greedy_matching, reference_assignment, compare_greedy_matching,
+		scales = { "small" : [{"k":30,"t":20}], "medium" : [{"k":60,"t":20}], "large" : [{"k":100,"t":20}] } ),
+	Benchmark( "validation.diversity_batch", setup_ranking_sets, run_diversity_batch, reference_diversity_batch, compare_scores,
+		scales = { "small" : [{"k":10,"t":20,"r":20}], "medium" : [{"k":20,"t":50,"r":50}], "large" : [{"k":50,"t":100,"r":100}] } ),
+	Benchmark( "ensemble.add_all", setup_ranking_sets, run_ensemble,
+		scales = { "small" : [{"k":10,"t":20,"r":20}], "medium" : [{"k":20,"t":50,"r":100}], "large" : [{"k":50,"t":100,"r":100}] } ),
+	Benchmark( "validation.coherence", setup_coherence, run_coherence, reference_coherence, compare_coherence,
+		scales = { "small" : [{"n":1000,"m":2000,"k":10,"t":10,"r":20,"density":0.05}], "medium" : [{"n":10000,"m":5000,"k":20,"t":20,"r":50,"density":0.02}], "large" : [{"n":50000,"m":20000,"k":50,"t":20,"r":100}] } ),
+	Benchmark( "skm.cosine_distances", setup_corpus, run_cosine_distances, reference_cosine_distances,
+		scales = { "small" : [{"n":500,"m":2000}], "medium" : [{"n":2000,"m":5000}], "large" : [{"n":10000,"m":10000}] } ),
+	Benchmark( "util.build_centroids", setup_corpus, run_build_centroids, reference_build_centroids,
+		scales = { "small" : [{"n":1000,"m":2000}], "medium" : [{"n":10000,"m":5000}], "large" : [{"n":50000,"m":20000}] } ),
+	Benchmark( "util.rank_vector_terms", setup_corpus, run_rank_vector_terms, reference_rank_vector_terms,
+		scales = { "small" : [{"n":100,"m":10000}], "medium" : [{"n":100,"m":100000}], "large" : [{"n":100,"m":1000000}] } ),
+	Benchmark( "lda.write_documents", setup_corpus, run_write_documents,
+		scales = { "small" : [{"n":1000,"m":2000}], "medium" : [{"n":10000,"m":5000}], "large" : [{"n":50000,"m":20000}] } ),
+	Benchmark( "text.binary_corpus_nmf", setup_unsorted_corpus, run_binary_reference_nmf, reference_pkl_reference_nmf, compare_rankings,
+		scales = { "small" : [{"n":500,"m":1000}], "medium" : [{"n":2000,"m":5000}], "large" : [{"n":10000,"m":10000}] } ),
+	Benchmark( "text.preprocess", setup_documents, run_preprocess,
+		scales = { "small" : [{"n":500}], "medium" : [{"n":5000}], "large" : [{"n":20000}] } ),
+	Benchmark( "text.near_duplicates", setup_duplicate_documents, run_near_duplicates,
+		scales = { "small" : [{"n":1000,"duplicates":100}], "medium" : [{"n":10000,"duplicates":1000}], "large" : [{"n":50000,"duplicates":5000}] } ),
+	Benchmark( "startup", setup_startup, run_startup,
+		scales = dict( ( scale, [{"script":script} for script in cli_scripts()] ) for scale in ( "small", "medium", "large" ) ) ),
+]
@@ -0,0 +1,86 @@
+import numpy as np
+from scipy import sparse as sp
+
+# --------------------------------------------------------------
+# Synthetic Corpora
+# --------------------------------------------------------------
+
+def synthetic_terms( m ):
+	return ["term%05d" % i for i in range(m)]
+
+def synthetic_corpus( n, m, density = 0.01, seed = 1000, normalize = True ):
+	"""
+	Generate a random sparse document-term matrix with n documents and m terms, where roughly the 
+	specified fraction of entries are non-zero. Term frequencies follow a Zipf-like distribution, so 
+	that the matrix resembles a real TF-IDF corpus. Returns the matrix, terms and document IDs.
+	"""
+	rng = np.random.RandomState( seed )
+	nnz_per_row = max( 1, int( density * m ) )
+	term_weights = 1.0 / np.arange( 1, m + 1 )
+	term_weights /= term_weights.sum()
+	rows = np.repeat( np.arange( n ), nnz_per_row )
+	cols = rng.choice( m, size = n * nnz_per_row, p = term_weights )
+	values = rng.randint( 1, 10, size = len(cols) ).astype( np.float64 )
+	X = sp.csr_matrix( ( values, ( rows, cols ) ), shape = ( n, m ) )
+	X.sum_duplicates()
+	if normalize:
+		norms = np.sqrt( np.asarray( X.multiply( X ).sum( axis = 1 ) ).ravel() )
+		norms[norms == 0] = 1.0
+		X = sp.csr_matrix( sp.diags( 1.0 / norms ).dot( X ) )
+	doc_ids = ["doc%07d" % i for i in range(n)]
+	return ( X, synthetic_terms( m ), doc_ids )
+
+def synthetic_documents( n, words_per_document = 100, vocabulary_size = 5000, seed = 1000 ):
+	"""
+	Generate n random text documents as strings, with words drawn from a Zipf-like distribution.
+	"""
+	rng = np.random.RandomState( seed )
+	words = ["w%s" % "".join( chr( ord("a") + int(c) ) for c in str(i) ) for i in range(vocabulary_size)]
+	weights = 1.0 / np.arange( 1, vocabulary_size + 1 )
+	weights /= weights.sum()
+	docs = []
+	for i in range(n):
+		choices = rng.choice( vocabulary_size, size = words_per_document, p = weights )
+		docs.append( " ".join( words[j] for j in choices ) )
+	return docs
+
+def synthetic_partition( n, k, seed = 1000 ):
+	rng = np.random.RandomState( seed )
+	return rng.randint( 0, k, size = n )
+
+# --------------------------------------------------------------
+# Synthetic Ranking Sets
+# --------------------------------------------------------------
+
+def synthetic_rankings( k, t, r = 1, overlap = 0.5, vocabulary_size = None, seed = 1000 ):
+	"""
+	Generate a reference set of k random term rankings of length t, together with r perturbed ranking 
+	sets. In each perturbed set, every ranking keeps roughly the specified fraction of the terms from 
+	the corresponding reference ranking, in shuffled positions, and the order of the rankings is 
+	shuffled. Returns the reference set and the list of perturbed sets.
+	"""
+	rng = np.random.RandomState( seed )
+	if vocabulary_size is None:
+		vocabulary_size = max( 2 * k * t, 1000 )
+	terms = synthetic_terms( vocabulary_size )
+	reference = [rng.choice( vocabulary_size, size = t, replace = False ) for i in range(k)]
+	all_rankings = []
+	for run in range(r):
+		rankings = []
+		for ids in reference:
+			keep = rng.rand( t ) < overlap
+			ranking = list( ids[keep] )
+			# fill the remaining positions with other random terms, avoiding duplicates
+			used = set( ranking )
+			while len(ranking) < t:
+				term_id = rng.randint( vocabulary_size )
+				if not term_id in used:
+					used.add( term_id )
+					ranking.append( term_id )
+			ranking = np.array( ranking )
+			rng.shuffle( ranking[0:max( 1, t // 4 )] )
+			rankings.append( [terms[i] for i in ranking] )
+		order = rng.permutation( k )
+		all_rankings.append( [rankings[i] for i in order] )
+	reference = [[terms[i] for i in ids] for ids in reference]
+	return ( reference, all_rankings )
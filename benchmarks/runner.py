@@ -0,0 +1,122 @@
+import gc, json, os, os.path, platform, subprocess, time, timeit
+import numpy as np
+
+# --------------------------------------------------------------
+# Measurement
+# --------------------------------------------------------------
+
+def cpu_time():
+	if hasattr( time, "process_time" ):
+		return time.process_time()
+	return time.clock()
+
+def peak_memory( func, *args ):
+	"""
+	Return the peak memory in bytes allocated while calling the function, or None if memory tracing 
+	is not supported by this version of Python.
+	"""
+	try:
+		import tracemalloc
+	except ImportError:
+		return None
+	gc.collect()
+	tracemalloc.start()
+	try:
+		func( *args )
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+def measure( func, state, repeat = 3 ):
+	"""
+	Time repeated calls of the function on the state. Returns a dictionary with the wall clock times
+	and CPU times of each call, and the output of the last call.
+	"""
+	wall_times, cpu_times = [], []
+	output = None
+	for i in range(repeat):
+		gc.collect()
+		start_wall, start_cpu = timeit.default_timer(), cpu_time()
+		output = func( state )
+		wall_times.append( timeit.default_timer() - start_wall )
+		cpu_times.append( cpu_time() - start_cpu )
+	return { "wall" : wall_times, "cpu" : cpu_times, "best" : min( wall_times ), "median" : float( np.median( wall_times ) ), "output" : output }
+
+def params_key( params ):
+	return ",".join( "%s=%s" % ( key, params[key] ) for key in sorted( params ) )
+
+# --------------------------------------------------------------
+# Running
+# --------------------------------------------------------------
+
+def run_benchmark( benchmark, params, repeat = 3, check = True, memory = True ):
+	"""
+	Run a single benchmark for one set of parameters, timing the fast path and the reference 
+	implementation if there is one, and checking that their outputs agree.
+	"""
+	state = benchmark.setup( params )
+	result = { "name" : benchmark.name, "params" : params }
+	timings = measure( benchmark.run, state, repeat )
+	output = timings.pop( "output" )
+	result.update( timings )
+	if memory:
+		result["peak_memory"] = peak_memory( benchmark.run, state )
+	if check and not benchmark.reference is None:
+		reference_timings = measure( benchmark.reference, state, 1 )
+		result["reference_best"] = reference_timings["best"]
+		result["matches"] = bool( benchmark.compare( output, reference_timings["output"] ) )
+	return result
+
+def run_benchmarks( benchmarks, scale = "small", repeat = 3, check = True, memory = True, callback = None ):
+	results = []
+	for benchmark in benchmarks:
+		for params in benchmark.params( scale ):
+			result = run_benchmark( benchmark, params, repeat, check, memory )
+			if not callback is None:
+				callback( result )
+			results.append( result )
+	return results
+
+def current_commit():
+	repo_dir = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+	try:
+		devnull = open( os.devnull, "w" )
+		return subprocess.check_output( ["git", "rev-parse", "--short", "HEAD"], cwd = repo_dir, stderr = devnull ).decode( "utf-8" ).strip()
+	except Exception:
+		return None
+
+def environment():
+	return { "commit" : current_commit(), "python" : platform.python_version(), "numpy" : np.__version__, "platform" : platform.platform() }
+
+# --------------------------------------------------------------
+# Results
+# --------------------------------------------------------------
+
+def save_results( out_path, results, scale ):
+	report = { "environment" : environment(), "scale" : scale, "results" : results }
+	fout = open( out_path, "w" )
+	json.dump( report, fout, indent = 1, sort_keys = True )
+	fout.close()
+
+def load_results( in_path ):
+	fin = open( in_path, "r" )
+	report = json.load( fin )
+	fin.close()
+	return report
+
+def compare_results( old_results, new_results ):
+	"""
+	Match the results of two benchmark runs by name and parameters. Returns a list of tuples 
+	containing the name, the parameters key, the old and new best times, and their ratio.
+	"""
+	old_map = {}
+	for result in old_results:
+		old_map[( result["name"], params_key( result["params"] ) )] = result
+	comparisons = []
+	for result in new_results:
+		key = ( result["name"], params_key( result["params"] ) )
+		if not key in old_map:
+			continue
+		old_best, new_best = old_map[key]["best"], result["best"]
+		comparisons.append( ( key[0], key[1], old_best, new_best, new_best / max( old_best, 1e-12 ) ) )
+	return comparisons
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Tool to combine the document partitions produced by multiple runs of NMF/LDA/SKM on subsamples of a
+corpus into a single consensus partition, and to measure the stability of the partitions for each
+number of topics.
+"""
+import os, os.path, sys
+import logging as log
+from optparse import OptionParser
+import numpy as np
+from prettytable import PrettyTable
+import text.util, unsupervised.consensus, unsupervised.util
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] corpus_file results_dir1 results_dir2 ...")
+	parser.add_option("-k", action="store", type="int", dest="k", help="number of consensus clusters (default is the number of clusters in the runs)", default=None)
+	parser.add_option("--seed", action="store", type="int", dest="seed", help="random seed", default=1000)
+	parser.add_option("--nowrite", action="store_true", dest="no_write", help="do not write the consensus partitions")
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if( len(args) < 2 ):
+		parser.error( "Must specify at least a corpus and one results directory" )
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+
+	# Load the cached corpus
+	corpus_path = args[0]
+	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	log.info( "Corpus has %d documents" % len(doc_ids) )
+
+	tab = PrettyTable( ["directory", "k", "runs", "stability", "mean ARI"] )
+	tab.align["directory"] = "l"
+	for result_dir_path in args[1:]:
+		result_dir_path = result_dir_path.rstrip(os.sep)
+		locations = unsupervised.consensus.find_run_partitions( result_dir_path )
+		if len(locations) == 0:
+			print( "Warning: No partitions found in directory %s" % result_dir_path )
+			continue
+		log.info( "Building co-association for %d partitions in %s ..." % ( len(locations), result_dir_path ) )
+		coassoc = unsupervised.consensus.build_coassociation( locations, doc_ids )
+		k = options.k
+		if k is None:
+			k = max( coassoc.run_sizes )
+		log.info( "Extracting consensus partition with k=%d ..." % k )
+		partition = coassoc.consensus( k, options.seed )
+		(stability, cluster_scores) = coassoc.stability( partition )
+		agreement = coassoc.run_agreement( partition )
+		for cluster_index in range( len(cluster_scores) ):
+			log.debug( "Cluster %02d: size=%d stability=%.3f" % ( cluster_index+1, np.sum( partition == cluster_index ), cluster_scores[cluster_index] ) )
+		tab.add_row( [result_dir_path, k, len(coassoc), "%.3f" % stability, "%.3f" % agreement.mean()] )
+		if not options.no_write:
+			out_path = os.path.join( result_dir_path, "partition_consensus.pkl" )
+			log.info( "Writing consensus partition to %s" % out_path )
+			# documents are identified by their row indices, as in the partitions of the runs
+			unsupervised.util.save_partition( out_path, partition, np.arange( X.shape[0] ) )
+	print( tab )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
@@ -7,19 +7,23 @@ The output files have the following format:
 - *.terms: List of terms in the corpus, with each line corresponding to a column of the sparse data matrix.
 - *.docs: List of document identifiers, with each line corresponding to a row of the sparse data matrix.
 - *.labels: Assignment of documents to the "ground truth" label, where each line corresponds to a different class label.
+
+The tool can also convert between the Joblib (PKL) format and the memory-mappable binary corpus format, in 
+either direction, using the option --format pkl or --format binary. Binary corpus directories are detected 
+automatically when passed as input.
 """
 import os, os.path, sys, codecs
 import logging as log
 from optparse import OptionParser
 import numpy as np
 import text.util
-import scipy.io
 
 # --------------------------------------------------------------
 
 def main():
 	parser = OptionParser(usage="usage: %prog [options] corpus_file")
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
+	parser.add_option("-f","--format", action="store", type="choice", choices=["mtx","pkl","binary"], dest="out_format", help="output format: mtx (plain text files), pkl (Joblib file) or binary (memory-mappable directory)", default="mtx")
 	(options, args) = parser.parse_args()
 	if len(args) < 1:
 		parser.error( "Must specify one corpus file" )	
@@ -33,11 +37,27 @@ def main():
 	# Load the cached corpus
 	corpus_path = args[0]
 	log.info("Converting corpus from file %s ..." % corpus_path)
-	corpus_name = os.path.splitext( os.path.basename( corpus_path ) )[0]
+	corpus_name = text.util.corpus_name( corpus_path )
 	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
 	log.info( "Read existing document-term matrix: %d documents, %d terms" % (X.shape[0], X.shape[1]) )
 
+	# Convert to one of the binary formats?
+	if options.out_format != "mtx":
+		out_prefix = os.path.join( dir_out_base, corpus_name )
+		if options.out_format == "binary" and os.path.abspath( corpus_path.rstrip(os.sep) ) == os.path.abspath( "%s.corpus" % out_prefix ):
+			parser.error( "Output corpus directory is the same as the input corpus" )
+		if options.out_format == "pkl":
+			# NB: the pickle should not hold references to memory-mapped data
+			X = X.copy()
+			terms, doc_ids = list(terms), list(doc_ids)
+			if not classes is None:
+				classes = dict( classes.items() )
+		out_path = text.util.save_corpus( out_prefix, X, terms, doc_ids, classes, options.out_format )
+		log.info( "Wrote corpus in %s format to %s" % ( options.out_format, out_path ) )
+		return
+
 	# Write the MTX file
+	import scipy.io
 	out_path = os.path.join( dir_out_base, "%s.mtx" % corpus_name )
 	scipy.io.mmwrite( out_path, X )
 	log.info( "Wrote document-term matrix in MTX format to %s" % out_path )
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Tool to build consensus topics from all of the term ranking sets generated by NMF/LDA/SKM for
+a given number of topics, stored in one or more <algo>_kXX directories.
+"""
+import os, os.path, sys
+import logging as log
+from optparse import OptionParser
+import unsupervised.ensemble, unsupervised.rankings, unsupervised.util
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] results_dir1 results_dir2 ...")
+	parser.add_option("-t", "--top", action="store", type="int", dest="top", help="number of top terms to show", default=10)
+	parser.add_option("-r", "--relevance", action="store", type="choice", choices=["rr", "log", "unit"], dest="relevance", help="rank relevance function: rr, log or unit (default is rr)", default="rr")
+	parser.add_option("-o", action="store", type="string", dest="out_path", help="output path for the consensus term rankings", default=None)
+	parser.add_option("--reference", action="store_true", dest="include_reference", help="include the reference ranking set, if present")
+	parser.add_option("-w","--weights", action="store_true", dest="include_weights", help="display term weights")
+	parser.add_option("--sketch", action="store", type="int", dest="sketch_size", help="match topics using MinHash sketches of this size to estimate ranking similarity", default=None)
+	parser.add_option("-l","--long", action="store_true", dest="long_display", help="long format display")
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if( len(args) < 1 ):
+		parser.error( "Must specify at least one results directory" )
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+
+	if options.relevance == "log":
+		rel_measure = unsupervised.ensemble.LogRelevance()
+	elif options.relevance == "unit":
+		rel_measure = unsupervised.ensemble.RelevanceFunction()
+	else:
+		rel_measure = unsupervised.ensemble.ReciprocalRankRelevance()
+
+	# Find all ranking sets
+	rank_paths = []
+	for result_dir_path in args:
+		for fname in sorted( os.listdir( result_dir_path ) ):
+			if not ( fname.startswith( "ranks_" ) and fname.endswith( ".pkl") ):
+				continue
+			if fname == "ranks_reference.pkl" and not options.include_reference:
+				continue
+			rank_paths.append( os.path.join( result_dir_path, fname ) )
+	if len(rank_paths) == 0:
+		log.error( "No ranking sets found" )
+		sys.exit(1)
+
+	# Load the ranking sets, which must all have the same number of topics
+	log.info( "Reading %d term ranking sets ..." % len(rank_paths) )
+	vocabulary = unsupervised.rankings.Vocabulary()
+	all_term_rankings = []
+	for rank_path in rank_paths:
+		log.debug( "Loading term ranking set from %s ..." % rank_path )
+		(term_rankings,labels) = unsupervised.util.load_term_ids( rank_path, vocabulary )
+		if len(all_term_rankings) > 0 and len(term_rankings) != len(all_term_rankings[0]):
+			log.error( "Ranking set %s has %d topics, expected %d" % ( rank_path, len(term_rankings), len(all_term_rankings[0]) ) )
+			sys.exit(1)
+		all_term_rankings.append( term_rankings )
+
+	# Build the ensemble
+	log.info( "Building ensemble of %d ranking sets with %s ..." % ( len(all_term_rankings), str(rel_measure) ) )
+	metric = None
+	if not options.sketch_size is None:
+		metric = unsupervised.rankings.SketchAverageJaccard( options.sketch_size, vocabulary = vocabulary )
+	ensemble = unsupervised.ensemble.TopicEnsemble( rel_measure, metric = metric, vocabulary = vocabulary )
+	ensemble.add_all( all_term_rankings )
+	for topic_index in range( len(ensemble.ensemble_consistency) ):
+		log.debug( "Topic %02d: mean matched similarity=%.3f" % ( topic_index+1, ensemble.ensemble_consistency[topic_index] / max( 1, ensemble.runs - 1 ) ) )
+
+	# Display the consensus topics
+	term_rankings = ensemble.build_rankings( options.top, options.include_weights )
+	m = unsupervised.rankings.term_rankings_size( term_rankings )
+	if options.long_display:
+		print( unsupervised.rankings.format_term_rankings_long( term_rankings, None, min(options.top,m) ) )
+	else:
+		print( unsupervised.rankings.format_term_rankings( term_rankings, None, min(options.top,m) ) )
+
+	# Save the full consensus rankings?
+	if not options.out_path is None:
+		log.info( "Writing consensus term rankings to %s" % options.out_path )
+		consensus_rankings = [vocabulary.encode( ranking ) for ranking in ensemble.build_rankings( -1 )]
+		unsupervised.util.save_term_rankings( options.out_path, consensus_rankings, vocabulary = vocabulary )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
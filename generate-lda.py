@@ -3,7 +3,7 @@ import os, sys, random
 import logging as log
 from optparse import OptionParser
 import numpy as np
-import text.util, unsupervised.lda, unsupervised.rankings, unsupervised.util
+import text.util, unsupervised.lda, unsupervised.rankings, unsupervised.profiling, unsupervised.sampling, unsupervised.util
 
 # --------------------------------------------------------------
 
@@ -14,10 +14,11 @@ def main():
 	parser.add_option("--kmax", action="store", type="int", dest="kmax", help="maximum number of topics", default=5)
 	parser.add_option("-r","--runs", action="store", type="int", dest="runs", help="number of runs", default=1)
 	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=500)
-	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1)", default=0.8)
+	unsupervised.util.add_run_options( parser )
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
 	parser.add_option("-p", "--path", action="store", type="string", dest="mallet_path", help="path to Mallet 2 binary (required)", default=None)	
 	parser.add_option("--rerank", action="store_true", dest="rerank_terms", help="re-rank terms after applying LDA")
+	unsupervised.profiling.add_options( parser )
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if len(args) < 1:
@@ -28,6 +29,7 @@ def main():
 	if not os.path.exists( options.mallet_path ):
 		parser.error( "Cannot find specified Mallet 2 binary" )
 	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	unsupervised.profiling.configure( options )
 
 	if options.dir_out is None:
 		dir_out_base = os.getcwd()
@@ -36,62 +38,94 @@ def main():
 
 	# Load the cached corpus
 	corpus_path = args[0]
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	with unsupervised.profiling.stage( "load_corpus" ):
+		(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	vocabulary = unsupervised.rankings.Vocabulary( terms )
 
 	# Create implementation
 	impl = unsupervised.lda.MalletLDA( options.mallet_path, top = min(100,len(terms)), max_iters = options.maxiter, rerank_terms = options.rerank_terms )
 
 	n_documents = X.shape[0]
-	n_sample = int( options.sample_ratio * n_documents )
-	indices = np.arange(n_documents)
+	# Generate or load the document subsamples for all runs
+	try:
+		(manifest, cache, stopping) = unsupervised.util.prepare_runs( options, corpus_path, n_documents, vocabulary )
+	except ValueError as error:
+		log.error( str(error) )
+		sys.exit(1)
+	n_sample = manifest.rows.shape[1]
+	impl.cache = cache
+
+	# completed runs are only skipped if they were produced with the same settings and corpus
+	settings = "%s maxiters=%d rerank=%s top=%d corpus=%s" % ( impl.__class__.__name__, options.maxiter, options.rerank_terms, impl.top, unsupervised.util.corpus_fingerprint( corpus_path ) )
 
 	# Generate all LDA topic models for the specified numbers of topics
 	log.info( "Testing models in range k=[%d,%d]" % ( options.kmin, options.kmax ) )
-	log.info( "Sampling ratio = %.2f - %d/%d documents per run" % ( options.sample_ratio, n_sample, n_documents ) )
+	log.info( "Sampling ratio = %.2f - %d/%d documents per run" % ( float(n_sample) / n_documents, n_sample, n_documents ) )
 	for k in range(options.kmin, options.kmax+1):
-		# Set random state
-		np.random.seed( options.seed )
-		random.seed( options.seed )			
 		log.info( "Applying LDA (k=%d, runs=%d, seed=%s) ..." % ( k, options.runs, options.seed ) )
 		dir_out_k = os.path.join( dir_out_base, "lda_k%02d" % k )
 		if not os.path.exists(dir_out_k):
 			os.makedirs(dir_out_k)		
 		log.debug( "Results will be written to %s" % dir_out_k )
+		# document partitions for all runs are stored together
+		partitions_out_prefix = os.path.join( dir_out_k, "partitions_%s" % options.seed )
+		partitions = unsupervised.util.create_partition_batch( partitions_out_prefix, options.runs, n_sample, k, n_documents, resume = not options.force )
+		run_manifest = unsupervised.util.load_run_manifest( dir_out_k, options.seed )
+		if not stopping is None:
+			stopping.start( k, os.path.join( options.reference_dir, "lda_k%02d" % k, "ranks_reference.pkl" ) )
 		# Run LDA
 		for r in range(options.runs):
 			log.info( "LDA run %d/%d (k=%d, max_iters=%d, rerank_terms=%s)" % (r+1, options.runs, k, options.maxiter, options.rerank_terms ) )
 			file_suffix = "%s_%03d" % ( options.seed, r+1 )
 			# sub-sample data
-			np.random.shuffle(indices)
-			sample_indices = indices[0:n_sample]
-			S = X[sample_indices,:]
-			sample_doc_ids = []
-			for doc_index in sample_indices:
-				sample_doc_ids.append( doc_ids[doc_index] )
-			# apply LDA, using a new random seed
-			impl.seed = options.seed + r
 			try:
-				impl.apply( S, k )
-			except Exception as error:
-				log.exception("Failed to apply LDA: %s" % str(error) )
+				sample_indices = manifest.get( options.seed, k, r+1 )
+			except KeyError as error:
+				log.error( str(error) )
 				sys.exit(1)
+			# already completed?
+			ranks_out_path = os.path.join( dir_out_k, "ranks_%s.pkl" % file_suffix )
+			out_paths = [ranks_out_path]
+			run_settings = "%s sample=%s" % ( settings, unsupervised.sampling.sample_digest( sample_indices ) )
+			if not options.force and run_manifest.is_complete( options.seed, k, r+1, run_settings, out_paths, { "partition" : partitions.get( r )[0] } ):
+				log.info( "Skipping completed run %d/%d (k=%d)" % ( r+1, options.runs, k ) )
+				if not stopping is None and stopping.update( k, unsupervised.util.load_term_ids( ranks_out_path, vocabulary )[0] ):
+					break
+				continue
+			# Set random state for this run
+			np.random.seed( options.seed + r )
+			random.seed( options.seed + r )
+			S = unsupervised.sampling.RowSubset( X, sample_indices, cache )
+			# apply LDA, using a new random seed
+			impl.seed = options.seed + r
+			with unsupervised.profiling.stage( "apply", k=k, run=r+1 ):
+				try:
+					impl.apply( S, k )
+				except Exception as error:
+					log.exception("Failed to apply LDA: %s" % str(error) )
+					sys.exit(1)
 			# Get term rankings for each topic
-			term_rankings = []
-			for topic_index in range(k):		
-				ranked_term_indices = impl.rank_terms( topic_index )
-				term_ranking = [terms[i] for i in ranked_term_indices]
-				term_rankings.append(term_ranking)
+			with unsupervised.profiling.stage( "rank_terms", k=k, run=r+1 ):
+				term_rankings = []
+				for topic_index in range(k):		
+					term_rankings.append( impl.rank_terms( topic_index ) )
 			log.debug( "Generated ranking set with %d topics covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
 			# Write term rankings
-			ranks_out_path = os.path.join( dir_out_k, "ranks_%s.pkl" % file_suffix )
 			log.debug( "Writing term ranking set to %s" % ranks_out_path )
-			unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
+			with unsupervised.profiling.stage( "save_rankings", k=k, run=r+1 ):
+				unsupervised.util.save_term_rankings( ranks_out_path, term_rankings, vocabulary = vocabulary )
 			# Write document partition
-			partition = impl.generate_partition()
-			partition_out_path = os.path.join( dir_out_k, "partition_%s.pkl" % file_suffix )
-			log.debug( "Writing document partition to %s" % partition_out_path )
-			unsupervised.util.save_partition( partition_out_path, partition, sample_doc_ids )			
-	  
+			with unsupervised.profiling.stage( "save_partition", k=k, run=r+1 ):
+				partition = impl.generate_partition()
+				log.debug( "Writing document partition to %s" % partitions_out_prefix )
+				partitions.set( r, partition, sample_indices )
+				partitions.flush()
+			run_manifest.add( options.seed, k, r+1, run_settings, out_paths, { "partition" : partitions.get( r )[0] } )
+			if not stopping is None and stopping.update( k, term_rankings ):
+				break
+		if not stopping is None:
+			stopping.finish( k, options.runs )
+	unsupervised.profiling.finish()
 
 # --------------------------------------------------------------
 
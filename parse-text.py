@@ -41,6 +41,25 @@ def read_text( in_path ):
 	f.close()	
 	return body
 
+def remove_near_duplicates( docs, doc_ids, labels, options ):
+	"""
+	Remove documents whose shingles are near-duplicates of an earlier document, keeping the first
+	document in each group of near-duplicates.
+	"""
+	log.info( "Building MinHash signatures for %d documents (perms=%d, shingle=%d, jobs=%d) ..." % ( len(docs), options.num_perm, options.shingle_size, options.jobs ) )
+	signatures = text.util.minhash_signatures( docs, options.num_perm, options.shingle_size, jobs = options.jobs )
+	(duplicate_of, similarities) = text.util.find_near_duplicates( signatures, options.dedup_threshold )
+	removed = [i for i in range(len(docs)) if duplicate_of[i] >= 0]
+	for i in removed:
+		log.debug( "Removed %s: near-duplicate of %s (similarity=%.2f)" % ( doc_ids[i], doc_ids[duplicate_of[i]], similarities[i] ) )
+	if not options.duplicates_path is None:
+		with codecs.open( options.duplicates_path, "w", encoding="utf8" ) as fout:
+			for i in removed:
+				fout.write( "%s\t%s\t%.4f\n" % ( doc_ids[i], doc_ids[duplicate_of[i]], similarities[i] ) )
+	log.info( "Removed %d near-duplicate documents with similarity >= %.2f" % ( len(removed), options.dedup_threshold ) )
+	keep = [i for i in range(len(docs)) if duplicate_of[i] < 0]
+	return ( [docs[i] for i in keep], [doc_ids[i] for i in keep], [labels[i] for i in keep] )
+
 def main():
 	parser = OptionParser(usage="usage: %prog [options] dir1 dir2 ...")
 	parser.add_option("-o", action="store", type="string", dest="prefix", help="output prefix for corpus files", default=None)
@@ -49,10 +68,18 @@ def main():
 	parser.add_option("--norm", action="store_true", dest="apply_norm", help="apply unit length normalization to the document-term matrix")
 	parser.add_option("--minlen", action="store", type="int", dest="min_doc_length", help="minimum document length (in characters)", default=50)
 	parser.add_option("-s", action="store", type="string", dest="stoplist_file", help="custom stopword file path", default=None)
+	parser.add_option("--dedup", action="store", type="float", dest="dedup_threshold", help="remove documents whose estimated shingle similarity to an earlier document is at least this value (range is 0 to 1)", default=None)
+	parser.add_option("--shingle", action="store", type="int", dest="shingle_size", help="with --dedup, number of consecutive words in each shingle", default=5)
+	parser.add_option("--perms", action="store", type="int", dest="num_perm", help="with --dedup, number of permutations in each MinHash signature", default=128)
+	parser.add_option("--duplicates", action="store", type="string", dest="duplicates_path", help="with --dedup, write the removed documents and the documents they duplicate to this file", default=None)
+	parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="number of worker processes used to build MinHash signatures", default=1)
+	parser.add_option("-f", "--format", action="store", type="choice", choices=["pkl","binary"], dest="corpus_format", help="corpus output format: pkl (single Joblib file) or binary (memory-mappable directory)", default="pkl")
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 1 ):
 		parser.error( "Must specify at least one directory" )	
+	if not options.dedup_threshold is None and not ( 0 < options.dedup_threshold <= 1 ):
+		parser.error( "Invalid near-duplicate threshold %s" % options.dedup_threshold )
 	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
 	
 	# Find all relevant files in directories specified by user
@@ -73,8 +100,7 @@ def main():
 	docs = []
 	short_documents = 0
 	doc_ids = []
-	label_count = {}
-	classes = {}
+	labels = []
 	for filepath in filepaths:
 		# create the document ID
 		label = os.path.basename( os.path.dirname( filepath ).replace(" ", "_") )
@@ -89,12 +115,19 @@ def main():
 			continue
 		docs.append(body)	
 		doc_ids.append(doc_id)	
+		labels.append(label)
+	log.info( "Kept %d documents. Skipped %d documents with length < %d" % ( len(docs), short_documents, options.min_doc_length ) )
+	# remove near-duplicates before vectorization, so that they do not affect document frequencies
+	if not options.dedup_threshold is None:
+		(docs, doc_ids, labels) = remove_near_duplicates( docs, doc_ids, labels, options )
+	label_count = {}
+	classes = {}
+	for doc_id, label in zip( doc_ids, labels ):
 		if label not in classes:
 			classes[label] = set()
 			label_count[label] = 0
 		classes[label].add(doc_id)
 		label_count[label] += 1
-	log.info( "Kept %d documents. Skipped %d documents with length < %d" % ( len(docs), short_documents, options.min_doc_length ) )
 	if len(classes) < 2:
 		log.warning( "No ground truth available" )
 		classes = None
@@ -115,8 +148,9 @@ def main():
 	prefix = options.prefix
 	if prefix is None:
 		prefix = "corpus"
-	log.info( "Saving corpus '%s'" % prefix )
-	text.util.save_corpus( prefix, X, terms, doc_ids, classes )
+	log.info( "Saving corpus '%s' (format=%s)" % ( prefix, options.corpus_format ) )
+	out_path = text.util.save_corpus( prefix, X, terms, doc_ids, classes, options.corpus_format )
+	log.info( "Wrote corpus to %s" % out_path )
   
 # --------------------------------------------------------------
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Lightweight client for stability-server.py, which only uses the standard library so that it starts
+quickly. Queries are one of stability, diversity, display, position or status, e.g.
+
+	query-results.py stability topic-nmf/nmf_k05 -t 10,20 --runs 1-20
+	query-results.py display reference-nmf/nmf_k05/ranks_reference.pkl -t 10
+	query-results.py position topic-nmf/nmf_k05 --term economy
+"""
+import json, sys
+from optparse import OptionParser
+try:
+	from urllib.request import urlopen
+	from urllib.error import HTTPError
+	from urllib.parse import urlencode
+except ImportError:
+	from urllib2 import urlopen, HTTPError
+	from urllib import urlencode
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] query [path]")
+	parser.add_option("-s", "--server", action="store", type="string", dest="server", help="URL of the server", default="http://127.0.0.1:8765")
+	parser.add_option("-t", "--top", action="store", type="string", dest="top", help="number of top terms to use, or a comma-separated list of values", default="10")
+	parser.add_option("-r", "--runs", action="store", type="string", dest="runs", help="subset of run numbers to include, e.g. 1-10,15", default=None)
+	parser.add_option("--reference", action="store", type="string", dest="reference", help="path of the reference ranking file, relative to the results directory", default=None)
+	parser.add_option("--term", action="store", type="string", dest="term", help="term to find for position queries", default=None)
+	parser.add_option("-j", "--json", action="store_true", dest="raw", help="print the raw JSON response")
+	(options, args) = parser.parse_args()
+	if len(args) < 1:
+		parser.error( "Must specify a query" )
+	query = args[0]
+	params = { "top" : options.top }
+	if len(args) > 1:
+		params["dir" if query == "stability" else "path"] = args[1]
+	for name in ( "runs", "reference", "term" ):
+		if not getattr( options, name ) is None:
+			params[name] = getattr( options, name )
+
+	url = "%s/%s?%s" % ( options.server.rstrip("/"), query, urlencode( params ) )
+	try:
+		result = json.loads( urlopen( url ).read().decode( "utf8" ) )
+	except HTTPError as error:
+		sys.exit( "Error: %s" % json.loads( error.read().decode( "utf8" ) ).get( "error", error ) )
+	if options.raw or not query in ( "stability", "diversity", "display", "position" ):
+		print( json.dumps( result, indent = 2, sort_keys = True ) )
+	elif query == "stability":
+		print( "%s vs %s (%d runs)" % ( result["directory"], result["reference"], result["runs"] ) )
+		for top in sorted( result["stability"], key = int ):
+			scores = result["stability"][top]
+			print( "top=%s: stability=%.4f [%.4f,%.4f]" % ( top, scores["mean"], scores["min"], scores["max"] ) )
+	elif query == "diversity":
+		for top in sorted( result["diversity"], key = int ):
+			print( "top=%s: diversity=%.4f" % ( top, result["diversity"][top] ) )
+	elif query == "display":
+		for label, ranking in zip( result["labels"], result["rankings"] ):
+			print( "%s: %s" % ( label, ", ".join( ranking ) ) )
+	else:
+		for path in sorted( result["positions"] ):
+			print( "%s: %s" % ( path, " ".join( "-" if pos is None else str(pos) for pos in result["positions"][path] ) ) )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
@@ -3,7 +3,7 @@ import os, os.path, sys, random
 import logging as log
 from optparse import OptionParser
 import numpy as np
-import text.util, unsupervised.lda, unsupervised.rankings, unsupervised.util
+import text.util, unsupervised.lda, unsupervised.profiling, unsupervised.rankings, unsupervised.util
 
 # --------------------------------------------------------------
 
@@ -17,6 +17,7 @@ def main():
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
 	parser.add_option("-p", "--path", action="store", type="string", dest="mallet_path", help="path to Mallet 2 binary (required)", default=None)
 	parser.add_option("--rerank", action="store_true", dest="rerank_terms", help="re-rank terms after applying LDA")
+	unsupervised.profiling.add_options( parser )
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 1 ):
@@ -28,6 +29,7 @@ def main():
 		parser.error( "Cannot find specified Mallet 2 binary" )
 	log_level = max(50 - (options.debug * 10), 10)
 	log.basicConfig(level=log_level, format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	unsupervised.profiling.configure( options )
 
 	# Set random state
 	np.random.seed( options.seed )
@@ -40,7 +42,9 @@ def main():
 
 	# Load the cached corpus
 	corpus_path = args[0]
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	with unsupervised.profiling.stage( "load_corpus" ):
+		(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	vocabulary = unsupervised.rankings.Vocabulary( terms )
 
 	# Create implementation
 	impl = unsupervised.lda.MalletLDA( options.mallet_path, top = min(200,len(terms)), max_iters = options.maxiter, rerank_terms = options.rerank_terms )
@@ -53,34 +57,36 @@ def main():
 		if not os.path.exists(dir_out_k):
 			os.makedirs(dir_out_k)		
 		impl.seed = options.seed
-		try:
-			impl.apply( X, k )
-		except Exception as error:
-			log.error("Failed to apply LDA: %s" % str(error) )
-			log.error("Skipping LDA for k=%d" % k )
-			continue
+		with unsupervised.profiling.stage( "apply", k=k ):
+			try:
+				impl.apply( X, k )
+			except Exception as error:
+				log.error("Failed to apply LDA: %s" % str(error) )
+				log.error("Skipping LDA for k=%d" % k )
+				continue
 		# Get term rankings for each topic
-		term_rankings = []
-		for topic_index in range(k):		
-			ranked_term_indices = impl.rank_terms( topic_index )
-			term_ranking = [terms[i] for i in ranked_term_indices]
-			term_rankings.append(term_ranking)
+		with unsupervised.profiling.stage( "rank_terms", k=k ):
+			term_rankings = []
+			for topic_index in range(k):		
+				term_rankings.append( impl.rank_terms( topic_index ) )
 		log.info( "Generated %d rankings covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
 		# Print out the top terms, if we want verbose output
 		if log_level <= 10 and options.top > 0:
-			print( unsupervised.rankings.format_term_rankings( term_rankings, top = options.top ))
+			print( unsupervised.rankings.format_term_rankings( vocabulary.decode_rankings( term_rankings ), top = options.top ))
 
 		log.info( "Writing results to %s" % ( dir_out_k ) )
 		# Write term rankings
 		ranks_out_path = os.path.join( dir_out_k, "ranks_reference.pkl" )
 		log.debug( "Writing term ranking set to %s" % ranks_out_path )
-		unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
+		with unsupervised.profiling.stage( "save_rankings", k=k ):
+			unsupervised.util.save_term_rankings( ranks_out_path, term_rankings, vocabulary = vocabulary )
 		# Write document partition
-		partition = impl.generate_partition()
-		partition_out_path = os.path.join( dir_out_k, "partition_reference.pkl" )
-		log.debug( "Writing document partition to %s" % partition_out_path )
-		unsupervised.util.save_partition( partition_out_path, partition, doc_ids )
-  
+		with unsupervised.profiling.stage( "save_partition", k=k ):
+			partition = impl.generate_partition()
+			partitions_out_prefix = os.path.join( dir_out_k, "partitions_reference" )
+			log.debug( "Writing document partition to %s" % partitions_out_prefix )
+			unsupervised.util.save_partition_batch( partitions_out_prefix, [partition], [np.arange( X.shape[0] )], k, X.shape[0] )
+	unsupervised.profiling.finish()
 
 # --------------------------------------------------------------
 
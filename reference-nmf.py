@@ -3,7 +3,7 @@ import os, sys, random
 import logging as log
 from optparse import OptionParser
 import numpy as np
-import text.util, unsupervised.nmf, unsupervised.rankings, unsupervised.util
+import text.util, unsupervised.nmf, unsupervised.profiling, unsupervised.rankings, unsupervised.util
 
 # --------------------------------------------------------------
 
@@ -16,12 +16,14 @@ def main():
 	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=200)
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
 	parser.add_option("-w","--writefactors", action="store_true", dest="write_factors", help="write complete factorization results")
+	unsupervised.profiling.add_options( parser )
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 1 ):
 		parser.error( "Must specify at least one corpus file" )
 	log_level = max(50 - (options.debug * 10), 10)
 	log.basicConfig(level=log_level, format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	unsupervised.profiling.configure( options )
 	# use nimfa instead of sklearn?
 	use_nimfa = False
 
@@ -37,7 +39,9 @@ def main():
 	# Load the cached corpus
 	corpus_path = args[0]
 	log.info( "Loading corpus from %s ..." % corpus_path )
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	with unsupervised.profiling.stage( "load_corpus" ):
+		(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	vocabulary = unsupervised.rankings.Vocabulary( terms )
 	log.debug( "Read %s document-term matrix, dictionary of %d terms, list of %d document IDs" % ( str(X.shape), len(terms), len(doc_ids) ) )
 
 	# Choose implementation
@@ -53,36 +57,39 @@ def main():
 		dir_out_k = os.path.join( dir_out_base, "nmf_k%02d" % k )
 		if not os.path.exists(dir_out_k):
 			os.makedirs(dir_out_k)		
-		impl.apply( X, k )
+		with unsupervised.profiling.stage( "apply", k=k ):
+			impl.apply( X, k )
 		log.debug( "Generated W %s and H %s" % ( str(impl.W.shape), str(impl.H.shape) ) )
 		# Get term rankings for each topic
-		term_rankings = []
-		for topic_index in range(k):		
-			ranked_term_indices = impl.rank_terms( topic_index )
-			term_ranking = [terms[i] for i in ranked_term_indices]
-			term_rankings.append(term_ranking)
+		with unsupervised.profiling.stage( "rank_terms", k=k ):
+			term_rankings = []
+			for topic_index in range(k):		
+				term_rankings.append( impl.rank_terms( topic_index ) )
 		log.info( "Generated %d rankings covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
 		# Print out the top terms, if we want verbose output
 		if log_level <= 10 and options.top > 0:
-			print(unsupervised.rankings.format_term_rankings( term_rankings, top = options.top ))
+			print(unsupervised.rankings.format_term_rankings( vocabulary.decode_rankings( term_rankings ), top = options.top ))
 
 		log.info( "Writing results to %s" % ( dir_out_k ) )
 		# Write term rankings
 		ranks_out_path = os.path.join( dir_out_k, "ranks_reference.pkl" )
 		log.debug( "Writing term ranking set to %s" % ranks_out_path )
-		unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
+		with unsupervised.profiling.stage( "save_rankings", k=k ):
+			unsupervised.util.save_term_rankings( ranks_out_path, term_rankings, vocabulary = vocabulary )
 		# Write document partition
-		partition = impl.generate_partition()
-		partition_out_path = os.path.join( dir_out_k, "partition_reference.pkl" )
-		log.debug( "Writing document partition to %s" % partition_out_path )
-		unsupervised.util.save_partition( partition_out_path, partition, doc_ids )
+		with unsupervised.profiling.stage( "save_partition", k=k ):
+			partition = impl.generate_partition()
+			partitions_out_prefix = os.path.join( dir_out_k, "partitions_reference" )
+			log.debug( "Writing document partition to %s" % partitions_out_prefix )
+			unsupervised.util.save_partition_batch( partitions_out_prefix, [partition], [np.arange( X.shape[0] )], k, X.shape[0] )
 		# Write the complete factorization?
 		if options.write_factors:
 			factor_out_path = os.path.join( dir_out_k, "factors_reference.pkl" )
 			# NB: need to make a copy of the factors
 			log.debug( "Writing complete factorization to %s" % factor_out_path )
-			unsupervised.util.save_nmf_factors( factor_out_path, np.array( impl.W ), np.array( impl.H ), doc_ids )
-
+			with unsupervised.profiling.stage( "save_factors", k=k ):
+				unsupervised.util.save_nmf_factors( factor_out_path, np.array( impl.W ), np.array( impl.H ), list( doc_ids ) )
+	unsupervised.profiling.finish()
 
 # --------------------------------------------------------------
 
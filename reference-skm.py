@@ -4,7 +4,7 @@ import logging as log
 from optparse import OptionParser
 import numpy as np
 from unsupervised.skm import SphericalKMeans, SpectralSphericalKMeans
-import text.util, unsupervised.rankings, unsupervised.util
+import text.util, unsupervised.profiling, unsupervised.rankings, unsupervised.util
 
 # --------------------------------------------------------------
 
@@ -16,12 +16,14 @@ def main():
 	parser.add_option("-t", "--top", action="store", type="int", dest="top", help="number of top terms to display", default=10)
 	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations", default=100)
 	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
+	unsupervised.profiling.add_options( parser )
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 1 ):
 		parser.error( "Must specify at least one corpus file" )
 	log_level = max(50 - (options.debug * 10), 10)
 	log.basicConfig(level=log_level, format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	unsupervised.profiling.configure( options )
 	init_spectral = True
 
 	# Set random state
@@ -35,7 +37,9 @@ def main():
 
 	# Load the cached corpus
 	corpus_path = args[0]
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	with unsupervised.profiling.stage( "load_corpus" ):
+		(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	vocabulary = unsupervised.rankings.Vocabulary( terms )
 
 	# Implementation of the algorithm
 	if init_spectral:
@@ -50,29 +54,31 @@ def main():
 		dir_out_k = os.path.join( dir_out_base, "skm_k%02d" % k )
 		if not os.path.exists(dir_out_k):
 			os.makedirs(dir_out_k)		
-		impl.apply( X, k )
+		with unsupervised.profiling.stage( "apply", k=k ):
+			impl.apply( X, k )
 		# Get term rankings for each topic
-		term_rankings = []
-		for topic_index in range(k):		
-			ranked_term_indices = impl.rank_terms( topic_index )
-			term_ranking = [terms[i] for i in ranked_term_indices]
-			term_rankings.append(term_ranking)
+		with unsupervised.profiling.stage( "rank_terms", k=k ):
+			term_rankings = []
+			for topic_index in range(k):		
+				term_rankings.append( impl.rank_terms( topic_index ) )
 		log.info( "Generated %d rankings covering up to %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
 		# Print out the top terms, if we want verbose output
 		if log_level <= 10 and options.top > 0:
-			print unsupervised.rankings.format_term_rankings( term_rankings, top = options.top )
+			print( unsupervised.rankings.format_term_rankings( vocabulary.decode_rankings( term_rankings ), top = options.top ) )
 
 		log.info( "Writing results to %s" % ( dir_out_k ) )
 		# Write term rankings
 		ranks_out_path = os.path.join( dir_out_k, "ranks_reference.pkl" )
 		log.debug( "Writing term ranking set to %s" % ranks_out_path )
-		unsupervised.util.save_term_rankings( ranks_out_path, term_rankings )
+		with unsupervised.profiling.stage( "save_rankings", k=k ):
+			unsupervised.util.save_term_rankings( ranks_out_path, term_rankings, vocabulary = vocabulary )
 		# Write document partition
-		partition = impl.generate_partition()
-		partition_out_path = os.path.join( dir_out_k, "partition_reference.pkl" )
-		log.debug( "Writing document partition to %s" % partition_out_path )
-		unsupervised.util.save_partition( partition_out_path, partition, doc_ids )
-
+		with unsupervised.profiling.stage( "save_partition", k=k ):
+			partition = impl.generate_partition()
+			partitions_out_prefix = os.path.join( dir_out_k, "partitions_reference" )
+			log.debug( "Writing document partition to %s" % partitions_out_prefix )
+			unsupervised.util.save_partition_batch( partitions_out_prefix, [partition], [np.arange( X.shape[0] )], k, X.shape[0] )
+	unsupervised.profiling.finish()
 
 # --------------------------------------------------------------
 
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Tool to benchmark the hot paths of the package on synthetic corpora and ranking sets, checking that
+the output of each fast path agrees with its reference implementation. Results can be saved as JSON
+and compared with the results from another commit.
+"""
+import os, sys
+import logging as log
+from optparse import OptionParser
+from prettytable import PrettyTable
+import benchmarks.cases, benchmarks.runner
+
+# --------------------------------------------------------------
+
+def format_memory( value ):
+	if value is None:
+		return "-"
+	return "%.1fMB" % ( value / 1048576.0 )
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] [benchmark_name1 benchmark_name2 ...]")
+	parser.add_option("-s", "--scale", action="store", type="choice", choices=["small", "medium", "large"], dest="scale", help="size of the synthetic inputs: small, medium or large", default="small")
+	parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", help="number of timed calls for each benchmark", default=3)
+	parser.add_option("-o", action="store", type="string", dest="out_path", help="output path for the JSON results", default=None)
+	parser.add_option("-c", "--compare", action="store", type="string", dest="compare_path", help="JSON results from a previous run to compare against", default=None)
+	parser.add_option("--nocheck", action="store_true", dest="no_check", help="do not run the reference implementations")
+	parser.add_option("--nomemory", action="store_true", dest="no_memory", help="do not measure peak memory")
+	parser.add_option("-l", "--list", action="store_true", dest="list_benchmarks", help="list the available benchmarks")
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+
+	if options.list_benchmarks:
+		for benchmark in benchmarks.cases.all_benchmarks:
+			print( benchmark.name )
+		return
+
+	# select the benchmarks to run, by name or name prefix
+	selected = benchmarks.cases.all_benchmarks
+	if len(args) > 0:
+		selected = [b for b in selected if any( b.name.startswith( name ) for name in args )]
+		if len(selected) == 0:
+			parser.error( "No benchmarks match %s" % " ".join( args ) )
+
+	def report( result ):
+		log.info( "%s [%s]: best=%.4fs median=%.4fs peak=%s" % ( result["name"], benchmarks.runner.params_key( result["params"] ), result["best"], result["median"], format_memory( result.get( "peak_memory", None ) ) ) )
+		if "matches" in result and not result["matches"]:
+			log.error( "%s [%s]: output differs from the reference implementation" % ( result["name"], benchmarks.runner.params_key( result["params"] ) ) )
+
+	log.info( "Running %d benchmarks at scale '%s' ..." % ( len(selected), options.scale ) )
+	results = benchmarks.runner.run_benchmarks( selected, options.scale, options.repeat, not options.no_check, not options.no_memory, report )
+
+	tab = PrettyTable( ["benchmark", "params", "best", "median", "peak memory", "reference", "speedup", "check"] )
+	tab.align["benchmark"] = "l"
+	tab.align["params"] = "l"
+	for result in results:
+		reference = result.get( "reference_best", None )
+		row = [result["name"], benchmarks.runner.params_key( result["params"] ), "%.4fs" % result["best"], "%.4fs" % result["median"], format_memory( result.get( "peak_memory", None ) )]
+		if reference is None:
+			row += ["-", "-", "-"]
+		else:
+			row += ["%.4fs" % reference, "%.1fx" % ( reference / max( result["best"], 1e-12 ) ), "ok" if result["matches"] else "FAILED"]
+		tab.add_row( row )
+	print( tab )
+
+	if not options.out_path is None:
+		log.info( "Writing results to %s" % options.out_path )
+		benchmarks.runner.save_results( options.out_path, results, options.scale )
+
+	# compare with a previous run?
+	if not options.compare_path is None:
+		previous = benchmarks.runner.load_results( options.compare_path )
+		log.info( "Comparing with results from commit %s" % previous["environment"].get( "commit", None ) )
+		tab = PrettyTable( ["benchmark", "params", "before", "after", "ratio"] )
+		tab.align["benchmark"] = "l"
+		tab.align["params"] = "l"
+		for (name, key, old_best, new_best, ratio) in benchmarks.runner.compare_results( previous["results"], results ):
+			tab.add_row( [name, key, "%.4fs" % old_best, "%.4fs" % new_best, "%.2f" % ratio] )
+		print( tab )
+
+	# fail if any fast path disagrees with its reference implementation
+	failures = [result for result in results if not result.get( "matches", True )]
+	if len(failures) > 0:
+		log.error( "%d benchmarks produced output that differs from the reference implementation" % len(failures) )
+		sys.exit(1)
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
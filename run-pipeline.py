@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Tool to run the complete stability analysis for a pre-processed corpus: reference topic models, topic
+models for subsampled runs, and stability scores, for each algorithm and number of topics. The steps
+are modeled as a graph of stages, so that independent stages can run concurrently and only the stages
+whose inputs have changed since the previous invocation are run again.
+"""
+import os, os.path, sys
+import logging as log
+from optparse import OptionParser
+from prettytable import PrettyTable
+import numpy as np
+import unsupervised.pipeline
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] corpus_file")
+	parser.add_option("-a", "--algorithms", action="store", type="string", dest="algorithms", help="comma-separated list of algorithms: nmf, lda, skm", default="nmf")
+	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
+	parser.add_option("--kmin", action="store", type="int", dest="kmin", help="minimum number of topics", default=5)
+	parser.add_option("--kmax", action="store", type="int", dest="kmax", help="maximum number of topics", default=5)
+	parser.add_option("-r","--runs", action="store", type="int", dest="runs", help="number of runs", default=1)
+	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1)", default=0.8)
+	parser.add_option("-t", "--top", action="store", type="string", dest="top", help="number of top terms to use, or a comma-separated list of values", default="20")
+	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations for subsampled runs (default depends on the algorithm)", default=None)
+	parser.add_option("--refiters", action="store", type="int", dest="reference_maxiter", help="maximum number of iterations for reference runs (default depends on the algorithm)", default=None)
+	parser.add_option("-p", "--path", action="store", type="string", dest="mallet_path", help="path to Mallet 2 binary (required for LDA)", default=None)
+	parser.add_option("--rerank", action="store_true", dest="rerank_terms", help="re-rank terms after applying LDA")
+	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
+	parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="number of worker processes", default=1)
+	parser.add_option("--force", action="store_true", dest="force", help="run all stages, even if their outputs are up to date")
+	parser.add_option("-n", "--dryrun", action="store_true", dest="dry_run", help="list the stages which would be run, without running them")
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if len(args) < 1:
+		parser.error( "Must specify a corpus file" )
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+
+	algorithms = [algorithm.strip() for algorithm in options.algorithms.split(",")]
+	for algorithm in algorithms:
+		if not algorithm in unsupervised.pipeline.RUN_MAXITERS:
+			parser.error( "Unknown algorithm '%s'" % algorithm )
+	if "lda" in algorithms:
+		if options.mallet_path is None:
+			parser.error( "Must specify path to Mallet 2 binary file using the option -p <file_path>" )
+		if not os.path.exists( options.mallet_path ):
+			parser.error( "Cannot find specified Mallet 2 binary" )
+		options.mallet_path = os.path.abspath( options.mallet_path )
+	try:
+		options.top = [int(value) for value in options.top.split(",")]
+	except ValueError:
+		parser.error( "Invalid number of top terms '%s'" % options.top )
+	# iterations are set per algorithm, unless specified
+	unsupervised.pipeline.set_maxiters( options, algorithms )
+	dir_out_base = os.path.abspath( options.dir_out or os.getcwd() )
+
+	# Load the corpus once, so that it is shared by all stages run in this process or forked from it
+	corpus_path = os.path.abspath( args[0] )
+	(X,terms,doc_ids,classes) = unsupervised.pipeline.init_worker( corpus_path )
+	log.info( "Corpus has %d documents and %d terms" % X.shape )
+
+	(pipeline, results) = unsupervised.pipeline.build_stability_pipeline( corpus_path, X.shape[0], dir_out_base, algorithms, options.kmin, options.kmax, options )
+	if options.dry_run:
+		for name in pipeline.stale( options.force ):
+			print( name )
+		return
+	(completed, failed) = pipeline.run( options.jobs, options.force, unsupervised.pipeline.init_worker, ( corpus_path, ) )
+	log.info( "Completed %d stages, %d failed" % ( len(completed), len(failed) ) )
+
+	# Summarize the stability scores for all stages which have completed
+	tab = PrettyTable( ["algorithm", "k", "top", "runs", "stability", "min", "max"] )
+	for (algorithm, k) in sorted( results ):
+		out_path = results[(algorithm, k)]
+		if not os.path.exists( out_path ):
+			continue
+		stability = unsupervised.pipeline.load_stability( out_path )
+		for top in options.top:
+			scores = np.array( stability["scores"][str(top)] )
+			tab.add_row( [algorithm, k, top, stability["runs"], "%.4f" % scores.mean(), "%.4f" % scores.min(), "%.4f" % scores.max()] )
+	print( tab )
+	if len(failed) > 0:
+		sys.exit(1)
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Tool to generate a sample manifest for a pre-processed corpus, containing the random document subsamples
+for every run and value of k. The manifest can be passed to generate-nmf.py, generate-lda.py and
+generate-skm.py using the option -m, so that all algorithms are applied to the same perturbations of the corpus.
+"""
+import os, os.path, sys
+import logging as log
+from optparse import OptionParser
+import text.util, unsupervised.sampling
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] corpus_file")
+	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
+	parser.add_option("--kmin", action="store", type="int", dest="kmin", help="minimum number of topics", default=5)
+	parser.add_option("--kmax", action="store", type="int", dest="kmax", help="maximum number of topics", default=5)
+	parser.add_option("-r","--runs", action="store", type="int", dest="runs", help="number of runs", default=1)
+	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1)", default=0.8)
+	parser.add_option("-o", action="store", type="string", dest="out_path", help="output manifest directory (default is <corpus>.samples)", default=None)
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if len(args) < 1:
+		parser.error( "Must specify one corpus file" )
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+
+	# Load the cached corpus
+	corpus_path = args[0]
+	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	n_documents = X.shape[0]
+
+	out_path = options.out_path
+	if out_path is None:
+		out_path = "%s.samples" % text.util.corpus_name( corpus_path )
+
+	# Generate the samples for all runs
+	log.info( "Generating samples for k=[%d,%d], runs=%d, seed=%s, ratio=%.2f ..." % ( options.kmin, options.kmax, options.runs, options.seed, options.sample_ratio ) )
+	manifest = unsupervised.sampling.generate_sample_manifest( n_documents, options.sample_ratio, options.seed, options.kmin, options.kmax, options.runs )
+	log.info( "Generated %d samples of %d/%d documents" % ( len(manifest), manifest.rows.shape[1], n_documents ) )
+	unsupervised.sampling.save_sample_manifest( out_path, manifest )
+	log.info( "Wrote sample manifest to %s" % out_path )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
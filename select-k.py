@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Tool to select the number of topics for a corpus by adaptive search. Rather than running every value of
+k in a range, it scores a coarse grid of values with a few runs each, refines the search around promising
+local maxima of the stability curve, and only adds runs where the best values cannot yet be separated.
+Each value of k evaluated is reported with its stability and confidence interval.
+"""
+import os, os.path, sys
+import logging as log
+from optparse import OptionParser
+from prettytable import PrettyTable
+import unsupervised.pipeline, unsupervised.sampling, unsupervised.selection, unsupervised.util
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] corpus_file")
+	parser.add_option("-a", "--algorithm", action="store", type="choice", choices=["nmf", "lda", "skm"], dest="algorithm", help="algorithm: nmf, lda or skm", default="nmf")
+	parser.add_option("--seed", action="store", type="int", dest="seed", help="initial random seed", default=1000)
+	parser.add_option("--kmin", action="store", type="int", dest="kmin", help="minimum number of topics", default=2)
+	parser.add_option("--kmax", action="store", type="int", dest="kmax", help="maximum number of topics", default=20)
+	parser.add_option("--step", action="store", type="int", dest="step", help="spacing of the initial coarse grid of values of k", default=5)
+	parser.add_option("--initial", action="store", type="int", dest="initial_runs", help="number of runs for each new value of k", default=5)
+	parser.add_option("--batch", action="store", type="int", dest="batch_runs", help="number of runs added to each value of k that cannot be separated from the best", default=5)
+	parser.add_option("--maxruns", action="store", type="int", dest="max_runs", help="maximum number of runs for any value of k", default=50)
+	parser.add_option("-c", "--confidence", action="store", type="float", dest="confidence", help="confidence level for the stability intervals", default=0.95)
+	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1)", default=0.8)
+	parser.add_option("-t", "--top", action="store", type="int", dest="top", help="number of top terms to use", default=20)
+	parser.add_option("--maxiters", action="store", type="int", dest="maxiter", help="maximum number of iterations for subsampled runs (default depends on the algorithm)", default=None)
+	parser.add_option("--refiters", action="store", type="int", dest="reference_maxiter", help="maximum number of iterations for reference runs (default depends on the algorithm)", default=None)
+	parser.add_option("-p", "--path", action="store", type="string", dest="mallet_path", help="path to Mallet 2 binary (required for LDA)", default=None)
+	parser.add_option("--rerank", action="store_true", dest="rerank_terms", help="re-rank terms after applying LDA")
+	parser.add_option("-o","--outdir", action="store", type="string", dest="dir_out", help="base output directory (default is current directory)", default=None)
+	parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="number of worker processes", default=1)
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if len(args) < 1:
+		parser.error( "Must specify a corpus file" )
+	if options.kmin < 2 or options.kmax < options.kmin:
+		parser.error( "Invalid range of topics k=[%d,%d]" % ( options.kmin, options.kmax ) )
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	algorithm = options.algorithm
+	if algorithm == "lda":
+		if options.mallet_path is None:
+			parser.error( "Must specify path to Mallet 2 binary file using the option -p <file_path>" )
+		if not os.path.exists( options.mallet_path ):
+			parser.error( "Cannot find specified Mallet 2 binary" )
+		options.mallet_path = os.path.abspath( options.mallet_path )
+	# stages share their options with the pipeline tool
+	unsupervised.pipeline.set_maxiters( options, [algorithm] )
+	options.top = [options.top]
+	dir_out_base = os.path.abspath( options.dir_out or os.getcwd() )
+	if not os.path.exists( dir_out_base ):
+		os.makedirs( dir_out_base )
+
+	# Load the corpus once, so that it is shared by all stages run in this process or forked from it
+	corpus_path = os.path.abspath( args[0] )
+	(X,terms,doc_ids,classes) = unsupervised.pipeline.init_worker( corpus_path )
+	n_documents = X.shape[0]
+	log.info( "Corpus has %d documents and %d terms" % X.shape )
+	corpus = unsupervised.util.corpus_fingerprint( corpus_path )
+
+	def evaluate( requests ):
+		# stages for all values of k are run together, so that they can run concurrently
+		pipeline = unsupervised.pipeline.Pipeline( os.path.join( dir_out_base, "pipeline.json" ) )
+		out_paths = {}
+		for k in sorted( requests ):
+			manifest_path = os.path.join( dir_out_base, "samples", "k%02d" % k )
+			manifest = unsupervised.sampling.generate_sample_manifest( n_documents, options.sample_ratio, options.seed, k, k, options.max_runs )
+			if not unsupervised.pipeline.same_samples( manifest_path, manifest ):
+				unsupervised.sampling.save_sample_manifest( manifest_path, manifest )
+			out_paths[k] = unsupervised.pipeline.add_stability_stages( pipeline, corpus, dir_out_base, algorithm, k, requests[k], manifest, manifest_path, options )
+		(completed, failed) = pipeline.run( options.jobs, False, unsupervised.pipeline.init_worker, ( corpus_path, ) )
+		if len(failed) > 0:
+			log.error( "Failed to evaluate %d stages" % len(failed) )
+			sys.exit(1)
+		return dict( ( k, unsupervised.pipeline.load_stability( out_paths[k] )["scores"][str(options.top[0])] ) for k in out_paths )
+
+	log.info( "Searching k=[%d,%d] (step=%d, initial runs=%d, max runs=%d)" % ( options.kmin, options.kmax, options.step, options.initial_runs, options.max_runs ) )
+	search = unsupervised.selection.AdaptiveSearch( evaluate, options.kmin, options.kmax, options.step, options.initial_runs, options.batch_runs, options.max_runs, options.confidence )
+	best_k = search.run()
+	full_runs = ( options.kmax - options.kmin + 1 ) * options.max_runs
+	log.info( "Evaluated %d values of k with %d runs in %d rounds (%.1f%% of a full sweep with %d runs)" % ( len(search.estimates), search.total_runs(), search.rounds, 100.0 * search.total_runs() / full_runs, options.max_runs ) )
+
+	tab = PrettyTable( ["k", "runs", "stability", "low", "high", ""] )
+	for k in sorted( search.estimates ):
+		( mean, low, high ) = search.estimates[k].interval()
+		tab.add_row( [k, len(search.estimates[k]), "%.4f" % mean, "%.4f" % low, "%.4f" % high, "*" if k == best_k else ""] )
+	print( tab )
+	print( "Selected k=%d" % best_k )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Tool to serve stability, diversity, display and term position queries on a tree of results over HTTP
+on localhost. The term rankings in the tree are loaded once into memory, and reloaded automatically
+when files change, so that repeated queries avoid the cost of starting the tools and reloading results.
+"""
+import logging as log
+from optparse import OptionParser
+import unsupervised.service
+
+# --------------------------------------------------------------
+
+def main():
+	parser = OptionParser(usage="usage: %prog [options] results_dir")
+	parser.add_option("--host", action="store", type="string", dest="host", help="address to listen on", default="127.0.0.1")
+	parser.add_option("--port", action="store", type="int", dest="port", help="port to listen on", default=8765)
+	parser.add_option("--depth", action="store", type="int", dest="max_depth", help="maximum number of top terms kept for each topic", default=1000)
+	parser.add_option("--cache", action="store", type="int", dest="cache_size", help="maximum number of similarity matrices to cache", default=1024)
+	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
+	(options, args) = parser.parse_args()
+	if( len(args) < 1 ):
+		parser.error( "Must specify a results directory" )
+	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+
+	tree = unsupervised.service.ResultsTree( args[0], options.max_depth )
+	n_dirs = tree.scan()
+	log.info( "Loaded %d directories of rankings covering %d distinct terms" % ( n_dirs, len(tree.vocabulary) ) )
+	service = unsupervised.service.StabilityService( tree, options.cache_size )
+	unsupervised.service.serve( service, options.host, options.port )
+
+# --------------------------------------------------------------
+
+if __name__ == "__main__":
+	main()
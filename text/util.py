@@ -1,11 +1,11 @@
 import codecs, os, os.path, re
-from sklearn.externals import joblib
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
 
 def preprocess( docs, stopwords, min_df = 3, min_term_length = 2, ngram_range = (1,1), apply_tfidf = True, apply_norm = True ):
 	"""
 	Preprocess a list containing text documents stored as strings.
 	"""
+	from sklearn.feature_extraction.text import TfidfVectorizer
 	token_pattern=r"\b\w\w+\b"
 	token_pattern = re.compile(token_pattern, re.U)
 
@@ -41,18 +41,321 @@ def load_stopwords( inpath = "text/stopwords.txt"):
 				stopwords.add(l)
 	return stopwords
 
-def save_corpus( out_prefix, X, terms, doc_ids, classes = None ):
+def save_corpus( out_prefix, X, terms, doc_ids, classes = None, corpus_format = "pkl" ):
 	"""
-	Save a pre-processed scikit-learn corpus and associated metadata using Joblib.
+	Save a pre-processed scikit-learn corpus and associated metadata, either as a single Joblib
+	file or as a memory-mappable binary corpus directory.
 	"""
+	if corpus_format == "binary":
+		return save_corpus_binary( "%s.corpus" % out_prefix, X, terms, doc_ids, classes )
 	matrix_outpath = "%s.pkl" % out_prefix 
-	joblib.dump((X,terms,doc_ids,classes), matrix_outpath ) 
+	load_joblib().dump((X,terms,doc_ids,classes), matrix_outpath ) 
+	return matrix_outpath
 
 def load_corpus( in_path ):
 	"""
-	Load a pre-processed scikit-learn corpus and associated metadata using Joblib.
+	Load a pre-processed scikit-learn corpus and associated metadata. Binary corpus directories 
+	are memory-mapped, while other paths are assumed to be Joblib files.
 	"""
-	(X,terms,doc_ids,classes) = joblib.load( in_path )
+	if is_binary_corpus( in_path ):
+		return load_corpus_binary( in_path )
+	(X,terms,doc_ids,classes) = load_joblib().load( in_path )
 	return (X, terms, doc_ids, classes)
 
+def load_joblib():
+	"""
+	Import Joblib on first use, as only some tools read or write results. The standalone package is
+	preferred, as the version bundled with older releases of scikit-learn imports all of scikit-learn.
+	"""
+	try:
+		import joblib
+	except ImportError:
+		from sklearn.externals import joblib
+	return joblib
+
+def corpus_name( in_path ):
+	"""
+	Return the base name of a corpus file or binary corpus directory, without its extension.
+	"""
+	return os.path.splitext( os.path.basename( in_path.rstrip(os.sep) ) )[0]
+
+# --------------------------------------------------------------
+# Near-Duplicate Documents
+# --------------------------------------------------------------
+
+def shingle_hashes( doc, shingle_size = 5 ):
+	"""
+	Return the 32-bit hashes of the distinct shingles (sequences of consecutive lowercased words) in a
+	document. Documents with fewer words than the shingle size have a single shingle.
+	"""
+	import zlib
+	words = re.findall( r"\w+", doc.lower(), re.U )
+	count = max( 1, len(words) - shingle_size + 1 )
+	shingles = set( " ".join( words[i:i+shingle_size] ) for i in range(count) )
+	return np.array( [zlib.crc32( shingle.encode( "utf8" ) ) & 0xFFFFFFFF for shingle in shingles], dtype=np.uint64 )
+
+def minhash_permutations( num_perm = 128, seed = 1000 ):
+	"""
+	Return the coefficients of the random multiply-shift hash functions used to build MinHash signatures.
+	"""
+	rng = np.random.RandomState( seed )
+	a = rng.randint( 0, 2**62, size = num_perm ).astype( np.uint64 ) * np.uint64(2) + np.uint64(1)
+	b = rng.randint( 0, 2**62, size = num_perm ).astype( np.uint64 )
+	return ( a, b )
+
+def minhash_signature( doc, shingle_size, a, b ):
+	"""
+	Return the MinHash signature of a single document, for the specified permutation coefficients.
+	"""
+	hashes = shingle_hashes( doc, shingle_size )
+	# each hash function keeps the high 32 bits of a*x+b modulo 2^64, so the minimum can be taken first
+	return ( ( np.outer( a, hashes ) + b[:,np.newaxis] ).min( axis = 1 ) >> np.uint64(32) ).astype( np.uint32 )
+
+def minhash_chunk( params ):
+	( docs, shingle_size, a, b ) = params
+	return [minhash_signature( doc, shingle_size, a, b ) for doc in docs]
+
+def minhash_signatures( docs, num_perm = 128, shingle_size = 5, seed = 1000, jobs = 1 ):
+	"""
+	Build the MinHash signatures of a list of documents as a (documents x permutations) array, using
+	the specified number of worker processes.
+	"""
+	( a, b ) = minhash_permutations( num_perm, seed )
+	if jobs < 2:
+		signatures = minhash_chunk( ( docs, shingle_size, a, b ) )
+	else:
+		from multiprocessing import Pool
+		# documents are sent to the workers in chunks, so that the coefficients are not sent with every document
+		chunk_size = max( 1, min( 1000, len(docs) // ( 4 * jobs ) ) )
+		pool = Pool( jobs )
+		try:
+			chunks = pool.map( minhash_chunk, [( docs[i:i+chunk_size], shingle_size, a, b ) for i in range( 0, len(docs), chunk_size )] )
+		finally:
+			pool.close()
+			pool.join()
+		signatures = [signature for chunk in chunks for signature in chunk]
+	return np.array( signatures, dtype=np.uint32 ).reshape( (len(docs), num_perm) )
+
+def lsh_bands( num_perm, threshold ):
+	"""
+	Return the number of bands used to group the signatures, chosen among the divisors of the number
+	of permutations to minimize the sum of the probabilities of pairs below the threshold becoming
+	candidates and of pairs above the threshold not becoming candidates.
+	"""
+	x = np.linspace( 0.0, 1.0, 201 )
+	def error( bands ):
+		# probability that a pair with similarity x is identical in at least one band
+		p = 1.0 - ( 1.0 - x ** ( num_perm // bands ) ) ** bands
+		return np.mean( p[x < threshold] ) + np.mean( 1.0 - p[x >= threshold] )
+	return min( [bands for bands in range( 1, num_perm + 1 ) if num_perm % bands == 0], key = error )
+
+def find_near_duplicates( signatures, threshold = 0.8, bands = None ):
+	"""
+	Find near-duplicate documents from their MinHash signatures. Documents whose signatures are identical
+	in any band are candidates, and a candidate is a near-duplicate of an earlier document if the
+	estimated Jaccard similarity of their shingles is at least the threshold. Each document is only
+	compared with the earlier documents which are kept. Returns an array with the index of the kept
+	document for each near-duplicate, or -1 for kept documents, and the estimated similarities.
+	"""
+	n, num_perm = signatures.shape
+	bands = bands or lsh_bands( num_perm, threshold )
+	rows = num_perm // bands
+	# bucket of each document in each band
+	buckets = np.empty( (n, bands), dtype=np.int64 )
+	for band in range(bands):
+		buckets[:,band] = np.unique( signatures[:,band*rows:(band+1)*rows], axis = 0, return_inverse = True )[1].ravel()
+	duplicate_of = np.empty( n, dtype=np.int64 )
+	duplicate_of.fill( -1 )
+	similarities = np.zeros( n )
+	kept = [{} for band in range(bands)]
+	for doc_index in range(n):
+		candidates = set()
+		for band in range(bands):
+			candidates.update( kept[band].get( buckets[doc_index,band], [] ) )
+		if len(candidates) > 0:
+			candidates = np.array( sorted( candidates ) )
+			sims = ( signatures[candidates] == signatures[doc_index] ).mean( axis = 1 )
+			best = np.argmax( sims )
+			if sims[best] >= threshold:
+				duplicate_of[doc_index] = candidates[best]
+				similarities[doc_index] = sims[best]
+				continue
+		for band in range(bands):
+			kept[band].setdefault( buckets[doc_index,band], [] ).append( doc_index )
+	return ( duplicate_of, similarities )
+
+# --------------------------------------------------------------
+# Binary Corpus Format
+# --------------------------------------------------------------
+
+def is_binary_corpus( in_path ):
+	"""
+	Check whether the specified path is a binary corpus directory.
+	"""
+	return os.path.isdir( in_path ) and os.path.exists( os.path.join( in_path, "matrix.indptr.npy" ) )
+
+class StringTable:
+	"""
+	Read-only sequence of strings, stored as one block of UTF-8 bytes with an array of offsets 
+	marking where each string starts. Strings are only decoded when accessed.
+	"""
+	def __init__( self, offsets, data ):
+		self.offsets = offsets
+		self.data = data
+
+	def __len__( self ):
+		return len(self.offsets) - 1
+
+	def __getitem__( self, index ):
+		if isinstance( index, slice ):
+			return [self[i] for i in range(*index.indices(len(self)))]
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError("string table index out of range")
+		return self.data[self.offsets[index]:self.offsets[index+1]].tobytes().decode("utf8")
+
+	def __iter__( self ):
+		for i in range(len(self)):
+			yield self[i]
+
+	def tolist( self ):
+		return list(self)
+
+def save_string_table( out_prefix, strings ):
+	"""
+	Write a list of strings as an offset-indexed string table.
+	"""
+	encoded = [s.encode("utf8") for s in strings]
+	offsets = np.zeros( len(encoded) + 1, dtype=np.int64 )
+	offsets[1:] = np.cumsum( [len(b) for b in encoded] )
+	np.save( "%s.offsets.npy" % out_prefix, offsets )
+	with open( "%s.strings" % out_prefix, "wb" ) as fout:
+		fout.write( b"".join( encoded ) )
+
+def load_string_table( in_prefix, mmap = True ):
+	"""
+	Read an offset-indexed string table written by save_string_table().
+	"""
+	offsets = np.load( "%s.offsets.npy" % in_prefix, mmap_mode = "r" if mmap else None )
+	strings_path = "%s.strings" % in_prefix
+	# NB: numpy cannot memory-map an empty file
+	if mmap and os.path.getsize( strings_path ) > 0:
+		data = np.memmap( strings_path, dtype=np.uint8, mode="r" )
+	else:
+		data = np.fromfile( strings_path, dtype=np.uint8 )
+	return StringTable( offsets, data )
+
+class ClassMap:
+	"""
+	Read-only mapping from class names to sets of document IDs, backed by a compact array with one 
+	class index per document (-1 if the document has no class). Sets are built on first access.
+	"""
+	def __init__( self, names, labels, doc_ids ):
+		self.names = list(names)
+		self.labels = labels
+		self.doc_ids = doc_ids
+		self._sets = {}
+
+	def __len__( self ):
+		return len(self.names)
 
+	def __iter__( self ):
+		return iter(self.names)
+
+	def __contains__( self, class_name ):
+		return class_name in self.names
+
+	def __getitem__( self, class_name ):
+		if not class_name in self._sets:
+			class_index = self.names.index( class_name )
+			self._sets[class_name] = set( self.doc_ids[i] for i in np.where( self.labels == class_index )[0] )
+		return self._sets[class_name]
+
+	def keys( self ):
+		return list(self.names)
+
+	def values( self ):
+		return [self[class_name] for class_name in self.names]
+
+	def items( self ):
+		return [(class_name, self[class_name]) for class_name in self.names]
+
+	def get( self, class_name, default = None ):
+		if class_name in self.names:
+			return self[class_name]
+		return default
+
+def class_labels( classes, doc_ids ):
+	"""
+	Convert a dictionary mapping class names to document IDs into a sorted list of class names
+	and an array with the class index of each document (-1 if the document has no class).
+	"""
+	if isinstance( classes, ClassMap ):
+		return ( classes.names, classes.labels )
+	names = sorted( classes.keys() )
+	doc_map = {}
+	for i, doc_id in enumerate(doc_ids):
+		doc_map[doc_id] = i
+	dtype = np.int8 if len(names) < 127 else np.int32
+	labels = np.empty( len(doc_ids), dtype=dtype )
+	labels.fill( -1 )
+	for class_index, class_name in enumerate(names):
+		for doc_id in classes[class_name]:
+			row = doc_map.get( doc_id, None )
+			if row is None:
+				continue
+			if labels[row] != -1:
+				raise ValueError("Document %s belongs to more than one class" % doc_id )
+			labels[row] = class_index
+	return ( names, labels )
+
+def save_corpus_binary( out_path, X, terms, doc_ids, classes = None ):
+	"""
+	Save a pre-processed corpus as a binary corpus directory, containing the raw CSR arrays of the 
+	document-term matrix, string tables for terms and document IDs, and compact class labels.
+	"""
+	if not os.path.exists( out_path ):
+		os.makedirs( out_path )
+	# store the matrix in canonical form, so that it never needs to be modified after loading
+	X = X.tocsr()
+	if not X.has_canonical_format:
+		X = X.copy()
+		X.sum_duplicates()
+	np.save( os.path.join( out_path, "matrix.data.npy" ), X.data )
+	np.save( os.path.join( out_path, "matrix.indices.npy" ), X.indices )
+	np.save( os.path.join( out_path, "matrix.indptr.npy" ), X.indptr )
+	np.save( os.path.join( out_path, "matrix.shape.npy" ), np.array( X.shape, dtype=np.int64 ) )
+	save_string_table( os.path.join( out_path, "terms" ), terms )
+	save_string_table( os.path.join( out_path, "docs" ), doc_ids )
+	# remove stale class information from a previous corpus
+	for fname in ["classes.offsets.npy", "classes.strings", "labels.npy"]:
+		if os.path.exists( os.path.join( out_path, fname ) ):
+			os.remove( os.path.join( out_path, fname ) )
+	if not classes is None:
+		(names, labels) = class_labels( classes, doc_ids )
+		save_string_table( os.path.join( out_path, "classes" ), names )
+		np.save( os.path.join( out_path, "labels.npy" ), labels )
+	return out_path
+
+def load_corpus_binary( in_path, mmap = True ):
+	"""
+	Load a binary corpus directory. By default, all arrays are memory-mapped rather than read.
+	"""
+	from scipy import sparse as sp
+	mmap_mode = "r" if mmap else None
+	# the matrix arrays are mapped copy-on-write, as some operations canonicalize sparse matrices in place
+	matrix_mmap_mode = "c" if mmap else None
+	data = np.load( os.path.join( in_path, "matrix.data.npy" ), mmap_mode = matrix_mmap_mode )
+	indices = np.load( os.path.join( in_path, "matrix.indices.npy" ), mmap_mode = matrix_mmap_mode )
+	indptr = np.load( os.path.join( in_path, "matrix.indptr.npy" ), mmap_mode = matrix_mmap_mode )
+	shape = tuple( np.load( os.path.join( in_path, "matrix.shape.npy" ) ).tolist() )
+	X = sp.csr_matrix( (data, indices, indptr), shape = shape, copy = False )
+	terms = load_string_table( os.path.join( in_path, "terms" ), mmap )
+	doc_ids = load_string_table( os.path.join( in_path, "docs" ), mmap )
+	classes = None
+	if os.path.exists( os.path.join( in_path, "labels.npy" ) ):
+		names = load_string_table( os.path.join( in_path, "classes" ), mmap ).tolist()
+		labels = np.load( os.path.join( in_path, "labels.npy" ), mmap_mode = mmap_mode )
+		classes = ClassMap( names, labels, doc_ids )
+	return (X, terms, doc_ids, classes)
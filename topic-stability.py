@@ -4,55 +4,93 @@ import logging as log
 from optparse import OptionParser
 import numpy as np
 import unsupervised.util
+import unsupervised.profiling
 import unsupervised.rankings
 
 # --------------------------------------------------------------
 
 def main():
 	parser = OptionParser(usage="usage: %prog [options] reference_rank_file test_rank_file1 test_rank_file2 ...")
-	parser.add_option("-t", "--top", action="store", type="int", dest="top", help="number of top terms to use", default=20)
+	parser.add_option("-t", "--top", action="store", type="string", dest="top", help="number of top terms to use, or a comma-separated list of values", default="20")
+	parser.add_option("--approx", action="store_true", dest="approximate", help="use fast approximate matching, reporting an upper bound on the exact stability")
+	parser.add_option("--refine", action="store", type="float", dest="tolerance", help="with --approx, use exact matching for runs where the bound exceeds the approximate score by more than this value", default=None)
+	parser.add_option("--sketch", action="store", type="int", dest="sketch_size", help="estimate the similarity of rankings from MinHash sketches of this size, stored alongside the ranking files", default=None)
+	unsupervised.util.add_prefetch_options( parser )
+	unsupervised.profiling.add_options( parser )
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 
 	(options, args) = parser.parse_args()
 	if( len(args) < 2 ):
 		parser.error( "Must specify at least two ranking sets" )
 	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	unsupervised.profiling.configure( options )
+	try:
+		top_values = [int(value) for value in options.top.split(",")]
+	except ValueError:
+		parser.error( "Invalid number of top terms '%s'" % options.top )
+	# a top value below 1 uses all terms, so the rankings are only truncated if all values are positive
+	max_top = unsupervised.rankings.truncation_depth( top_values )
+	# all ranking sets are read as ids from one vocabulary, so that they can be compared directly
+	vocabulary = unsupervised.rankings.Vocabulary()
+	if options.sketch_size is None:
+		metric = unsupervised.rankings.AverageJaccard()
+	else:
+		metric = unsupervised.rankings.SketchAverageJaccard( options.sketch_size, vocabulary = vocabulary )
 
-	# Load cached ranking sets
-	log.info( "Reading %d term ranking sets (top=%d) ..." % ( len(args), options.top ) )
-	all_term_rankings = []
-	for rank_path in args:
+	# Load cached ranking sets, comparing each test set with the reference set as soon as it is read
+	log.info( "Reading %d term ranking sets (top=%s) ..." % ( len(args), options.top ) )
+	matcher = unsupervised.rankings.RankingSetAgreement( metric, approximate = options.approximate or not options.tolerance is None, tolerance = options.tolerance )
+	if not options.sketch_size is None:
+		log.info( "Sketch estimates have a standard error of at most %.4f at each sketched depth" % metric.standard_error() )
+	all_scores, all_bounds = {}, {}
+	for top in top_values:
+		all_scores[top] = []
+		all_bounds[top] = []
+	reference_term_ranking = None
+	loader = unsupervised.util.prefetch( lambda rank_path : unsupervised.util.load_term_ids( rank_path, vocabulary ), args, options.load_threads, options.prefetch_window )
+	for i in range( len(args) ):
+		# time spent waiting for each file, as files are read in the background
+		with unsupervised.profiling.stage( "load_rankings" ):
+			(rank_path, (term_rankings,labels)) = next( loader )
 		# first set is the reference set
-		if len(all_term_rankings) == 0:
-			log.debug( "Loading reference term ranking set from %s ..." % rank_path )
+		if reference_term_ranking is None:
+			log.debug( "Loaded reference term ranking set from %s" % rank_path )
 		else:
-			log.debug( "Loading test term ranking set from %s ..." % rank_path )
-		(term_rankings,labels) = unsupervised.util.load_term_rankings( rank_path )
+			log.debug( "Loaded test term ranking set from %s" % rank_path )
 		log.debug( "Set has %d rankings covering %d terms" % ( len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
 		# do we need to truncate the number of terms in the ranking?
-		if options.top > 1:
-			term_rankings = unsupervised.rankings.truncate_term_rankings( term_rankings, options.top )
-			log.debug( "Truncated to %d -> set now has %d rankings covering %d terms" % ( options.top, len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
-		all_term_rankings.append( term_rankings )
-
-	# First argument was the reference term ranking
-	reference_term_ranking = all_term_rankings[0]
-	all_term_rankings = all_term_rankings[1:]
-	r = len(all_term_rankings)
-	log.info( "Loaded %d non-reference term rankings" % r )
-
-	# Perform the evaluation
-	metric = unsupervised.rankings.AverageJaccard()
-	matcher = unsupervised.rankings.RankingSetAgreement( metric )	
-	log.info( "Performing reference comparisons with %s ..." % str(metric) )
-	all_scores = []
-	for i in range(r):
-		score = matcher.similarity( reference_term_ranking, all_term_rankings[i] )
-		all_scores.append( score )
+		if max_top > 1:
+			term_rankings = unsupervised.rankings.truncate_term_rankings( term_rankings, max_top )
+			log.debug( "Truncated to %d -> set now has %d rankings covering %d terms" % ( max_top, len(term_rankings), unsupervised.rankings.term_rankings_size( term_rankings ) ) )
+		if not options.sketch_size is None:
+			with unsupervised.profiling.stage( "load_sketch" ):
+				term_rankings = unsupervised.util.load_ranking_sketch( rank_path, term_rankings, metric )
+		if reference_term_ranking is None:
+			reference_term_ranking = term_rankings
+			log.info( "Performing reference comparisons with %s ..." % str(metric) )
+			continue
+		# scores for all top values come from a single set of prefix overlaps
+		with unsupervised.profiling.stage( "matching", run=i ):
+			scores = matcher.similarities( reference_term_ranking, term_rankings, top_values )
+		for top in top_values:
+			all_scores[top].append( scores[top] )
+			all_bounds[top].append( matcher.all_bounds[top] )
+	r = len(args) - 1
+	log.info( "Compared %d non-reference term rankings" % r )
 	
 	# Get overall score across all candidates
-	all_scores = np.array( all_scores )
-	log.info( "Stability=%.4f [%.4f,%.4f]" % ( all_scores.mean(), all_scores.min(), all_scores.max() ) )
+	for top in top_values:
+		top_scores = np.array( all_scores[top] )
+		if len(top_values) == 1:
+			msg = "Stability=%.4f [%.4f,%.4f]" % ( top_scores.mean(), top_scores.min(), top_scores.max() )
+		else:
+			msg = "Stability (top=%d)=%.4f [%.4f,%.4f]" % ( top, top_scores.mean(), top_scores.min(), top_scores.max() )
+		if matcher.approximate:
+			# exact runs have a bound equal to their score
+			top_bounds = np.array( all_bounds[top] )
+			msg += " upper bound=%.4f, %d/%d runs exact" % ( top_bounds.mean(), np.sum( top_bounds == top_scores ), r )
+		log.info( msg )
+	unsupervised.profiling.finish()
 
 # --------------------------------------------------------------
 
@@ -0,0 +1,175 @@
+import os, os.path
+import numpy as np
+from scipy import sparse as sp
+import unsupervised.util
+
+# --------------------------------------------------------------
+# Co-association
+# --------------------------------------------------------------
+
+class CoAssociation:
+	"""
+	Implicit document co-association matrix for partitions produced by multiple runs on subsamples of
+	a corpus. Each run contributes a block of cluster indicator columns to a sparse (documents x clusters)
+	matrix B, so that the number of runs in which two documents were clustered together is given by
+	B B^T, and the number of runs in which both were sampled is given by D D^T, where D is the
+	(documents x runs) sample indicator matrix. Neither n x n product is ever computed.
+	"""
+	def __init__( self, n_documents ):
+		self.n_documents = n_documents
+		self.run_rows = []
+		self.run_clusters = []
+		self.run_sizes = []
+		self._B = None
+
+	def __len__( self ):
+		return len(self.run_rows)
+
+	def add( self, partition, rows ):
+		"""
+		Add the partition produced by a single run, where rows are the corpus row indices of the
+		clustered documents. Documents with a negative cluster index are treated as not sampled.
+		"""
+		partition = np.asarray( partition ).ravel().astype( np.int64 )
+		rows = np.asarray( rows ).ravel().astype( np.int64 )
+		keep = partition >= 0
+		# relabel the clusters to remove any empty ones
+		values, labels = np.unique( partition[keep], return_inverse = True )
+		self.run_rows.append( rows[keep] )
+		self.run_clusters.append( labels.astype( np.int32 ) )
+		self.run_sizes.append( len(values) )
+		self._B = None
+
+	def cluster_indicators( self ):
+		"""
+		Return the sparse (documents x clusters) indicator matrix B for all runs.
+		"""
+		if self._B is None:
+			offsets = np.concatenate( [[0], np.cumsum( self.run_sizes )] )
+			rows = np.concatenate( self.run_rows )
+			cols = np.concatenate( [labels + offsets[r] for r, labels in enumerate(self.run_clusters)] )
+			self._B = sp.csr_matrix( ( np.ones( len(rows) ), ( rows, cols ) ), shape = ( self.n_documents, offsets[-1] ) )
+		return self._B
+
+	def sample_indicators( self ):
+		"""
+		Return the sparse (documents x runs) indicator matrix D of the documents sampled in each run.
+		"""
+		rows = np.concatenate( self.run_rows )
+		cols = np.repeat( np.arange( len(self) ), [len(r) for r in self.run_rows] )
+		return sp.csr_matrix( ( np.ones( len(rows) ), ( rows, cols ) ), shape = ( self.n_documents, len(self) ) )
+
+	def sample_counts( self ):
+		"""
+		Return the number of runs in which each document was sampled.
+		"""
+		return np.bincount( np.concatenate( self.run_rows ), minlength = self.n_documents )
+
+	def consensus( self, k, random_state = None ):
+		"""
+		Extract a consensus partition with k clusters, by spectral clustering of the bipartite graph
+		between documents and run clusters. Each document is weighted by the number of runs in which it
+		was sampled, so that documents missing from some subsamples are not penalized. Documents which
+		were never sampled are assigned to cluster -1.
+		"""
+		from scipy.sparse.linalg import svds
+		from sklearn.cluster import KMeans
+		B = self.cluster_indicators()
+		counts = self.sample_counts()
+		sampled = np.flatnonzero( counts > 0 )
+		B = sp.diags( 1.0 / np.sqrt( counts[sampled] ) ).dot( B[sampled] )
+		# normalize by the degrees of the documents and of the run clusters
+		doc_degree = np.asarray( B.dot( B.sum( axis = 0 ).T ) ).ravel()
+		cluster_degree = np.asarray( B.sum( axis = 0 ) ).ravel()
+		doc_degree[doc_degree == 0] = 1.0
+		cluster_degree[cluster_degree == 0] = 1.0
+		L = sp.diags( 1.0 / np.sqrt( doc_degree ) ).dot( B ).dot( sp.diags( 1.0 / np.sqrt( cluster_degree ) ) )
+		# leading singular vectors of L give the spectral embedding of the documents
+		n_components = max( 1, min( k, min( L.shape ) - 1 ) )
+		U, s, Vt = svds( L.tocsc(), k = n_components )
+		norms = np.sqrt( np.square( U ).sum( axis = 1 ) )
+		norms[norms == 0] = 1.0
+		U = U / norms[:,np.newaxis]
+		model = KMeans( n_clusters = k, n_init = 10, random_state = random_state )
+		partition = np.empty( self.n_documents, dtype = np.int64 )
+		partition[:] = -1
+		partition[sampled] = model.fit_predict( U )
+		return partition
+
+	def stability( self, partition ):
+		"""
+		Calculate the stability of a partition, given by the fraction of runs sampling a pair of documents
+		in the same cluster in which they were also clustered together, summed over all such pairs. This
+		is computed exactly from the contingency tables between the partition and each run. Returns the
+		overall score and an array with the score for each cluster.
+		"""
+		partition = np.asarray( partition ).ravel()
+		sampled = np.flatnonzero( partition >= 0 )
+		k = int( partition.max() ) + 1 if len(sampled) > 0 else 0
+		Z = sp.csr_matrix( ( np.ones( len(sampled) ), ( partition[sampled], sampled ) ), shape = ( k, self.n_documents ) )
+		counts = self.sample_counts()
+		self_pairs = np.bincount( partition[sampled], weights = counts[sampled], minlength = k )
+		# pairs co-clustered in each run: sum of squared contingency table counts
+		T = Z.dot( self.cluster_indicators() )
+		together = np.asarray( T.multiply( T ).sum( axis = 1 ) ).ravel() - self_pairs
+		# pairs sampled together in each run
+		T = Z.dot( self.sample_indicators() )
+		both = np.asarray( T.multiply( T ).sum( axis = 1 ) ).ravel() - self_pairs
+		cluster_scores = np.zeros( k )
+		nonzero = both > 0
+		cluster_scores[nonzero] = together[nonzero] / both[nonzero]
+		if both.sum() == 0:
+			return ( 0.0, cluster_scores )
+		return ( together.sum() / both.sum(), cluster_scores )
+
+	def run_agreement( self, partition ):
+		"""
+		Calculate the Adjusted Rand Index between the partition and each run, on the documents sampled in the run.
+		"""
+		from sklearn.metrics.cluster import adjusted_rand_score
+		partition = np.asarray( partition ).ravel()
+		scores = []
+		for rows, labels in zip( self.run_rows, self.run_clusters ):
+			scores.append( adjusted_rand_score( partition[rows], labels ) )
+		return np.array( scores )
+
+# --------------------------------------------------------------
+# Utilities
+# --------------------------------------------------------------
+
+def find_run_partitions( dir_path ):
+	"""
+	Find the partitions produced by all subsampled runs in a results directory, ignoring reference
+	partitions. Returns a list of tuples, in the format used by unsupervised.util.find_run_partition().
+	"""
+	locations = []
+	for fname in sorted( os.listdir( dir_path ) ):
+		if fname.startswith( "partition_" ) and fname.endswith( ".pkl" ) and not fname in ( "partition_reference.pkl", "partition_consensus.pkl" ):
+			locations.append( ( os.path.join( dir_path, fname ), None ) )
+		elif fname.startswith( "partitions_" ) and fname.endswith( ".clusters.npy" ) and fname != "partitions_reference.clusters.npy":
+			prefix = os.path.join( dir_path, fname[0:-len(".clusters.npy")] )
+			batch = unsupervised.util.load_partition_batch( prefix )
+			for run_index in np.flatnonzero( batch.completed() ):
+				locations.append( ( prefix, int(run_index) ) )
+	return locations
+
+def build_coassociation( locations, doc_ids ):
+	"""
+	Build the co-association for the run partitions at the specified locations. Partitions saved as
+	Joblib files are mapped to corpus rows using the list of corpus document IDs.
+	"""
+	coassoc = CoAssociation( len(doc_ids) )
+	row_map = None
+	batches = {}
+	for location, run_index in locations:
+		if run_index is None:
+			(partition, partition_doc_ids) = unsupervised.util.load_partition( location )
+			if row_map is None:
+				row_map = dict( ( doc_id, row ) for row, doc_id in enumerate(doc_ids) )
+			rows = np.array( [row_map[doc_id] for doc_id in partition_doc_ids], dtype = np.int64 )
+		else:
+			if not location in batches:
+				batches[location] = unsupervised.util.load_partition_batch( location )
+			(partition, rows) = batches[location].get( run_index )
+		coassoc.add( partition, rows )
+	return coassoc
@@ -1,4 +1,5 @@
-import math, operator
+import math
+import numpy as np
 import unsupervised.rankings
 
 # --------------------------------------------------------------
@@ -12,6 +13,9 @@ class RelevanceFunction:
 		"""	Computes a score for the specified rank, which is indexed from 1 """
 		return 1.0
 
+	def __str__( self ):
+		return "%s" % ( self.__class__.__name__ )
+
 class ReciprocalRankRelevance:
 	""" Relevance function with inverse rank-weighted scores. """
 
@@ -39,78 +43,189 @@ class LogRelevance:
 # Ensembles
 # --------------------------------------------------------------
 
-class EnsembleRanking:
+class RelevanceWeights:
+	"""
+	Array of the relevance scores for ranks 1 to n, using the specified relevance function. The scores
+	are only computed once, and the array is grown when longer rankings are added.
+	"""
 	def __init__( self, rel_measure ):
 		self.rel_measure = rel_measure
-		self.weights = {}
+		self.weights = np.zeros( 0 )
+
+	def get( self, n ):
+		if n > len(self.weights):
+			self.weights = np.array( unsupervised.rankings.calc_relevance_scores( max( n, 2 * len(self.weights) ), self.rel_measure ), dtype=np.float64 )
+		return self.weights[0:n]
+
+def encode_ranking( vocabulary, ranking ):
+	"""
+	Return the ids used to index ensemble weight arrays for a ranking. Rankings which are already arrays
+	of ids from the vocabulary are used directly, while the terms of other rankings are added to it.
+	"""
+	if unsupervised.rankings.is_id_ranking( ranking ):
+		return ranking
+	return vocabulary.encode( ranking )
+
+def top_weighted_terms( weights, top = -1 ):
+	"""
+	Return the ids of the terms with the highest non-zero weights, in descending order of weight.
+	"""
+	candidates = np.flatnonzero( weights )
+	if top > 0 and top < len(candidates):
+		selected = np.argpartition( -weights[candidates], top - 1 )[0:top]
+		candidates = candidates[selected]
+	order = np.argsort( -weights[candidates], kind = "mergesort" )
+	return candidates[order]
+
+class EnsembleRanking:
+	"""
+	Aggregated ranking for a single topic, where the relevance weights of each term across multiple
+	rankings are accumulated in an array indexed by term id.
+	"""
+	def __init__( self, rel_measure, vocabulary = None ):
+		self.rel_measure = rel_measure
+		self.relevance = RelevanceWeights( rel_measure )
+		self.index = vocabulary or unsupervised.rankings.Vocabulary()
+		self.weights = np.zeros( 0 )
 		self.runs = 0
 
 	def add( self, ranking ):
-		for i in range(len(ranking)):
-			self.weights[ranking[i]] = self.weights.get( ranking[i], 0 ) + self.rel_measure.relevance( i + 1 )
+		ids = encode_ranking( self.index, ranking )
+		if len(self.index) > len(self.weights):
+			self.weights = np.concatenate( [self.weights, np.zeros( max( len(self.index), 2 * len(self.weights) ) - len(self.weights) )] )
+		np.add.at( self.weights, ids, self.relevance.get( len(ids) ) )
 		self.runs += 1
 
 	def build_ranking( self, top = -1, include_weights = False ):
-		sx = sorted(self.weights.iteritems(), key=operator.itemgetter(1))
-		sx.reverse()
-		# include everything?
-		if top > 0:
-			actual_top = top
-		else:
-			actual_top = len(sx)
 		ranking = []
-		for p in range( actual_top ):
+		for term_id in top_weighted_terms( self.weights[0:len(self.index)], top ):
 			if include_weights:
-				w = sx[p][1] / self.runs
-				ranking.append( "%s (%.2f)" % ( sx[p][0], w ) )
+				w = self.weights[term_id] / self.runs
+				ranking.append( "%s (%.2f)" % ( self.index.terms[term_id], w ) )
 			else:
-				ranking.append( sx[p][0] )
+				ranking.append( self.index.terms[term_id] )
 		return ranking
 
 	def get_score( self, term ):
-		return self.weights.get( term, 0.0 ) / self.runs
+		term_id = self.index.get_id( term )
+		if term_id is None:
+			return 0.0
+		return self.weights[term_id] / self.runs
 
 	def term_count( self ):
-		return len(self.weights)
+		return len( self.__weighted_ids() )
 
 	def terms( self ):
-		return self.weights.keys()
+		return [self.index.terms[term_id] for term_id in self.__weighted_ids()]
+
+	def __weighted_ids( self ):
+		# only the terms which appear in the added rankings, rather than the whole vocabulary
+		return np.flatnonzero( self.weights[0:len(self.index)] )
 
 
 class TopicEnsemble:
-	def __init__( self, rel_measure = ReciprocalRankRelevance() ):
-		self.matcher = unsupervised.rankings.RankingSetAgreement( unsupervised.rankings.AverageJaccard() )
+	"""
+	Ensemble of multiple topic models with the same number of topics, where the topics from each model 
+	are matched against the topics of the first model. Term weights for all ensemble topics are 
+	accumulated in a single (k x terms) array. Topics are matched using the Average Jaccard metric, unless
+	another metric (e.g. a sketch-based approximation) is specified. Rankings of ids must come from the
+	specified vocabulary.
+	"""
+	def __init__( self, rel_measure = ReciprocalRankRelevance(), max_chunk_size = 2**25, metric = None, vocabulary = None ):
+		self.matcher = unsupervised.rankings.RankingSetAgreement( metric or unsupervised.rankings.AverageJaccard() )
 		self.rel_measure = rel_measure
+		self.relevance = RelevanceWeights( rel_measure )
+		self.max_chunk_size = max_chunk_size
 		self.reference_rankings = None
-		self.ensemble_rankings = []
-		self.ensemble_consistency = []
+		self.index = vocabulary or unsupervised.rankings.Vocabulary()
+		self.weights = None
+		self.ensemble_consistency = None
+		self.runs = 0
 		self.doc_ensemble = None
 
-	def add( self, rankings, partition ):
+	def add( self, rankings, partition = None ):
+		self.add_all( [rankings] )
+
+	def add_all( self, all_rankings ):
+		"""
+		Add the ranking sets produced by multiple models to the ensemble. The topics of all models are 
+		matched in batches, and their weights are then added with a single scatter-add.
+		"""
+		all_rankings = list(all_rankings)
+		if len(all_rankings) == 0:
+			return
+		# compute the relevance scores once, for the longest ranking
+		self.relevance.get( max( len(ranking) for rankings in all_rankings for ranking in rankings ) )
 		# first set of rankings?
 		if self.reference_rankings is None:
-			for ranking in rankings:
-				er = EnsembleRanking( self.rel_measure )
-				er.add( ranking )
-				self.ensemble_rankings.append( er )
-				self.ensemble_consistency.append( 0.0 )
-			self.reference_rankings = rankings
+			self.reference_rankings = all_rankings[0]
+			k = len(self.reference_rankings)
+			self.weights = np.zeros( (k, 0) )
+			self.ensemble_consistency = np.zeros( k )
+			self.__scatter( [all_rankings[0]], [list(range(k))] )
+			all_rankings = all_rankings[1:]
 		# otherwise, add to existing
-		else:
-			self.matcher.similarity( self.reference_rankings, rankings )
-			for pair in self.matcher.results:
-				reference_topic_index = pair[0]
-				other_topic_index = pair[1]
-				self.ensemble_consistency[reference_topic_index] += self.matcher.S[reference_topic_index,other_topic_index]
-				self.ensemble_rankings[reference_topic_index].add( rankings[other_topic_index] )
+		k = len(self.reference_rankings)
+		depth = max( 1, unsupervised.rankings.term_rankings_size( self.reference_rankings ) )
+		chunk = max( 1, self.max_chunk_size // ( k * k * depth ) )
+		for start in range( 0, len(all_rankings), chunk ):
+			batch = all_rankings[start:start+chunk]
+			# compare the reference against the topics of all models in the batch at once
+			stacked = [ranking for rankings in batch for ranking in rankings]
+			S_all = self.matcher.build_matrix( self.reference_rankings, stacked )
+			matches = []
+			offset = 0
+			for rankings in batch:
+				S = S_all[:,offset:offset+len(rankings)]
+				offset += len(rankings)
+				score, results = self.matcher.hungarian_matching( S )
+				targets = [-1] * len(rankings)
+				for (reference_topic_index, other_topic_index) in results:
+					if reference_topic_index < k and other_topic_index < len(rankings):
+						targets[other_topic_index] = reference_topic_index
+						self.ensemble_consistency[reference_topic_index] += S[reference_topic_index,other_topic_index]
+				matches.append( targets )
+			self.__scatter( batch, matches )
+
+	def __scatter( self, batch, matches ):
+		"""
+		Add the relevance weights for the terms of all matched rankings to the weight array.
+		"""
+		rows, cols, values = [], [], []
+		for rankings, targets in zip( batch, matches ):
+			for other_topic_index, ranking in enumerate(rankings):
+				if targets[other_topic_index] < 0:
+					continue
+				ids = encode_ranking( self.index, ranking )
+				rows.append( np.repeat( targets[other_topic_index], len(ids) ) )
+				cols.append( ids )
+				values.append( self.relevance.get( len(ids) ) )
+			self.runs += 1
+		k = self.weights.shape[0]
+		if len(self.index) > self.weights.shape[1]:
+			grown = np.zeros( (k, max( len(self.index), 2 * self.weights.shape[1] )) )
+			grown[:,0:self.weights.shape[1]] = self.weights
+			self.weights = grown
+		if len(rows) > 0:
+			flat = np.concatenate( rows ) * self.weights.shape[1] + np.concatenate( cols )
+			self.weights += np.bincount( flat, weights = np.concatenate( values ), minlength = self.weights.size ).reshape( self.weights.shape )
 
 	def build_rankings( self, top = 10, include_weights = False ):
 		current_term_rankings = []
-		for er in self.ensemble_rankings:
-			current_term_rankings.append( er.build_ranking( top, include_weights ) )
+		n_terms = len(self.index)
+		for topic_index in range( self.weights.shape[0] ):
+			ranking = []
+			for term_id in top_weighted_terms( self.weights[topic_index,0:n_terms], top ):
+				if include_weights:
+					w = self.weights[topic_index,term_id] / self.runs
+					ranking.append( "%s (%.2f)" % ( self.index.terms[term_id], w ) )
+				else:
+					ranking.append( self.index.terms[term_id] )
+			current_term_rankings.append( ranking )
 		return current_term_rankings
 
-
-
-
-
+	def get_score( self, topic_index, term ):
+		term_id = self.index.get_id( term )
+		if term_id is None:
+			return 0.0
+		return self.weights[topic_index,term_id] / self.runs
@@ -2,7 +2,7 @@ import os, os.path, tempfile, shutil
 import logging as log
 from subprocess import call
 import numpy as np
-from scipy.stats.mstats import gmean
+import unsupervised.sampling
 
 class MalletLDA:
 	"""
@@ -20,21 +20,35 @@ class MalletLDA:
 		self.optimize_interval = 10
 		self.rerank_terms = rerank_terms
 		self.delete_temp_files = True
+		# optional cache of Mallet imports for row subset views
+		self.cache = None
 		# state
 		self.partition = None
 
 	def apply( self, X, k = 2 ):
 		"""
-		Apply topic modeling to the specific document-term matrix, using K topics.
+		Apply topic modeling to the specific document-term matrix, using K topics. The matrix can
+		also be a row subset view, in which case rows are read directly from the full matrix.
 		"""
 		self.partition = None
 		self.topic_rankings = None
 		# create Mallet corpus
 		dir_tmp = tempfile.mkdtemp()
-		corpus_path = self.__write_documents( X, dir_tmp )
-		mallet_data_path = self.__import_data( corpus_path, dir_tmp )
-		if not os.path.exists( mallet_data_path ):
-			raise Exception("Error: Failed to import data into Mallet format")
+		mallet_data_path = None
+		use_cache = not self.cache is None and isinstance( X, unsupervised.sampling.RowSubset )
+		if use_cache:
+			mallet_data_path = self.cache.path( X.rows, "mallet" )
+			if os.path.exists( mallet_data_path ):
+				log.debug( "Reusing cached Mallet import %s" % mallet_data_path )
+			else:
+				mallet_data_path = None
+		if mallet_data_path is None:
+			corpus_path = self.__write_documents( X, dir_tmp )
+			mallet_data_path = self.__import_data( corpus_path, dir_tmp )
+			if not os.path.exists( mallet_data_path ):
+				raise Exception("Error: Failed to import data into Mallet format")
+			if use_cache:
+				mallet_data_path = self.cache.store( X.rows, "mallet", mallet_data_path )
 		# run Mallet
 		mallet_terms_path, mallet_docs_path, mallet_weights_path = self.__run_mallet( k, mallet_data_path, dir_tmp )
 		if not ( os.path.exists( mallet_terms_path ) and os.path.exists( mallet_docs_path ) and os.path.exists( mallet_weights_path ) ):
@@ -76,14 +90,15 @@ class MalletLDA:
 		log.debug( "Writing temporary files to %s" % dir_tmp )
 		# Write documents, one per line
 		corpus_path = os.path.join( dir_tmp, "corpus.txt" )
+		if not isinstance( X, unsupervised.sampling.RowSubset ):
+			X = unsupervised.sampling.RowSubset( X )
 		f = open( corpus_path, "w")
-		for row in range( X.shape[0] ):
-			v = X.getrow( row )
+		for (indices, data) in X.iterrows():
 			doc_tokens = []
-			for pos in range(v.nnz):
+			for pos in range(len(indices)):
 				# just in case the data has been normalized...
-				freq = max( 1, int(v.data[pos]) )
-				token = "%d" % v.indices[pos]
+				freq = max( 1, int(data[pos]) )
+				token = "%d" % indices[pos]
 				for i in range(freq):
 					doc_tokens.append( token )
 			f.write( " ".join( doc_tokens ) )
@@ -199,6 +214,7 @@ class MalletLDA:
 				term_index = int(parts[1])		
 				W[term_index,topic_index] = float(parts[2])
 		# Calculate geometric means
+		from scipy.stats.mstats import gmean
 		gmeans = gmean( W, axis = 1 )
 		# Reweight the terms
 		# TODO: vectorize this
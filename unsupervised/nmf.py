@@ -1,4 +1,5 @@
 import numpy as np
+import unsupervised.sampling
 
 import warnings
 warnings.simplefilter("ignore", DeprecationWarning)
@@ -22,6 +23,8 @@ class SklNMF:
 		from sklearn import decomposition
 		self.W = None
 		self.H = None
+		# NB: the scikit-learn solver needs a concrete matrix
+		X = unsupervised.sampling.as_matrix( X )
 		model = decomposition.NMF(init=self.init_strategy, n_components=k, max_iter=self.max_iters)
 		self.W = model.fit_transform(X)
 		self.H = model.components_			
@@ -63,6 +66,8 @@ class NimfaNMF:
 		import nimfa
 		self.W = None
 		self.H = None
+		# NB: the Nimfa solver needs a concrete matrix
+		X = unsupervised.sampling.as_matrix( X )
 		initialize_only = self.max_iters < 1
 		if self.update == "euclidean":
 			objective = "fro"
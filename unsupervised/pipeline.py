@@ -0,0 +1,339 @@
+import hashlib, json, os, os.path, random, traceback
+import logging as log
+from multiprocessing import Pool
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+import numpy as np
+import text.util, unsupervised.rankings, unsupervised.sampling, unsupervised.util
+
+# --------------------------------------------------------------
+# Stage Graph
+# --------------------------------------------------------------
+
+class Stage:
+	"""
+	A single step of a pipeline. The function is called with the dictionary of parameters, which must
+	be JSON serializable, and is expected to write the specified output files.
+	"""
+	def __init__( self, name, func, params, depends = None, outputs = None ):
+		self.name = name
+		self.func = func
+		self.params = params
+		self.depends = depends or []
+		self.outputs = outputs or []
+
+	def key( self, dependency_keys ):
+		"""
+		Return a hash of the function, its parameters and the keys of the stages on which it depends.
+		"""
+		spec = { "func" : self.func.__name__, "params" : self.params, "depends" : dependency_keys }
+		return hashlib.sha1( json.dumps( spec, sort_keys = True ).encode( "utf8" ) ).hexdigest()
+
+class Pipeline:
+	"""
+	Dependency graph of pipeline stages. The keys of completed stages are stored in a JSON state file,
+	so that a stage is only rerun if its parameters or those of any stage before it have changed, or
+	if any of its outputs are missing. Stages must be added after the stages on which they depend.
+	"""
+	def __init__( self, state_path ):
+		self.state_path = state_path
+		self.stages = {}
+		self.order = []
+		self.state = {}
+		if os.path.exists( state_path ):
+			with open( state_path, "r" ) as fin:
+				self.state = json.load( fin )
+
+	def __len__( self ):
+		return len(self.order)
+
+	def add( self, name, func, params, depends = None, outputs = None ):
+		if name in self.stages:
+			raise ValueError( "Duplicate pipeline stage %s" % name )
+		for dependency in depends or []:
+			if not dependency in self.stages:
+				raise ValueError( "Pipeline stage %s depends on unknown stage %s" % ( name, dependency ) )
+		self.stages[name] = Stage( name, func, params, depends, outputs )
+		self.order.append( name )
+		return self.stages[name]
+
+	def keys( self ):
+		keys = {}
+		for name in self.order:
+			stage = self.stages[name]
+			keys[name] = stage.key( [keys[dependency] for dependency in stage.depends] )
+		return keys
+
+	def stale( self, force = False ):
+		"""
+		Return the names of the stages which need to be run, in the order they were added.
+		"""
+		if force:
+			return list( self.order )
+		keys = self.keys()
+		stale = []
+		for name in self.order:
+			if self.state.get( name, None ) != keys[name] or not all( os.path.exists( path ) for path in self.stages[name].outputs ):
+				stale.append( name )
+		return stale
+
+	def run( self, jobs = 1, force = False, initializer = None, initargs = () ):
+		"""
+		Run all stale stages, using the specified number of worker processes. Stages whose dependencies
+		have completed are run concurrently. If a stage fails, the stages which depend on it are not run.
+		Returns the lists of completed and failed stage names.
+		"""
+		keys = self.keys()
+		pending = self.stale( force )
+		log.info( "Pipeline has %d stages, %d to run" % ( len(self.order), len(pending) ) )
+		completed, failed = [], []
+		if len(pending) == 0:
+			return ( completed, failed )
+		if jobs <= 1:
+			if not initializer is None:
+				initializer( *initargs )
+			pool = None
+		else:
+			pool = Pool( processes = jobs, initializer = initializer, initargs = initargs )
+		results = queue.Queue()
+		running = set()
+		try:
+			while len(pending) > 0 or len(running) > 0:
+				# start all stages which do not depend on a pending, running or failed stage
+				blocked = set( pending ) | running | set( failed )
+				for name in list( pending ):
+					stage = self.stages[name]
+					if any( dependency in blocked for dependency in stage.depends ):
+						if any( dependency in failed for dependency in stage.depends ):
+							log.warning( "Not running stage %s, as a stage it depends on failed" % name )
+							pending.remove( name )
+							failed.append( name )
+						continue
+					pending.remove( name )
+					log.info( "Running stage %s ..." % name )
+					if pool is None:
+						results.put( execute_stage( name, stage.func, stage.params ) )
+					else:
+						pool.apply_async( execute_stage, ( name, stage.func, stage.params ), callback = results.put )
+					running.add( name )
+				if len(running) == 0:
+					continue
+				(name, error) = results.get()
+				running.remove( name )
+				if error is None:
+					log.info( "Completed stage %s" % name )
+					completed.append( name )
+					self.state[name] = keys[name]
+					self.save()
+				else:
+					log.error( "Stage %s failed:\n%s" % ( name, error ) )
+					failed.append( name )
+					self.state.pop( name, None )
+					self.save()
+		finally:
+			if not pool is None:
+				pool.close()
+				pool.join()
+		return ( completed, failed )
+
+	def save( self ):
+		tmp_path = "%s.tmp%d" % ( self.state_path, os.getpid() )
+		with open( tmp_path, "w" ) as fout:
+			json.dump( self.state, fout, indent = 1, sort_keys = True )
+		os.rename( tmp_path, self.state_path )
+
+def execute_stage( name, func, params ):
+	"""
+	Run a single stage, returning its name and the formatted traceback of any error.
+	"""
+	try:
+		func( params )
+		return ( name, None )
+	except Exception:
+		return ( name, traceback.format_exc() )
+
+# --------------------------------------------------------------
+# Stability Analysis Stages
+# --------------------------------------------------------------
+
+# default maximum iterations for each algorithm, for reference and subsampled runs
+REFERENCE_MAXITERS = { "nmf" : 200, "lda" : 200, "skm" : 100 }
+RUN_MAXITERS = { "nmf" : 10, "lda" : 500, "skm" : 100 }
+
+# corpus shared by all stages run in a process
+worker_state = {}
+
+def set_maxiters( options, algorithms ):
+	"""
+	Replace the iteration options with dictionaries giving the maximum iterations for each algorithm, using
+	the default for the algorithm unless a value was specified.
+	"""
+	options.maxiter = dict( ( algorithm, options.maxiter or RUN_MAXITERS[algorithm] ) for algorithm in algorithms )
+	options.reference_maxiter = dict( ( algorithm, options.reference_maxiter or REFERENCE_MAXITERS[algorithm] ) for algorithm in algorithms )
+
+def init_worker( corpus_path ):
+	"""
+	Load the corpus used by all stages, unless the process already has it (e.g. inherited when forked).
+	"""
+	if worker_state.get( "corpus_path", None ) != corpus_path:
+		log.info( "Loading corpus from %s ..." % corpus_path )
+		worker_state["corpus"] = text.util.load_corpus( corpus_path )
+		worker_state["corpus_path"] = corpus_path
+		worker_state["vocabulary"] = unsupervised.rankings.Vocabulary( worker_state["corpus"][1] )
+	return worker_state["corpus"]
+
+def create_algorithm( params, n_terms, reference = False ):
+	"""
+	Create the implementation of a topic modeling algorithm used by the reference or generate tools.
+	"""
+	algorithm = params["algorithm"]
+	if algorithm == "nmf":
+		import unsupervised.nmf
+		if reference:
+			return unsupervised.nmf.SklNMF( max_iters = params["maxiter"], init_strategy = "nndsvd" )
+		return unsupervised.nmf.NimfaNMF( max_iters = params["maxiter"], init_strategy = "random", update = "euclidean" )
+	if algorithm == "skm":
+		from unsupervised.skm import SphericalKMeans, SpectralSphericalKMeans
+		if reference:
+			return SpectralSphericalKMeans( max_iters = params["maxiter"] )
+		return SphericalKMeans( max_iters = params["maxiter"] )
+	if algorithm == "lda":
+		import unsupervised.lda
+		top = min( 200 if reference else 100, n_terms )
+		return unsupervised.lda.MalletLDA( params["mallet_path"], top = top, max_iters = params["maxiter"], rerank_terms = params["rerank_terms"] )
+	raise ValueError( "Unknown algorithm %s" % algorithm )
+
+def rank_topic_terms( impl, k ):
+	return [impl.rank_terms( topic_index ) for topic_index in range(k)]
+
+def reference_stage( params ):
+	"""
+	Apply an algorithm to the complete corpus for a single value of k, as done by the reference tools.
+	"""
+	(X,terms,doc_ids,classes) = worker_state["corpus"]
+	k = params["k"]
+	np.random.seed( params["seed"] )
+	random.seed( params["seed"] )
+	impl = create_algorithm( params, len(terms), reference = True )
+	impl.seed = params["seed"]
+	impl.apply( X, k )
+	if not os.path.exists( params["dir_out"] ):
+		os.makedirs( params["dir_out"] )
+	unsupervised.util.save_term_rankings( os.path.join( params["dir_out"], "ranks_reference.pkl" ), rank_topic_terms( impl, k ), vocabulary = worker_state["vocabulary"] )
+	partitions_out_prefix = os.path.join( params["dir_out"], "partitions_reference" )
+	unsupervised.util.save_partition_batch( partitions_out_prefix, [impl.generate_partition()], [np.arange( X.shape[0] )], k, X.shape[0] )
+
+def generate_stage( params ):
+	"""
+	Apply an algorithm to the subsamples of the corpus for all runs with a single value of k, as done by
+	the generate tools. Runs already recorded in the run manifest of the output directory are skipped.
+	"""
+	(X,terms,doc_ids,classes) = worker_state["corpus"]
+	k, seed, runs = params["k"], params["seed"], params["runs"]
+	manifest = unsupervised.sampling.load_sample_manifest( params["manifest_path"] )
+	n_documents = X.shape[0]
+	n_sample = manifest.rows.shape[1]
+	impl = create_algorithm( params, len(terms) )
+	settings = "%s maxiters=%d corpus=%s" % ( impl.__class__.__name__, params["maxiter"], params["corpus"] )
+	dir_out_k = params["dir_out"]
+	if not os.path.exists( dir_out_k ):
+		os.makedirs( dir_out_k )
+	partitions = unsupervised.util.create_partition_batch( os.path.join( dir_out_k, "partitions_%s" % seed ), runs, n_sample, k, n_documents, resume = True )
+	run_manifest = unsupervised.util.load_run_manifest( dir_out_k, seed )
+	for r in range(runs):
+		sample_indices = manifest.get( seed, k, r+1 )
+		ranks_out_path = os.path.join( dir_out_k, "ranks_%s_%03d.pkl" % ( seed, r+1 ) )
+		run_settings = "%s sample=%s" % ( settings, unsupervised.sampling.sample_digest( sample_indices ) )
+		if run_manifest.is_complete( seed, k, r+1, run_settings, [ranks_out_path], { "partition" : partitions.get( r )[0] } ):
+			continue
+		np.random.seed( seed + r )
+		random.seed( seed + r )
+		impl.seed = seed + r
+		impl.apply( unsupervised.sampling.RowSubset( X, sample_indices ), k )
+		unsupervised.util.save_term_rankings( ranks_out_path, rank_topic_terms( impl, k ), vocabulary = worker_state["vocabulary"] )
+		partitions.set( r, impl.generate_partition(), sample_indices )
+		partitions.flush()
+		run_manifest.add( seed, k, r+1, run_settings, [ranks_out_path], { "partition" : partitions.get( r )[0] } )
+
+def stability_stage( params ):
+	"""
+	Calculate the stability of the runs for a single value of k against the reference rankings, as done
+	by the topic-stability tool, and write the scores for each number of top terms as JSON.
+	"""
+	max_top = unsupervised.rankings.truncation_depth( params["top"] )
+	vocabulary = worker_state.get( "vocabulary", None ) or unsupervised.rankings.Vocabulary()
+	(reference_rankings, labels) = unsupervised.util.load_term_ids( params["reference_path"], vocabulary )
+	reference_rankings = unsupervised.rankings.truncate_term_rankings( reference_rankings, max_top )
+	matcher = unsupervised.rankings.RankingSetAgreement( unsupervised.rankings.AverageJaccard() )
+	scores = dict( ( str(top), [] ) for top in params["top"] )
+	for rank_path in params["rank_paths"]:
+		(term_rankings, labels) = unsupervised.util.load_term_ids( rank_path, vocabulary )
+		term_rankings = unsupervised.rankings.truncate_term_rankings( term_rankings, max_top )
+		run_scores = matcher.similarities( reference_rankings, term_rankings, params["top"] )
+		for top in params["top"]:
+			scores[str(top)].append( run_scores[top] )
+	tmp_path = "%s.tmp%d" % ( params["out_path"], os.getpid() )
+	with open( tmp_path, "w" ) as fout:
+		json.dump( { "k" : params["k"], "runs" : len(params["rank_paths"]), "scores" : scores }, fout, indent = 1, sort_keys = True )
+	os.rename( tmp_path, params["out_path"] )
+
+def load_stability( in_path ):
+	"""
+	Load the stability scores written by a stability stage.
+	"""
+	with open( in_path, "r" ) as fin:
+		return json.load( fin )
+
+def same_samples( manifest_path, manifest ):
+	"""
+	Check whether a saved sample manifest contains exactly the same subsamples as the specified manifest.
+	"""
+	if not os.path.exists( manifest_path ):
+		return False
+	saved = unsupervised.sampling.load_sample_manifest( manifest_path, mmap = False )
+	return saved.n_documents == manifest.n_documents and np.array_equal( saved.keys, manifest.keys ) and np.array_equal( saved.rows, manifest.rows )
+
+def add_stability_stages( pipeline, corpus, dir_out_base, algorithm, k, runs, manifest, manifest_path, options ):
+	"""
+	Add the reference, generate and stability stages for a single algorithm and value of k to a pipeline,
+	using the first runs subsamples for k in the manifest. Returns the path of the stability results.
+	"""
+	params = { "algorithm" : algorithm, "corpus" : corpus, "seed" : options.seed, "k" : k }
+	if algorithm == "lda":
+		params.update( { "mallet_path" : options.mallet_path, "rerank_terms" : bool(options.rerank_terms) } )
+	dir_reference = os.path.join( dir_out_base, "reference-%s" % algorithm, "%s_k%02d" % ( algorithm, k ) )
+	dir_topic = os.path.join( dir_out_base, "topic-%s" % algorithm, "%s_k%02d" % ( algorithm, k ) )
+	reference_path = os.path.join( dir_reference, "ranks_reference.pkl" )
+	reference_name = "reference-%s:k=%d" % ( algorithm, k )
+	pipeline.add( reference_name, reference_stage, dict( params, maxiter = options.reference_maxiter.get( algorithm ), dir_out = dir_reference ), outputs = [reference_path] )
+	rank_paths = [os.path.join( dir_topic, "ranks_%s_%03d.pkl" % ( options.seed, r+1 ) ) for r in range( runs )]
+	samples = [unsupervised.sampling.sample_digest( manifest.get( options.seed, k, r+1 ) ) for r in range( runs )]
+	generate_name = "generate-%s:k=%d" % ( algorithm, k )
+	pipeline.add( generate_name, generate_stage, dict( params, maxiter = options.maxiter.get( algorithm ), runs = runs, samples = samples, manifest_path = manifest_path, dir_out = dir_topic ), outputs = rank_paths )
+	out_path = os.path.join( dir_topic, "stability_%s.json" % options.seed )
+	params = { "k" : k, "top" : options.top, "reference_path" : reference_path, "rank_paths" : rank_paths, "out_path" : out_path }
+	pipeline.add( "stability-%s:k=%d" % ( algorithm, k ), stability_stage, params, depends = [reference_name, generate_name], outputs = [out_path] )
+	return out_path
+
+def build_stability_pipeline( corpus_path, n_documents, dir_out_base, algorithms, kmin, kmax, options ):
+	"""
+	Build the pipeline of reference, generate and stability stages for each algorithm and value of k.
+	The subsamples for all runs are generated once and shared by all algorithms, and each generate stage
+	is keyed by the digests of its own subsamples. Returns the pipeline and the paths of the stability
+	results for each algorithm and value of k.
+	"""
+	if not os.path.exists( dir_out_base ):
+		os.makedirs( dir_out_base )
+	corpus = unsupervised.util.corpus_fingerprint( corpus_path )
+	manifest_path = os.path.join( dir_out_base, "samples" )
+	manifest = unsupervised.sampling.generate_sample_manifest( n_documents, options.sample_ratio, options.seed, kmin, kmax, options.runs )
+	if not same_samples( manifest_path, manifest ):
+		unsupervised.sampling.save_sample_manifest( manifest_path, manifest )
+	pipeline = Pipeline( os.path.join( dir_out_base, "pipeline.json" ) )
+	results = {}
+	for algorithm in algorithms:
+		for k in range( kmin, kmax+1 ):
+			results[(algorithm, k)] = add_stability_stages( pipeline, corpus, dir_out_base, algorithm, k, options.runs, manifest, manifest_path, options )
+	return ( pipeline, results )
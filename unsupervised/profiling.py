@@ -0,0 +1,212 @@
+import json, os, sys, time, timeit
+import logging as log
+from contextlib import contextmanager
+from functools import wraps
+
+# --------------------------------------------------------------
+# Stage Timing
+# --------------------------------------------------------------
+
+def cpu_time():
+	if hasattr( time, "process_time" ):
+		return time.process_time()
+	return time.clock()
+
+def peak_rss():
+	"""
+	Return the peak resident set size of the current process in MB since it started, or None if not
+	available.
+	"""
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+	# reported in bytes on OS X, and in KB elsewhere
+	if sys.platform == "darwin":
+		return peak / 1048576.0
+	return peak / 1024.0
+
+def current_rss():
+	"""
+	Return the current resident set size of the process in MB, or None if not available (e.g. on
+	platforms without /proc).
+	"""
+	try:
+		with open( "/proc/self/statm", "r" ) as fin:
+			pages = int( fin.read().split()[1] )
+		return pages * os.sysconf( "SC_PAGE_SIZE" ) / 1048576.0
+	except Exception:
+		return None
+
+class StageRecorder:
+	"""
+	Records the wall clock time, CPU time and number of calls for named stages of a script, together with
+	the memory used by each stage: the current RSS at the start and end of the stage, and the growth of
+	the peak RSS of the process during the stage. As the peak RSS is a high-water mark for the process,
+	a stage which uses less memory than an earlier stage shows no growth.
+	Each stage can be qualified by context values, such as the number of topics k and the run number,
+	which are inherited by any nested stages. If an output stream is set, every completed stage is
+	written to it as a JSON line.
+	"""
+	def __init__( self ):
+		self.out = None
+		self.script = os.path.basename( sys.argv[0] ) if len(sys.argv) > 0 else None
+		self.totals = {}
+		self.context = {}
+		self.profile_context = None
+		self.profile_path = None
+
+	def configure( self, out_path = None, profile_context = None, profile_path = None ):
+		"""
+		Set the path of the JSON lines output, and optionally the context of a single stage to profile
+		with cProfile, whose statistics are dumped to the specified path.
+		"""
+		if not out_path is None:
+			self.out = open( out_path, "a" )
+		self.profile_context = profile_context
+		self.profile_path = profile_path
+
+	@contextmanager
+	def stage( self, name, **context ):
+		outer_context = self.context
+		self.context = dict( outer_context )
+		self.context.update( context )
+		stage_context = self.context
+		profiler = self.__start_profiler( stage_context )
+		memory = ( current_rss(), peak_rss() )
+		start_wall, start_cpu = timeit.default_timer(), cpu_time()
+		try:
+			yield
+		finally:
+			wall, cpu = timeit.default_timer() - start_wall, cpu_time() - start_cpu
+			if not profiler is None:
+				profiler.disable()
+				profiler.dump_stats( self.profile_path )
+				self.profile_context = None
+			self.context = outer_context
+			self.record( name, wall, cpu, stage_context, memory )
+
+	def record( self, name, wall, cpu, context = None, memory = None ):
+		"""
+		Add a completed stage to the totals, and write it to the output. The memory is a tuple of the
+		current and peak RSS at the start of the stage, if known.
+		"""
+		totals = self.totals.setdefault( name, { "wall" : 0.0, "cpu" : 0.0, "calls" : 0 } )
+		totals["wall"] += wall
+		totals["cpu"] += cpu
+		totals["calls"] += 1
+		if not self.out is None:
+			event = { "event" : "stage", "stage" : name, "wall" : wall, "cpu" : cpu, "calls" : totals["calls"], "script" : self.script }
+			event.update( self.__memory_usage( memory or ( None, None ) ) )
+			event.update( context or {} )
+			self.write( event )
+
+	def write( self, event ):
+		self.out.write( json.dumps( event, sort_keys = True ) )
+		self.out.write( "\n" )
+		self.out.flush()
+
+	def summary( self ):
+		"""
+		Return a list of the total times and calls for each stage, in descending order of wall clock time.
+		"""
+		rows = []
+		for name in self.totals:
+			row = { "stage" : name }
+			row.update( self.totals[name] )
+			rows.append( row )
+		return sorted( rows, key = lambda row : -row["wall"] )
+
+	def finish( self ):
+		"""
+		Write the totals for all stages to the output, if any.
+		"""
+		if self.out is None:
+			return
+		for row in self.summary():
+			event = { "event" : "summary", "process_rss_peak" : peak_rss(), "script" : self.script }
+			event.update( row )
+			self.write( event )
+		self.out.close()
+		self.out = None
+
+	def __memory_usage( self, memory ):
+		( start_rss, start_peak ) = memory
+		end_rss, end_peak = current_rss(), peak_rss()
+		usage = { "rss_start" : start_rss, "rss_end" : end_rss, "process_rss_peak" : end_peak, "rss_peak_growth" : None }
+		if not ( start_peak is None or end_peak is None ):
+			usage["rss_peak_growth"] = end_peak - start_peak
+		return usage
+
+	def __start_profiler( self, context ):
+		if self.profile_context is None or self.profile_path is None:
+			return None
+		for key in self.profile_context:
+			if context.get( key, None ) != self.profile_context[key]:
+				return None
+		import cProfile
+		profiler = cProfile.Profile()
+		profiler.enable()
+		# only the outermost matching stage is profiled
+		self.profile_context = None
+		return profiler
+
+# shared recorder used by all scripts
+recorder = StageRecorder()
+
+def stage( name, **context ):
+	"""
+	Context manager which records a named stage with the shared recorder.
+	"""
+	return recorder.stage( name, **context )
+
+def timed( name = None ):
+	"""
+	Decorator which records every call of a function as a stage with the shared recorder.
+	"""
+	def decorator( func ):
+		stage_name = name or func.__name__
+		@wraps( func )
+		def wrapper( *args, **kwargs ):
+			with recorder.stage( stage_name ):
+				return func( *args, **kwargs )
+		return wrapper
+	return decorator
+
+def parse_profile_context( spec ):
+	"""
+	Parse a specification of the stage context to profile, in the format key=value,key=value.
+	Integer values are converted to integers.
+	"""
+	context = {}
+	for part in spec.split( "," ):
+		key, value = part.split( "=", 1 )
+		key, value = key.strip(), value.strip()
+		context[key] = int(value) if value.lstrip( "-" ).isdigit() else value
+	return context
+
+def add_options( parser ):
+	"""
+	Add the standard instrumentation options to a script's option parser.
+	"""
+	parser.add_option("--timings", action="store", type="string", dest="timings_path", help="append stage timings to this file as JSON lines", default=None)
+	parser.add_option("--profile", action="store", type="string", dest="profile_spec", help="profile the stage matching a context such as k=5,run=3 with cProfile", default=None)
+	parser.add_option("--profile-out", action="store", type="string", dest="profile_path", help="output path for the cProfile statistics (default is profile.prof)", default="profile.prof")
+
+def configure( options ):
+	"""
+	Configure the shared recorder from the standard instrumentation options.
+	"""
+	profile_context = None
+	if not options.profile_spec is None:
+		profile_context = parse_profile_context( options.profile_spec )
+	recorder.configure( options.timings_path, profile_context, options.profile_path )
+
+def finish():
+	"""
+	Log the totals for all stages of the script, and close the shared recorder's output.
+	"""
+	for row in recorder.summary():
+		log.debug( "Stage %s: wall=%.2fs cpu=%.2fs calls=%d" % ( row["stage"], row["wall"], row["cpu"], row["calls"] ) )
+	recorder.finish()
@@ -1,7 +1,6 @@
-import math, string
+import math, string, threading
 import numpy as np
-from prettytable import PrettyTable
-import unsupervised.hungarian
+import unsupervised.profiling
 
 # --------------------------------------------------------------
 # Ranking Similarity 
@@ -22,6 +21,21 @@ class JaccardBinary:
 			return 0.0
 		return float(numer)/denom
 
+	def similarity_matrices( self, rankings1, rankings2, top_values ):
+		"""
+		Calculate the similarity matrices between all pairs of rankings in two ranking sets, for each 
+		of the specified numbers of top terms, from a single computation of the prefix overlaps.
+		"""
+		return similarity_matrices( self, rankings1, rankings2, top_values )
+
+	def prefix_similarities( self, overlaps ):
+		"""
+		Convert an array of prefix overlap counts, where the last axis is the depth, into similarities 
+		between the prefixes at every depth.
+		"""
+		depths = np.arange( 1, overlaps.shape[-1] + 1 )
+		return overlaps / ( 2.0 * depths - overlaps )
+
 	def __str__( self ):
 		return "%s" % ( self.__class__.__name__ )
 
@@ -37,6 +51,11 @@ class AverageJaccard(JaccardBinary):
 			total += JaccardBinary.similarity( self, gold_ranking[0:i], test_ranking[0:i] )
 		return total/k
 
+	def prefix_similarities( self, overlaps ):
+		# the average of the Jaccard scores at all depths up to the current depth
+		depths = np.arange( 1, overlaps.shape[-1] + 1 )
+		return np.cumsum( JaccardBinary.prefix_similarities( self, overlaps ), axis = -1 ) / depths
+
 # --------------------------------------------------------------
 # Ranking Set Agreement
 # --------------------------------------------------------------
@@ -44,10 +63,15 @@ class AverageJaccard(JaccardBinary):
 class RankingSetAgreement:
 	"""
 	Calculates the agreement between pairs of ranking sets, using a specified measure of 
-	similarity between rankings.
+	similarity between rankings. In approximate mode, rankings are matched greedily, and the exact
+	Hungarian matching is only used when the upper bound on the exact score exceeds the greedy score
+	by more than the specified tolerance (if any).
 	"""
-	def __init__( self, metric = AverageJaccard() ):
+	def __init__( self, metric = AverageJaccard(), sparse_min_topics = 100, approximate = False, tolerance = None ):
 		self.metric = metric
+		self.sparse_min_topics = sparse_min_topics
+		self.approximate = approximate
+		self.tolerance = tolerance
 
 	def similarity( self, rankings1, rankings2 ):
 		"""
@@ -56,39 +80,666 @@ class RankingSetAgreement:
 		"""
 		self.results = None
 		self.S = self.build_matrix( rankings1, rankings2 )
-		score, self.results = self.hungarian_matching()
+		score, self.results, self.bound = self.match( self.S )
 		return score
 
+	def similarities( self, rankings1, rankings2, top_values ):
+		"""
+		Calculate the overall agreement between two ranking sets for each of the specified numbers 
+		of top terms. The similarity matrices for all top values are built together, so that only 
+		the matching step is repeated for each value. Returns a dictionary of scores indexed by top value.
+		"""
+		self.all_S = self.build_matrices( rankings1, rankings2, top_values )
+		self.all_results = {}
+		self.all_bounds = {}
+		scores = {}
+		for top in top_values:
+			scores[top], self.all_results[top], self.all_bounds[top] = self.match( self.all_S[top] )
+		return scores
+
 	def build_matrix( self, rankings1, rankings2 ):
 		"""
 		Construct the similarity matrix between the pairs of rankings in two 
 		different ranking sets.
 		"""
-		rows = len(rankings1)
-		cols = len(rankings2)
-		S = np.zeros( (rows,cols) )
-		for row in range(rows):
-			for col in range(cols):
-				S[row,col] = self.metric.similarity( rankings1[row], rankings2[col] )
-		return S	
+		return self.build_matrices( rankings1, rankings2, [-1] )[-1]
 
-	def hungarian_matching( self ):
+	def build_matrices( self, rankings1, rankings2, top_values ):
+		"""
+		Construct the similarity matrices between the pairs of rankings in two different ranking 
+		sets, for each of the specified numbers of top terms.
+		"""
+		# for large numbers of topics, only compare pairs of rankings which share terms
+		if self.use_sparse( rankings1, rankings2 ):
+			return sparse_similarity_matrices( self.metric, rankings1, rankings2, top_values )
+		if hasattr( self.metric, "similarity_matrices" ):
+			return self.metric.similarity_matrices( rankings1, rankings2, top_values )
+		all_S = {}
+		for top in top_values:
+			all_S[top] = pairwise_similarity_matrix( self.metric, truncate_term_rankings( rankings1, top ), truncate_term_rankings( rankings2, top ) )
+		return all_S
+
+	@unsupervised.profiling.timed( "hungarian_matching" )
+	def hungarian_matching( self, S = None ):
 		"""
 		Solve the Hungarian matching problem to find the best matches between columns and rows based on
-		values in the specified similarity matrix.
+		values in the specified similarity matrix, which defaults to the last matrix built.
 		"""
+		from scipy import sparse as sp
+		import unsupervised.hungarian
+		if S is None:
+			S = self.S
+		if sp.issparse( S ):
+			return sparse_hungarian_matching( S )
 		# apply hungarian matching
 		h = unsupervised.hungarian.Hungarian()
-		C = h.make_cost_matrix(self.S)
+		C = h.make_cost_matrix(S)
 		h.calculate(C)
 		results = h.get_results()
 		# compute score based on similarities
 		score = 0.0
 		for (row,col) in results:
-			score += self.S[row,col]
+			score += S[row,col]
 		score /= len(results)
 		return (score, results)
 
+	def match( self, S ):
+		"""
+		Match the rows and columns of the similarity matrix, exactly or approximately depending on the
+		mode. Returns the score, the matched pairs, and an upper bound on the exact score.
+		"""
+		if self.approximate:
+			score, results = greedy_matching( S )
+			bound = matching_upper_bound( S, score )
+			if self.tolerance is None or bound - score <= self.tolerance:
+				return (score, results, bound)
+		score, results = self.hungarian_matching( S )
+		return (score, results, score)
+
+	def use_sparse( self, rankings1, rankings2 ):
+		"""
+		Check whether the similarity matrices between two ranking sets should be built sparsely.
+		"""
+		if self.sparse_min_topics is None or not hasattr( self.metric, "prefix_similarities" ):
+			return False
+		return max( len(rankings1), len(rankings2) ) >= self.sparse_min_topics
+
+# --------------------------------------------------------------
+# Term Vocabulary
+# --------------------------------------------------------------
+
+def terms_digest( terms ):
+	"""
+	Return a digest identifying an ordered list of terms.
+	"""
+	import hashlib
+	return hashlib.md5( "\n".join( terms ).encode( "utf8" ) ).hexdigest()
+
+class Vocabulary:
+	"""
+	Shared mapping between terms and the integer ids which represent them in rankings. A vocabulary built
+	from the terms of a corpus uses the corpus term indices as ids, so that the rankings produced by topic
+	models are stored and compared as arrays of ids, and only resolved to terms for display. Terms which
+	are not in the vocabulary are added with new ids, so that the ids of existing terms never change.
+	"""
+	# terms may be added by several threads, e.g. while files are prefetched
+	lock = threading.RLock()
+
+	def __init__( self, terms = None ):
+		self.terms = list( terms or [] )
+		self.term_ids = None
+		self.terms_digest = None
+		self.translations = {}
+		self.term_hashes = None
+
+	def __len__( self ):
+		return len(self.terms)
+
+	def digest( self ):
+		"""
+		Return the digest of the current terms, which identifies the mapping for vocabularies saved to files.
+		"""
+		if self.terms_digest is None:
+			self.terms_digest = terms_digest( self.terms )
+		return self.terms_digest
+
+	def get_id( self, term ):
+		"""
+		Return the id of a term, or None if it is not in the vocabulary.
+		"""
+		with Vocabulary.lock:
+			return self.index().get( term, None )
+
+	def index( self ):
+		# the mapping from terms to ids is only built when needed
+		if self.term_ids is None:
+			self.term_ids = dict( ( term, term_id ) for term_id, term in enumerate(self.terms) )
+		return self.term_ids
+
+	def encode( self, ranking ):
+		"""
+		Return an array of the ids of the terms in a ranking, adding any new terms to the vocabulary.
+		"""
+		ids = np.empty( len(ranking), dtype=np.int32 )
+		with Vocabulary.lock:
+			term_ids = self.index()
+			for pos, term in enumerate(ranking):
+				term_id = term_ids.get( term, None )
+				if term_id is None:
+					term_id = len(self.terms)
+					term_ids[term] = term_id
+					self.terms.append( term )
+					self.terms_digest = None
+				ids[pos] = term_id
+		return ids
+
+	def decode( self, ranking ):
+		return [self.terms[term_id] for term_id in ranking]
+
+	def decode_rankings( self, term_rankings ):
+		return [self.decode( ranking ) for ranking in term_rankings]
+
+	def translate( self, other ):
+		"""
+		Return an array which maps the ids of another vocabulary to the ids of the same terms in this
+		vocabulary, adding any new terms, or None if the vocabularies have the same terms. An empty
+		vocabulary takes the terms of the other vocabulary, so that their ids can be used directly.
+		"""
+		with Vocabulary.lock:
+			if len(self.terms) == 0:
+				self.terms, self.term_ids, self.terms_digest = list( other.terms ), None, other.digest()
+			if other.digest() == self.digest():
+				return None
+			mapping = self.translations.get( other.digest(), None )
+			if mapping is None:
+				mapping = self.encode( other.terms )
+				self.translations[other.digest()] = mapping
+			return mapping
+
+	def hashes( self ):
+		"""
+		Return the hashes of all terms as used by ranking sketches, indexed by term id.
+		"""
+		with Vocabulary.lock:
+			if self.term_hashes is None or len(self.term_hashes) < len(self.terms):
+				start = 0 if self.term_hashes is None else len(self.term_hashes)
+				added = term_hashes( self.terms[start:] )
+				self.term_hashes = added if start == 0 else np.concatenate( [self.term_hashes, added] )
+			return self.term_hashes
+
+def is_id_ranking( ranking ):
+	"""
+	Check whether a ranking is an array of integer term ids, rather than a list of terms.
+	"""
+	return isinstance( ranking, np.ndarray ) and ranking.dtype.kind in "iu"
+
+# --------------------------------------------------------------
+# Prefix Overlaps
+# --------------------------------------------------------------
+
+def encode_term_rankings( ranking_sets ):
+	"""
+	Encode one or more ranking sets as 2D arrays of integer term ids, using a shared mapping of terms 
+	to ids. All rankings are truncated to the length of the shortest ranking. Returns a list with 
+	one array per ranking set, and the number of distinct terms.
+	"""
+	depth = min( term_rankings_size( rankings ) for rankings in ranking_sets )
+	all_rankings = [ranking for rankings in ranking_sets for ranking in rankings]
+	if len(all_rankings) > 0 and all( is_id_ranking( ranking ) for ranking in all_rankings ):
+		# rankings of vocabulary ids only need their ids renumbered to a contiguous range
+		unique, inverse = np.unique( np.concatenate( [ranking[0:depth] for ranking in all_rankings] ), return_inverse = True )
+		encoded, offset = [], 0
+		for rankings in ranking_sets:
+			encoded.append( inverse[offset:offset+len(rankings)*depth].reshape( (len(rankings), depth) ).astype( np.int64 ) )
+			offset += len(rankings) * depth
+		return ( encoded, len(unique) )
+	term_ids = {}
+	encoded = []
+	for rankings in ranking_sets:
+		R = np.empty( (len(rankings), depth), dtype=np.int64 )
+		for row, ranking in enumerate(rankings):
+			for pos in range(depth):
+				R[row,pos] = term_ids.setdefault( ranking[pos], len(term_ids) )
+		encoded.append( R )
+	return ( encoded, len(term_ids) )
+
+def has_duplicate_terms( R ):
+	"""
+	Check whether any of the encoded rankings in the array contains the same term more than once.
+	"""
+	if R.shape[-1] < 2:
+		return False
+	R_sorted = np.sort( R, axis = -1 )
+	return bool( ( R_sorted[...,1:] == R_sorted[...,:-1] ).any() )
+
+def prefix_overlaps( R1, R2, n_terms ):
+	"""
+	Count the number of terms shared by the top-d prefixes of every pair of encoded rankings from
+	R1 and R2, for every depth d. Returns an array of shape (rows of R1, rows of R2, depth), where
+	the last axis corresponds to d=1,2,... Assumes that rankings contain no duplicate terms.
+	"""
+	k1, depth = R1.shape
+	k2 = R2.shape[0]
+	dtype = np.int16 if depth < np.iinfo(np.int16).max else np.int32
+	# position of each term in each ranking of R2, or depth if absent
+	P = np.empty( (k2, n_terms), dtype=dtype )
+	P.fill( depth )
+	P[np.arange(k2)[:,np.newaxis], R2] = np.arange( depth, dtype=dtype )
+	# the term at position i of R1[a] is shared from depth max(i, position in R2[b]) onwards
+	Q = np.maximum( P[:,R1].transpose( (1,0,2) ), np.arange( depth, dtype=dtype ) )
+	offsets = ( np.arange( k1 * k2 ) * (depth + 1) ).reshape( (k1, k2, 1) )
+	counts = np.bincount( ( Q + offsets ).ravel(), minlength = k1 * k2 * (depth + 1) )
+	counts = counts.reshape( (k1, k2, depth + 1) )[:,:,0:depth]
+	return np.cumsum( counts, axis = 2 )
+
+def batch_prefix_overlaps( R, n_terms, max_chunk_size = 2**25 ):
+	"""
+	Count the prefix overlaps between all pairs of rankings within each of several ranking sets, 
+	given as an array of encoded rankings of shape (sets, k, depth). Term ids only need to be unique 
+	within each set. Returns an array of shape (sets, k, k, depth). Sets are processed in chunks, 
+	to bound the size of the intermediate arrays.
+	"""
+	r, k, depth = R.shape
+	dtype = np.int16 if depth < np.iinfo(np.int16).max else np.int32
+	overlaps = np.empty( (r, k, k, depth), dtype=np.int32 )
+	chunk = max( 1, max_chunk_size // max( 1, k * max( k * depth, n_terms ) ) )
+	for start in range( 0, r, chunk ):
+		Rc = R[start:start+chunk]
+		c = Rc.shape[0]
+		P = np.empty( (c, k, n_terms), dtype=dtype )
+		P.fill( depth )
+		P[np.arange(c)[:,np.newaxis,np.newaxis], np.arange(k)[np.newaxis,:,np.newaxis], Rc] = np.arange( depth, dtype=dtype )
+		# positions of the terms of each ranking a in each ranking b of the same set, shape (c, a, b, depth)
+		Q = P[np.arange(c)[:,np.newaxis,np.newaxis,np.newaxis], np.arange(k)[np.newaxis,np.newaxis,:,np.newaxis], Rc[:,:,np.newaxis,:]]
+		Q = np.maximum( Q, np.arange( depth, dtype=dtype ) )
+		offsets = ( np.arange( c * k * k ) * (depth + 1) ).reshape( (c, k, k, 1) )
+		counts = np.bincount( ( Q + offsets ).ravel(), minlength = c * k * k * (depth + 1) )
+		counts = counts.reshape( (c, k, k, depth + 1) )[:,:,:,0:depth]
+		overlaps[start:start+c] = np.cumsum( counts, axis = 3 )
+	return overlaps
+
+def similarity_matrices( metric, rankings1, rankings2, top_values ):
+	"""
+	Calculate the similarity matrices between two ranking sets for each of the specified numbers of 
+	top terms, using the prefix overlaps where possible and pairwise comparisons otherwise. 
+	"""
+	lengths = [len(ranking) for ranking in rankings1] + [len(ranking) for ranking in rankings2]
+	min_length = min( lengths )
+	uniform = ( min_length == max( lengths ) )
+	results = {}
+	fast_tops = []
+	for top in top_values:
+		# the overlaps only give exact results if all pairs are compared at the same depth
+		if top < 1 or top > min_length:
+			if uniform:
+				fast_tops.append( top )
+				continue
+			results[top] = pairwise_similarity_matrix( metric, truncate_term_rankings( rankings1, top ), truncate_term_rankings( rankings2, top ) )
+		else:
+			fast_tops.append( top )
+	if len(fast_tops) > 0:
+		( (R1, R2), n_terms ) = encode_term_rankings( [rankings1, rankings2] )
+		# overlap counts are only valid for rankings without duplicate terms
+		if has_duplicate_terms( R1 ) or has_duplicate_terms( R2 ):
+			for top in fast_tops:
+				results[top] = pairwise_similarity_matrix( metric, truncate_term_rankings( rankings1, top ), truncate_term_rankings( rankings2, top ) )
+			return results
+		S_all = metric.prefix_similarities( prefix_overlaps( R1, R2, n_terms ) )
+		for top in fast_tops:
+			depth = min_length if ( top < 1 or top > min_length ) else top
+			results[top] = S_all[:,:,depth-1]
+	return results
+
+def pairwise_similarity_matrix( metric, rankings1, rankings2 ):
+	"""
+	Calculate the similarity matrix between two ranking sets by comparing each pair of rankings.
+	"""
+	S = np.zeros( (len(rankings1),len(rankings2)) )
+	for row in range(len(rankings1)):
+		for col in range(len(rankings2)):
+			S[row,col] = metric.similarity( rankings1[row], rankings2[col] )
+	return S
+
+# --------------------------------------------------------------
+# Sparse Similarity
+# --------------------------------------------------------------
+
+def sparse_prefix_overlaps( R1, R2, n_terms ):
+	"""
+	Count the prefix overlaps between the pairs of encoded rankings from R1 and R2 which share at least
+	one term, using an inverted index from terms to their positions in the rankings of R2. Returns the
+	row and column of each such pair, and an array of shape (pairs, depth) with their overlaps.
+	Assumes that rankings contain no duplicate terms.
+	"""
+	k1, depth = R1.shape
+	k2 = R2.shape[0]
+	# inverted index: all (term, ranking, position) entries of R2, sorted by term
+	terms2 = R2.ravel()
+	order = np.argsort( terms2, kind = "mergesort" )
+	index_terms = terms2[order]
+	index_rows, index_pos = np.divmod( order, depth )
+	# find the entries in the index for each term of R1
+	terms1 = R1.ravel()
+	start = np.searchsorted( index_terms, terms1, side = "left" )
+	end = np.searchsorted( index_terms, terms1, side = "right" )
+	n_matches = end - start
+	entries1 = np.repeat( np.arange( len(terms1) ), n_matches )
+	within = np.arange( len(entries1) ) - np.repeat( np.cumsum( n_matches ) - n_matches, n_matches )
+	entries2 = np.repeat( start, n_matches ) + within
+	rows, pos1 = np.divmod( entries1, depth )
+	cols, pos2 = index_rows[entries2], index_pos[entries2]
+	# each shared term is counted from the depth at which it appears in both rankings
+	pair_keys, pair_ids = np.unique( rows * k2 + cols, return_inverse = True )
+	counts = np.bincount( pair_ids * depth + np.maximum( pos1, pos2 ), minlength = len(pair_keys) * depth )
+	overlaps = np.cumsum( counts.reshape( (len(pair_keys), depth) ), axis = 1 )
+	return ( pair_keys // k2, pair_keys % k2, overlaps )
+
+def sparse_similarity_matrices( metric, rankings1, rankings2, top_values ):
+	"""
+	Calculate sparse similarity matrices between two ranking sets for each of the specified numbers 
+	of top terms, where only the pairs of rankings sharing terms in their top terms are compared.
+	Falls back to the dense matrices when the prefix overlaps cannot be used.
+	"""
+	from scipy import sparse as sp
+	lengths = [len(ranking) for ranking in rankings1] + [len(ranking) for ranking in rankings2]
+	min_length = min( lengths )
+	max_top = max( top_values )
+	if min_length != max( lengths ) and ( min( top_values ) < 1 or max_top > min_length ):
+		all_S = similarity_matrices( metric, rankings1, rankings2, top_values )
+		return dict( ( top, sp.csr_matrix( S ) ) for top, S in all_S.items() )
+	# only the terms up to the largest top value are needed
+	depth = min_length if ( min( top_values ) < 1 or max_top > min_length ) else max_top
+	( (R1, R2), n_terms ) = encode_term_rankings( [truncate_term_rankings( rankings1, depth ), truncate_term_rankings( rankings2, depth )] )
+	if has_duplicate_terms( R1 ) or has_duplicate_terms( R2 ):
+		all_S = similarity_matrices( metric, rankings1, rankings2, top_values )
+		return dict( ( top, sp.csr_matrix( S ) ) for top, S in all_S.items() )
+	rows, cols, overlaps = sparse_prefix_overlaps( R1, R2, n_terms )
+	S_all = metric.prefix_similarities( overlaps )
+	shape = ( len(rankings1), len(rankings2) )
+	results = {}
+	for top in top_values:
+		top_depth = depth if ( top < 1 or top > depth ) else top
+		S = sp.csr_matrix( ( S_all[:,top_depth-1], ( rows, cols ) ), shape = shape )
+		S.eliminate_zeros()
+		results[top] = S
+	return results
+
+def sparse_hungarian_matching( S ):
+	"""
+	Solve the Hungarian matching problem for a sparse similarity matrix. As rankings in different 
+	connected components of the non-zero entries have zero similarity, each component is matched 
+	separately, and the remaining rows and columns are paired arbitrarily with zero similarity.
+	"""
+	from scipy import sparse as sp
+	from scipy.sparse.csgraph import connected_components
+	S = sp.csr_matrix( S )
+	k1, k2 = S.shape
+	# components of the bipartite graph, with rows as nodes 0..k1-1 and columns as nodes k1..k1+k2-1
+	G = sp.bmat( [[None, S], [S.T, None]], format = "csr" )
+	n_components, labels = connected_components( G, directed = False )
+	results = []
+	score = 0.0
+	matched_rows, matched_cols = set(), set()
+	for component in range( n_components ):
+		nodes = np.flatnonzero( labels == component )
+		rows, cols = nodes[nodes < k1], nodes[nodes >= k1] - k1
+		if len(rows) == 0 or len(cols) == 0:
+			continue
+		block = S[rows][:,cols].toarray()
+		for (row, col) in max_similarity_assignment( block ):
+			results.append( (int(rows[row]), int(cols[col])) )
+			matched_rows.add( results[-1][0] )
+			matched_cols.add( results[-1][1] )
+			score += block[row,col]
+	free_rows = [row for row in range(k1) if not row in matched_rows]
+	free_cols = [col for col in range(k2) if not col in matched_cols]
+	results += list( zip( free_rows, free_cols ) )
+	score /= min( k1, k2 )
+	return (score, results)
+
+def max_similarity_assignment( S ):
+	"""
+	Find the pairs of rows and columns with the maximum total similarity in a dense matrix, using the
+	SciPy assignment solver if available, or the Hungarian implementation otherwise.
+	"""
+	try:
+		from scipy.optimize import linear_sum_assignment
+		return list( zip( *linear_sum_assignment( -S ) ) )
+	except ImportError:
+		pass
+	# pad to a square matrix, as the Hungarian implementation does not preserve the layout of 
+	# non-square matrices when padding them
+	size = max( S.shape )
+	P = np.zeros( (size, size) )
+	P[0:S.shape[0],0:S.shape[1]] = S
+	import unsupervised.hungarian
+	h = unsupervised.hungarian.Hungarian()
+	h.calculate( h.make_cost_matrix( P ) )
+	return [(row, col) for (row, col) in h.get_results() if row < S.shape[0] and col < S.shape[1]]
+
+# --------------------------------------------------------------
+# Approximate Matching
+# --------------------------------------------------------------
+
+def greedy_matching( S ):
+	"""
+	Match the rows and columns of a dense or sparse similarity matrix greedily, by repeatedly taking the 
+	most similar pair whose row and column are both unmatched. The score is at least half the exact score.
+	"""
+	from scipy import sparse as sp
+	k1, k2 = S.shape
+	if sp.issparse( S ):
+		S = sp.coo_matrix( S )
+		rows, cols, values = S.row, S.col, S.data
+	else:
+		S = np.asarray( S )
+		rows, cols = np.divmod( np.arange( S.size ), k2 )
+		values = S.ravel()
+	order = np.argsort( -values, kind = "mergesort" )
+	row_free, col_free = np.ones( k1, dtype=bool ), np.ones( k2, dtype=bool )
+	results = []
+	score = 0.0
+	n = min( k1, k2 )
+	for i in order:
+		if len(results) == n or values[i] <= 0:
+			break
+		row, col = rows[i], cols[i]
+		if row_free[row] and col_free[col]:
+			row_free[row], col_free[col] = False, False
+			results.append( (int(row), int(col)) )
+			score += values[i]
+	# pair any remaining rows and columns, which have zero similarity
+	results += list( zip( np.flatnonzero( row_free ).tolist(), np.flatnonzero( col_free ).tolist() ) )
+	return (score / n, results)
+
+def matching_upper_bound( S, greedy_score = None ):
+	"""
+	Return an upper bound on the exact matching score for a similarity matrix, given by the smaller of the 
+	sums of the n largest row and column maxima, where n pairs are matched, and twice the greedy 
+	matching score if specified.
+	"""
+	from scipy import sparse as sp
+	n = min( S.shape )
+	row_max = np.asarray( S.max( axis = 1 ).todense() if sp.issparse( S ) else S.max( axis = 1 ) ).ravel()
+	col_max = np.asarray( S.max( axis = 0 ).todense() if sp.issparse( S ) else S.max( axis = 0 ) ).ravel()
+	bound = min( np.sort( row_max )[::-1][0:n].sum(), np.sort( col_max )[::-1][0:n].sum() ) / n
+	if not greedy_score is None:
+		bound = min( bound, 2 * greedy_score )
+	return bound
+
+# --------------------------------------------------------------
+# Ranking Sketches
+# --------------------------------------------------------------
+
+# padding value for sketches of prefixes with fewer terms than the sketch size
+SKETCH_PAD = np.iinfo(np.uint64).max
+
+def term_hashes( terms ):
+	"""
+	Hash a list of terms to 63-bit integers, which are the same in every process.
+	"""
+	import hashlib
+	hashes = np.empty( len(terms), dtype=np.uint64 )
+	for i, term in enumerate(terms):
+		digest = hashlib.md5( term.encode( "utf8" ) if hasattr( term, "encode" ) else str(term).encode( "utf8" ) ).hexdigest()
+		hashes[i] = int( digest[0:16], 16 ) & 0x7FFFFFFFFFFFFFFF
+	return hashes
+
+def sketch_depths( depth, resolution = 2 ):
+	"""
+	Return the geometrically spaced prefix depths at which rankings of the specified depth are sketched,
+	with the specified number of depths for each doubling of the depth.
+	"""
+	steps = int( math.ceil( resolution * math.log( max( depth, 1 ), 2 ) ) )
+	depths = np.round( 2.0 ** ( np.arange( steps + 1 ) / float(resolution) ) ).astype( np.int64 )
+	return np.unique( np.append( depths[depths < depth], depth ) )
+
+def interpolation_weights( depths, top ):
+	"""
+	Return the weights for the Jaccard scores at the sketched depths which approximate the average of
+	the scores at all depths 1 to top, where scores between sketched depths are linearly interpolated.
+	"""
+	weights = np.zeros( len(depths) )
+	for d in range( 1, top + 1 ):
+		upper = min( int( np.searchsorted( depths, d ) ), len(depths) - 1 )
+		if depths[upper] == d or upper == 0:
+			weights[upper] += 1.0
+		else:
+			lower = upper - 1
+			fraction = float( d - depths[lower] ) / ( depths[upper] - depths[lower] )
+			weights[lower] += 1.0 - fraction
+			weights[upper] += fraction
+	return weights / top
+
+class RankingSketch:
+	"""
+	MinHash sketches of the prefixes of each ranking in a ranking set, at geometrically spaced depths.
+	Each sketch uses one permutation hashing: term hashes are split into m buckets, and the sketch holds
+	the minimum hash value in each bucket. The hashes array has shape (rankings, depths, m), where empty
+	buckets are padded.
+	"""
+	def __init__( self, hashes, depths ):
+		self.hashes = hashes
+		self.depths = depths
+
+	def __len__( self ):
+		return self.hashes.shape[0]
+
+	def depth( self ):
+		return int( self.depths[-1] )
+
+	def size( self ):
+		return self.hashes.shape[2]
+
+def sketch_term_rankings( term_rankings, m = 64, resolution = 2, vocabulary = None ):
+	"""
+	Build the prefix sketches for a ranking set. All rankings are truncated to the shortest ranking. If
+	a vocabulary is specified for rankings of term ids, the hashes of their terms are used, so that the
+	sketches do not depend on the ids.
+	"""
+	depth = term_rankings_size( term_rankings )
+	depths = sketch_depths( depth, resolution )
+	k = len(term_rankings)
+	if not vocabulary is None and all( is_id_ranking( ranking ) for ranking in term_rankings ):
+		hashes = vocabulary.hashes()
+		H = np.array( [hashes[ranking[0:depth]] for ranking in term_rankings], dtype=np.uint64 ).reshape( (k, depth) )
+	else:
+		terms = sorted( set( term for ranking in term_rankings for term in ranking[0:depth] ) )
+		term_map = dict( zip( terms, term_hashes( terms ) ) )
+		H = np.array( [[term_map[term] for term in ranking[0:depth]] for ranking in term_rankings], dtype=np.uint64 ).reshape( (k, depth) )
+	buckets, values = ( H % np.uint64(m) ).astype( np.int64 ), H // np.uint64(m)
+	hashes = np.empty( (k, len(depths), m), dtype=np.uint64 )
+	# each sketch extends the sketch of the previous depth with the terms between the two depths
+	current = np.empty( (k, m), dtype=np.uint64 )
+	current.fill( SKETCH_PAD )
+	rows = np.arange( k )[:,np.newaxis]
+	start = 0
+	for level, d in enumerate(depths):
+		np.minimum.at( current, ( np.repeat( rows, d - start, axis = 1 ), buckets[:,start:d] ), values[:,start:d] )
+		hashes[:,level,:] = current
+		start = d
+	return RankingSketch( hashes, depths )
+
+def sketch_jaccard( A, B ):
+	"""
+	Estimate the Jaccard similarity of all pairs of sets from their sketches A and B, which have shapes
+	(..., m) that broadcast against each other. The estimate is the fraction of buckets which are not
+	empty in both sketches in which the two minimum hash values are equal.
+	"""
+	occupied = ( A != SKETCH_PAD ) | ( B != SKETCH_PAD )
+	shared = np.sum( ( A == B ) & occupied, axis = -1 )
+	union = np.sum( occupied, axis = -1 )
+	J = np.zeros( union.shape )
+	nonzero = union > 0
+	J[nonzero] = shared[nonzero] / union[nonzero].astype( np.float64 )
+	return J
+
+class SketchAverageJaccard:
+	"""
+	Approximation of the Average Jaccard metric using MinHash sketches of ranking prefixes at
+	geometrically spaced depths, so that the cost of comparing a pair of rankings depends on the sketch
+	size and the number of depths rather than on the number of top terms. The Jaccard score at each
+	sketched depth is estimated from m hash buckets with a standard error of at most 0.5/sqrt(m) for
+	prefixes with at least m terms in their union; scores at other depths are interpolated. Ranking sets
+	can be passed as lists of rankings or as precomputed RankingSketch objects, and rankings of term ids
+	are sketched using the hashes of their terms from the specified vocabulary.
+	"""
+	def __init__( self, m = 64, resolution = 2, max_chunk_size = 2**24, vocabulary = None ):
+		self.m = m
+		self.resolution = resolution
+		self.max_chunk_size = max_chunk_size
+		self.vocabulary = vocabulary
+
+	def sketch( self, term_rankings ):
+		if isinstance( term_rankings, RankingSketch ):
+			return term_rankings
+		return sketch_term_rankings( term_rankings, self.m, self.resolution, self.vocabulary )
+
+	def standard_error( self ):
+		"""
+		Return the upper limit on the standard error of the Jaccard estimate at each sketched depth.
+		"""
+		return 0.5 / math.sqrt( self.m )
+
+	def similarity( self, gold_ranking, test_ranking ):
+		return self.similarity_matrices( [gold_ranking], [test_ranking], [-1] )[-1][0,0]
+
+	def prefix_jaccard( self, sketch1, sketch2 ):
+		"""
+		Estimate the Jaccard scores between all pairs of rankings at each sketched depth, returning an
+		array of shape (rankings1, rankings2, depths). Rows are processed in chunks, to bound memory.
+		"""
+		k1, k2, levels = len(sketch1), len(sketch2), len(sketch1.depths)
+		J = np.empty( (k1, k2, levels) )
+		chunk = max( 1, self.max_chunk_size // max( 1, k2 * levels * self.m ) )
+		for start in range( 0, k1, chunk ):
+			A = sketch1.hashes[start:start+chunk,np.newaxis,:,:]
+			J[start:start+chunk] = sketch_jaccard( A, sketch2.hashes[np.newaxis,:,:,:] )
+		return J
+
+	def similarity_matrices( self, rankings1, rankings2, top_values ):
+		"""
+		Estimate the similarity matrices between two ranking sets for each of the specified numbers of
+		top terms, from the Jaccard estimates at the sketched depths.
+		"""
+		sketch1, sketch2 = self.sketch( rankings1 ), self.sketch( rankings2 )
+		if sketch1.depth() != sketch2.depth() or sketch1.size() != sketch2.size():
+			# sketches must be built at the same depths to be compared
+			if isinstance( rankings1, RankingSketch ) or isinstance( rankings2, RankingSketch ):
+				raise ValueError( "Cannot compare sketches of different depths or sizes" )
+			depth = min( sketch1.depth(), sketch2.depth() )
+			sketch1 = self.sketch( truncate_term_rankings( rankings1, depth ) )
+			sketch2 = self.sketch( truncate_term_rankings( rankings2, depth ) )
+		J = self.prefix_jaccard( sketch1, sketch2 )
+		results = {}
+		for top in top_values:
+			depth = sketch1.depth() if ( top < 1 or top > sketch1.depth() ) else top
+			results[top] = J.dot( interpolation_weights( sketch1.depths, depth ) )
+		return results
+
+	def __str__( self ):
+		return "%s(m=%d)" % ( self.__class__.__name__, self.m )
+
 # --------------------------------------------------------------
 # Utilities
 # --------------------------------------------------------------
@@ -114,6 +765,15 @@ def term_rankings_size( term_rankings ):
 			m = min( len(ranking), m ) 
 	return m
 
+def truncation_depth( top_values ):
+	"""
+	Return the number of terms to which rankings can be truncated when scoring them for several numbers
+	of top terms, or 0 if any of the values (top < 1) requires all of the terms.
+	"""
+	if min( top_values ) < 1:
+		return 0
+	return max( top_values )
+
 def truncate_term_rankings( orig_rankings, top ):
 	"""
 	Truncate a list of multiple term rankings to the specified length.
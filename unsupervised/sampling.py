@@ -0,0 +1,244 @@
+import os, os.path, hashlib, shutil
+import numpy as np
+from scipy import sparse as sp
+import unsupervised.util
+
+# --------------------------------------------------------------
+# Row Subset Views
+# --------------------------------------------------------------
+
+# number of subset rows copied at a time when computing products
+ROW_BLOCK = 10000
+
+class RowSubset:
+	"""
+	Read-only view of a subset of the rows of a sparse document-term matrix, which avoids copying
+	the rows for every subsampled run. Rows are identified by their integer index in the full matrix.
+	"""
+	def __init__( self, X, rows = None, cache = None ):
+		if not sp.isspmatrix_csr( X ):
+			X = sp.csr_matrix( X )
+		self.X = X
+		if rows is None:
+			rows = np.arange( X.shape[0] )
+		self.rows = np.asarray( rows, dtype=np.intp )
+		self.shape = ( len(self.rows), X.shape[1] )
+		self.dtype = X.dtype
+		self.cache = cache
+		self._row_norms = None
+
+	@property
+	def nnz( self ):
+		return int( np.sum( self.X.indptr[self.rows+1] - self.X.indptr[self.rows] ) )
+
+	def row( self, i ):
+		"""
+		Return the column indices and values of the i-th row in the subset.
+		"""
+		start, end = self.X.indptr[self.rows[i]], self.X.indptr[self.rows[i]+1]
+		return ( self.X.indices[start:end], self.X.data[start:end] )
+
+	def iterrows( self ):
+		for i in range( self.shape[0] ):
+			yield self.row( i )
+
+	def __getitem__( self, positions ):
+		"""
+		Return a copy of the specified rows of the subset, as a sparse matrix. Only intended for
+		small selections, such as choosing initial centroids.
+		"""
+		return self.X[self.rows[positions]]
+
+	def materialize( self ):
+		"""
+		Return a copy of the full subset as a sparse matrix, for code that needs a concrete matrix.
+		"""
+		return self.X[self.rows,:]
+
+	def dot( self, M ):
+		"""
+		Compute the product of the subset with the dense or sparse matrix M. Only the selected rows are
+		multiplied, copying at most ROW_BLOCK rows of the corpus at a time.
+		"""
+		blocks = []
+		for start in range( 0, max( len(self.rows), 1 ), ROW_BLOCK ):
+			blocks.append( self.X[self.rows[start:start+ROW_BLOCK]].dot( M ) )
+		if sp.issparse( blocks[0] ):
+			return sp.vstack( blocks, format = "csr" )
+		return np.vstack( [np.asarray( P ) for P in blocks] )
+
+	def row_norms( self ):
+		"""
+		Return the L2 norm of each row in the subset.
+		"""
+		if self._row_norms is None:
+			if self.cache is None:
+				self._row_norms = self._compute_row_norms()
+			else:
+				self._row_norms = self.cache.array( self.rows, "norms", self._compute_row_norms )
+		return self._row_norms
+
+	def _compute_row_norms( self ):
+		row_ids = np.repeat( np.arange( self.X.shape[0] ), np.diff( self.X.indptr ) )
+		sq = np.bincount( row_ids, weights = np.square( self.X.data ), minlength = self.X.shape[0] )
+		return np.sqrt( sq[self.rows] )
+
+	def centroids( self, assignments, k ):
+		"""
+		Compute the mean of the rows assigned to each of k clusters, using a single sparse product
+		with a cluster indicator matrix. Empty clusters have an all-zero centroid.
+		"""
+		return np.asarray( unsupervised.util.build_centroids( self.X, assignments, k, self.rows ).todense() )
+
+	def cosine_distances( self, centres ):
+		"""
+		Compute the cosine distances between every row in the subset and each of the centres.
+		"""
+		centres = np.asarray( centres )
+		sims = self.dot( centres.T )
+		centre_norms = np.sqrt( np.square( centres ).sum( axis = 1 ) )
+		denom = np.outer( self.row_norms(), centre_norms )
+		denom[denom == 0] = 1.0
+		return 1.0 - sims / denom
+
+def as_matrix( X ):
+	"""
+	Return a concrete matrix for the specified data, materializing the rows if it is a subset view.
+	"""
+	if isinstance( X, RowSubset ):
+		return X.materialize()
+	return X
+
+# --------------------------------------------------------------
+# Sample Manifests
+# --------------------------------------------------------------
+
+class SampleManifest:
+	"""
+	Collection of document subsamples, where the sample for each (seed, k, run) combination is 
+	stored as an array of integer row indices into the corpus. Runs are numbered from 1.
+	"""
+	def __init__( self, n_documents, keys, rows ):
+		self.n_documents = n_documents
+		self.keys = keys
+		self.rows = rows
+		self.key_map = {}
+		for i, key in enumerate( np.asarray(keys).tolist() ):
+			self.key_map[tuple(key)] = i
+
+	def __len__( self ):
+		return len(self.key_map)
+
+	def __contains__( self, key ):
+		return tuple(key) in self.key_map
+
+	def get( self, seed, k, run ):
+		"""
+		Return the row indices of the sample for the specified seed, number of topics and run.
+		"""
+		i = self.key_map.get( (seed, k, run), None )
+		if i is None:
+			raise KeyError("No sample for seed=%s k=%d run=%d in manifest" % ( seed, k, run ) )
+		return self.rows[i]
+
+def generate_sample_manifest( n_documents, sample_ratio, seed, kmin, kmax, runs ):
+	"""
+	Generate the random subsamples used by the generators for each value of k in [kmin,kmax].
+	The random state is reset to the seed for each k, while the index order carries over.
+	"""
+	n_sample = int( sample_ratio * n_documents )
+	dtype = row_index_dtype( n_documents )
+	indices = np.arange( n_documents )
+	keys, rows = [], []
+	for k in range( kmin, kmax+1 ):
+		np.random.seed( seed )
+		for r in range( runs ):
+			np.random.shuffle( indices )
+			keys.append( (seed, k, r+1) )
+			rows.append( indices[0:n_sample].astype( dtype ) )
+	keys = np.array( keys, dtype=np.int64 ).reshape( (len(keys), 3) )
+	rows = np.array( rows, dtype=dtype ).reshape( (len(keys), n_sample) )
+	return SampleManifest( n_documents, keys, rows )
+
+def row_index_dtype( n_documents ):
+	"""
+	Return the smallest unsigned integer type that can index the specified number of rows.
+	"""
+	for dtype in [np.uint16, np.uint32]:
+		if n_documents <= np.iinfo(dtype).max:
+			return dtype
+	return np.uint64
+
+def save_sample_manifest( out_path, manifest ):
+	"""
+	Save a sample manifest as a directory of memory-mappable arrays.
+	"""
+	if not os.path.exists( out_path ):
+		os.makedirs( out_path )
+	np.save( os.path.join( out_path, "keys.npy" ), manifest.keys )
+	np.save( os.path.join( out_path, "rows.npy" ), manifest.rows )
+	np.save( os.path.join( out_path, "documents.npy" ), np.array( [manifest.n_documents], dtype=np.int64 ) )
+
+def load_sample_manifest( in_path, mmap = True ):
+	"""
+	Load a sample manifest written by save_sample_manifest().
+	"""
+	mmap_mode = "r" if mmap else None
+	keys = np.load( os.path.join( in_path, "keys.npy" ) )
+	rows = np.load( os.path.join( in_path, "rows.npy" ), mmap_mode = mmap_mode )
+	n_documents = int( np.load( os.path.join( in_path, "documents.npy" ) )[0] )
+	return SampleManifest( n_documents, keys, rows )
+
+def sample_digest( rows ):
+	"""
+	Return a short fingerprint identifying a sample by its row indices, which is used to share
+	cached artifacts between algorithms that use the same sample.
+	"""
+	return hashlib.sha1( np.ascontiguousarray( rows, dtype=np.int64 ).tobytes() ).hexdigest()[0:16]
+
+# --------------------------------------------------------------
+# Sample Cache
+# --------------------------------------------------------------
+
+class SampleCache:
+	"""
+	Directory of derived artifacts for individual samples, such as Mallet corpus imports or row
+	norms, so that they can be reused across runs of different algorithms on the same sample.
+	Artifacts are stored in a subdirectory for each corpus fingerprint, so that a cache directory
+	shared by several corpora, or by different versions of the same corpus, never returns artifacts
+	derived from another matrix.
+	"""
+	def __init__( self, cache_dir, corpus_key ):
+		self.cache_dir = os.path.join( cache_dir, hashlib.md5( corpus_key.encode( "utf8" ) ).hexdigest() )
+		if not os.path.exists( self.cache_dir ):
+			os.makedirs( self.cache_dir )
+
+	def path( self, rows, name ):
+		"""
+		Return the path of the named artifact for the sample with the specified row indices.
+		"""
+		return os.path.join( self.cache_dir, "%s.%s" % ( sample_digest( rows ), name ) )
+
+	def store( self, rows, name, src_path ):
+		"""
+		Copy a file into the cache as the named artifact for the specified sample.
+		"""
+		out_path = self.path( rows, name )
+		tmp_path = "%s.tmp%d" % ( out_path, os.getpid() )
+		shutil.copyfile( src_path, tmp_path )
+		os.rename( tmp_path, out_path )
+		return out_path
+
+	def array( self, rows, name, compute ):
+		"""
+		Return the named array artifact for the specified sample, calling the function to compute 
+		and store it if it is not already cached.
+		"""
+		out_path = self.path( rows, "%s.npy" % name )
+		if os.path.exists( out_path ):
+			return np.load( out_path )
+		values = compute()
+		tmp_path = "%s.tmp%d.npy" % ( out_path[:-4], os.getpid() )
+		np.save( tmp_path, values )
+		os.rename( tmp_path, out_path )
+		return values
@@ -0,0 +1,239 @@
+import math, os.path
+import logging as log
+import numpy as np
+import unsupervised.rankings, unsupervised.util
+
+# --------------------------------------------------------------
+# Confidence Intervals
+# --------------------------------------------------------------
+
+def confidence_interval( scores, confidence = 0.95 ):
+	"""
+	Return the mean of a list of per-run stability scores, together with the lower and upper limits of
+	its confidence interval based on the t distribution. As stability scores lie in [0,1], the interval
+	is clipped to that range, and covers the full range if there are fewer than two scores.
+	"""
+	n = len(scores)
+	if n == 0:
+		return ( 0.0, 0.0, 1.0 )
+	mean = float( np.mean( scores ) )
+	if n < 2:
+		return ( mean, 0.0, 1.0 )
+	from scipy.stats import t
+	half_width = t.ppf( 0.5 * ( 1.0 + confidence ), n - 1 ) * np.std( scores, ddof = 1 ) / math.sqrt( n )
+	return ( mean, max( 0.0, mean - half_width ), min( 1.0, mean + half_width ) )
+
+class StabilityEstimate:
+	"""
+	Running estimate of the stability for a single number of topics, from the scores of its runs.
+	"""
+	def __init__( self, k, confidence = 0.95 ):
+		self.k = k
+		self.confidence = confidence
+		self.scores = []
+
+	def __len__( self ):
+		return len(self.scores)
+
+	def __str__( self ):
+		( mean, low, high ) = self.interval()
+		return "k=%d: %.4f [%.4f,%.4f] (%d runs)" % ( self.k, mean, low, high, len(self.scores) )
+
+	def add( self, score ):
+		self.scores.append( score )
+
+	def mean( self ):
+		return self.interval()[0]
+
+	def interval( self ):
+		return confidence_interval( self.scores, self.confidence )
+
+	def width( self ):
+		( mean, low, high ) = self.interval()
+		return high - low
+
+	def overlaps( self, other ):
+		( mean, low, high ) = self.interval()
+		( other_mean, other_low, other_high ) = other.interval()
+		return low <= other_high and other_low <= high
+
+# --------------------------------------------------------------
+# Adaptive Search
+# --------------------------------------------------------------
+
+def local_maxima( estimates ):
+	"""
+	Return the values of k whose mean stability is at least that of their evaluated neighbours.
+	"""
+	ks = sorted( estimates )
+	means = [estimates[k].mean() for k in ks]
+	maxima = []
+	for i, k in enumerate(ks):
+		if ( i == 0 or means[i] >= means[i-1] ) and ( i == len(ks) - 1 or means[i] >= means[i+1] ):
+			maxima.append( k )
+	return maxima
+
+def coarse_grid( kmin, kmax, step ):
+	ks = list( range( kmin, kmax+1, max( 1, step ) ) )
+	if ks[-1] != kmax:
+		ks.append( kmax )
+	return ks
+
+class AdaptiveSearch:
+	"""
+	Model selection which evaluates only promising numbers of topics. A coarse grid of values of k is
+	first scored with a small number of runs. The search then repeatedly bisects the gaps around local
+	maxima of the stability curve whose confidence intervals overlap that of the best k, and finally adds
+	runs to the values of k whose intervals still overlap that of the best k, until they are separated or
+	the maximum number of runs is reached.
+
+	The evaluate function is called with a dictionary mapping each k to the total number of runs required,
+	and must return a dictionary mapping each k to the list of stability scores for all of its runs.
+	"""
+	def __init__( self, evaluate, kmin, kmax, step = 5, initial_runs = 5, batch_runs = 5, max_runs = 50, confidence = 0.95 ):
+		self.evaluate = evaluate
+		self.kmin = kmin
+		self.kmax = kmax
+		self.step = step
+		self.initial_runs = max( 2, initial_runs )
+		self.batch_runs = max( 1, batch_runs )
+		self.max_runs = max( self.initial_runs, max_runs )
+		self.confidence = confidence
+		self.estimates = {}
+		self.rounds = 0
+
+	def best( self ):
+		return max( sorted( self.estimates ), key = lambda k : self.estimates[k].mean() )
+
+	def total_runs( self ):
+		return sum( len(estimate) for estimate in self.estimates.values() )
+
+	def contenders( self ):
+		"""
+		Return the values of k whose confidence intervals overlap that of the best k, including the best k.
+		"""
+		best = self.estimates[self.best()]
+		return [k for k in sorted( self.estimates ) if self.estimates[k].overlaps( best )]
+
+	def refinements( self ):
+		"""
+		Return the unevaluated values of k halfway between each promising local maximum and its neighbours.
+		"""
+		ks = sorted( self.estimates )
+		contenders = set( self.contenders() )
+		candidates = set()
+		for k in local_maxima( self.estimates ):
+			if not k in contenders:
+				continue
+			i = ks.index( k )
+			for neighbour in ( ks[i-1] if i > 0 else None, ks[i+1] if i < len(ks) - 1 else None ):
+				if not neighbour is None and abs( neighbour - k ) > 1:
+					candidates.add( ( k + neighbour ) // 2 )
+		return sorted( candidates )
+
+	def update( self, requests ):
+		self.rounds += 1
+		log.info( "Search round %d: evaluating %s" % ( self.rounds, ", ".join( "k=%d (%d runs)" % ( k, requests[k] ) for k in sorted( requests ) ) ) )
+		all_scores = self.evaluate( requests )
+		for k in requests:
+			estimate = StabilityEstimate( k, self.confidence )
+			for score in all_scores[k]:
+				estimate.add( score )
+			self.estimates[k] = estimate
+			log.debug( "Estimate %s" % str(estimate) )
+
+	def run( self ):
+		"""
+		Run the search, returning the best value of k.
+		"""
+		self.update( dict( ( k, self.initial_runs ) for k in coarse_grid( self.kmin, self.kmax, self.step ) ) )
+		while True:
+			# first refine the curve around promising maxima
+			refinements = self.refinements()
+			if len(refinements) > 0:
+				self.update( dict( ( k, self.initial_runs ) for k in refinements ) )
+				continue
+			# then add runs where the best k is not yet separated from the others
+			contenders = self.contenders()
+			requests = {}
+			if len(contenders) > 1:
+				for k in contenders:
+					if len(self.estimates[k]) < self.max_runs:
+						requests[k] = min( self.max_runs, len(self.estimates[k]) + self.batch_runs )
+			if len(requests) == 0:
+				break
+			self.update( requests )
+		return self.best()
+
+# --------------------------------------------------------------
+# Sequential Stopping
+# --------------------------------------------------------------
+
+class SequentialStopping:
+	"""
+	Decides when a generator can stop adding runs for each value of k in a sweep. Each completed run is
+	scored against the reference rankings for k, and no more runs are added once the confidence interval
+	of the stability is narrower than the specified width, or once its upper limit falls below the lower
+	limit for another value of k in the sweep. At least min_runs runs are always completed. The reference
+	rankings are read as ids from the vocabulary of the rankings produced by the runs.
+	"""
+	def __init__( self, top = 20, width = 0.05, min_runs = 5, confidence = 0.95, vocabulary = None ):
+		self.top = top
+		self.width = width
+		self.min_runs = max( 2, min_runs )
+		self.confidence = confidence
+		self.vocabulary = vocabulary or unsupervised.rankings.Vocabulary()
+		self.matcher = unsupervised.rankings.RankingSetAgreement( unsupervised.rankings.AverageJaccard() )
+		self.estimates = {}
+		self.references = {}
+
+	def start( self, k, reference_path ):
+		"""
+		Start scoring the runs for k against the reference rankings at the specified path. If there are
+		no reference rankings, all runs for k are completed.
+		"""
+		self.estimates[k] = StabilityEstimate( k, self.confidence )
+		if not os.path.exists( reference_path ):
+			log.warning( "No reference rankings found at %s, all runs will be completed for k=%d" % ( reference_path, k ) )
+			self.references[k] = None
+			return False
+		(term_rankings, labels) = unsupervised.util.load_term_ids( reference_path, self.vocabulary )
+		self.references[k] = unsupervised.rankings.truncate_term_rankings( term_rankings, self.top )
+		return True
+
+	def update( self, k, term_rankings ):
+		"""
+		Score the term rankings from a completed run for k, and return True if no more runs are needed.
+		"""
+		if self.references.get( k, None ) is None:
+			return False
+		term_rankings = unsupervised.rankings.truncate_term_rankings( term_rankings, self.top )
+		self.estimates[k].add( self.matcher.similarities( self.references[k], term_rankings, [self.top] )[self.top] )
+		reason = self.stop_reason( k )
+		if reason is None:
+			return False
+		log.info( "Stopping runs for k=%d after %d runs: %s" % ( k, len(self.estimates[k]), reason ) )
+		return True
+
+	def stop_reason( self, k ):
+		estimate = self.estimates[k]
+		if len(estimate) < self.min_runs:
+			return None
+		( mean, low, high ) = estimate.interval()
+		if high - low <= self.width:
+			return "interval width %.4f <= %.4f" % ( high - low, self.width )
+		for other_k in sorted( self.estimates ):
+			other = self.estimates[other_k]
+			if other_k != k and len(other) >= self.min_runs and other.interval()[1] > high:
+				return "dominated by k=%d" % other_k
+		return None
+
+	def finish( self, k, runs ):
+		"""
+		Log the number of runs used for k and the final stability interval.
+		"""
+		estimate = self.estimates.get( k, None )
+		if estimate is None or len(estimate) == 0:
+			return
+		( mean, low, high ) = estimate.interval()
+		log.info( "k=%d: used %d/%d runs, stability=%.4f [%.4f,%.4f]" % ( k, len(estimate), runs, mean, low, high ) )
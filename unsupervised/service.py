@@ -0,0 +1,351 @@
+import json, os, os.path, re, threading
+import logging as log
+from collections import OrderedDict
+try:
+	from http.server import HTTPServer, BaseHTTPRequestHandler
+	from socketserver import ThreadingMixIn
+	from urllib.parse import urlparse, parse_qs
+except ImportError:
+	from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	from SocketServer import ThreadingMixIn
+	from urlparse import urlparse, parse_qs
+import numpy as np
+import unsupervised.rankings, unsupervised.util
+
+# --------------------------------------------------------------
+# Results Tree
+# --------------------------------------------------------------
+
+class RankingFile:
+	"""
+	Term rankings loaded from a single file, stored as a (topics x depth) array of term ids.
+	"""
+	def __init__( self, path, signature, R, labels ):
+		self.path = path
+		self.signature = signature
+		self.R = R
+		self.labels = labels
+
+	def key( self ):
+		return ( self.path, self.signature )
+
+	def depth( self ):
+		return self.R.shape[1]
+
+class ResultsTree:
+	"""
+	All term ranking files found in the directories of a results tree, loaded once into compact arrays
+	of integer term ids from a single shared vocabulary. Each directory is checked for new, modified or
+	removed ranking files whenever it is accessed, and only changed files are reloaded. Rankings are
+	truncated to the specified maximum depth.
+	"""
+	def __init__( self, root_path, max_depth = 1000 ):
+		self.root_path = os.path.abspath( root_path )
+		self.max_depth = max_depth
+		self.vocabulary = unsupervised.rankings.Vocabulary()
+		self.dirs = {}
+		# directories may be accessed by several request threads
+		self.lock = threading.RLock()
+
+	def scan( self ):
+		"""
+		Find and load all directories in the tree which contain ranking files.
+		"""
+		for dir_path, subdirs, fnames in os.walk( self.root_path ):
+			subdirs.sort()
+			if any( is_ranking_file( fname ) for fname in fnames ):
+				self.directory( os.path.relpath( dir_path, self.root_path ) )
+		return len(self.dirs)
+
+	def resolve( self, rel_path ):
+		"""
+		Return the absolute path for a path relative to the root of the tree, which must lie inside the tree.
+		"""
+		path = os.path.normpath( os.path.join( self.root_path, rel_path ) )
+		if path != self.root_path and not path.startswith( self.root_path + os.sep ):
+			raise ValueError( "Path %s is outside the results tree" % rel_path )
+		return path
+
+	def directory( self, rel_path ):
+		"""
+		Return a dictionary of the ranking files in a directory of the tree, indexed by file name,
+		reloading any files which have changed.
+		"""
+		dir_path = self.resolve( rel_path )
+		if not os.path.isdir( dir_path ):
+			raise ValueError( "No such directory %s" % rel_path )
+		# a copy is returned, so that it is not changed by other threads while it is used
+		with self.lock:
+			return dict( self.__update_directory( dir_path ) )
+
+	def __update_directory( self, dir_path ):
+		files = self.dirs.setdefault( dir_path, {} )
+		current = {}
+		for fname in sorted( os.listdir( dir_path ) ):
+			if is_ranking_file( fname ):
+				stat = os.stat( os.path.join( dir_path, fname ) )
+				current[fname] = ( stat.st_size, stat.st_mtime )
+		for fname in list( files ):
+			if not fname in current:
+				log.info( "Removed %s" % os.path.join( dir_path, fname ) )
+				del files[fname]
+		for fname in current:
+			if not fname in files or files[fname].signature != current[fname]:
+				in_path = os.path.join( dir_path, fname )
+				log.info( "Loading %s" % in_path )
+				(id_rankings, labels) = unsupervised.util.load_term_ids( in_path, self.vocabulary )
+				depth = min( unsupervised.rankings.term_rankings_size( id_rankings ), self.max_depth )
+				R = np.array( [ranking[0:depth] for ranking in id_rankings], dtype=np.int32 ).reshape( (len(id_rankings), depth) )
+				files[fname] = RankingFile( in_path, current[fname], R, labels )
+		if len(files) == 0:
+			del self.dirs[dir_path]
+		return files
+
+	def ranking_file( self, rel_path ):
+		path = self.resolve( rel_path )
+		files = self.directory( os.path.relpath( os.path.dirname( path ), self.root_path ) )
+		fname = os.path.basename( path )
+		if not fname in files:
+			raise ValueError( "No ranking file %s" % rel_path )
+		return files[fname]
+
+	def decode( self, R ):
+		return self.vocabulary.decode_rankings( R )
+
+def is_ranking_file( fname ):
+	return fname.startswith( "ranks_" ) and fname.endswith( ".pkl" )
+
+def run_number( fname ):
+	"""
+	Return the run number of a ranking file named in the format ranks_<seed>_<run>.pkl, or None.
+	"""
+	match = re.match( r"ranks_.*_(\d+)\.pkl$", fname )
+	return int( match.group(1) ) if match else None
+
+def parse_runs( spec ):
+	"""
+	Parse a specification of run numbers, in the format 1-10,15,20-25.
+	"""
+	runs = set()
+	for part in spec.split( "," ):
+		if "-" in part:
+			first, last = part.split( "-", 1 )
+			runs.update( range( int(first), int(last) + 1 ) )
+		else:
+			runs.add( int(part) )
+	return runs
+
+# --------------------------------------------------------------
+# Query Service
+# --------------------------------------------------------------
+
+class LRUCache:
+	"""
+	Dictionary which holds at most the specified number of values, discarding the least recently used.
+	"""
+	def __init__( self, capacity ):
+		self.capacity = capacity
+		self.values = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def __len__( self ):
+		return len(self.values)
+
+	def get( self, key ):
+		with self.lock:
+			if not key in self.values:
+				self.misses += 1
+				return None
+			self.hits += 1
+			value = self.values.pop( key )
+			self.values[key] = value
+			return value
+
+	def put( self, key, value ):
+		with self.lock:
+			self.values.pop( key, None )
+			self.values[key] = value
+			while len(self.values) > self.capacity:
+				self.values.popitem( last = False )
+
+class StabilityService:
+	"""
+	Answers stability, diversity, display and term position queries on a results tree. The similarity
+	matrices between pairs of ranking files are cached for each number of top terms, and are invalidated
+	when either file changes.
+	"""
+	def __init__( self, tree, cache_size = 1024 ):
+		self.tree = tree
+		self.metric = unsupervised.rankings.AverageJaccard()
+		self.matcher = unsupervised.rankings.RankingSetAgreement( self.metric )
+		self.cache = LRUCache( cache_size )
+
+	def similarity_matrices( self, file1, file2, top_values ):
+		"""
+		Return the similarity matrices between the rankings in two files for each number of top terms,
+		computing all missing matrices together in the same way as the topic-stability tool.
+		"""
+		depth = min( file1.depth(), file2.depth() )
+		results, missing = {}, []
+		for top in top_values:
+			d = depth if ( top < 1 or top > depth ) else top
+			results[top] = self.cache.get( ( file1.key(), file2.key(), d ) )
+			if results[top] is None:
+				missing.append( top )
+		if len(missing) > 0:
+			missing_depths = sorted( set( depth if ( top < 1 or top > depth ) else top for top in missing ) )
+			max_depth = missing_depths[-1]
+			all_S = unsupervised.rankings.similarity_matrices( self.metric, file1.R[:,0:max_depth], file2.R[:,0:max_depth], missing_depths )
+			for top in missing:
+				d = depth if ( top < 1 or top > depth ) else top
+				results[top] = np.array( all_S[d] )
+				self.cache.put( ( file1.key(), file2.key(), d ), results[top] )
+		return results
+
+	def reference_path( self, run_dir ):
+		"""
+		Find the reference rankings for a directory of runs, either in the directory itself or in the
+		corresponding directory of a reference-<algorithm> tree, e.g. reference-nmf/nmf_k05 for topic-nmf/nmf_k05.
+		"""
+		if os.path.exists( os.path.join( self.tree.resolve( run_dir ), "ranks_reference.pkl" ) ):
+			return os.path.join( run_dir, "ranks_reference.pkl" )
+		parts = os.path.normpath( run_dir ).split( os.sep )
+		for i, part in enumerate(parts):
+			if part.startswith( "topic-" ):
+				candidate = os.path.join( *( parts[0:i] + ["reference-" + part[len("topic-"):]] + parts[i+1:] + ["ranks_reference.pkl"] ) )
+				if os.path.exists( self.tree.resolve( candidate ) ):
+					return candidate
+		raise ValueError( "No reference rankings found for %s" % run_dir )
+
+	def stability( self, run_dir, top_values, reference = None, runs = None ):
+		reference_file = self.tree.ranking_file( reference or self.reference_path( run_dir ) )
+		files = self.tree.directory( run_dir )
+		fnames = [fname for fname in sorted( files ) if files[fname].path != reference_file.path and fname != "ranks_reference.pkl"]
+		if not runs is None:
+			fnames = [fname for fname in fnames if run_number( fname ) in runs]
+		if len(fnames) == 0:
+			raise ValueError( "No runs found in %s" % run_dir )
+		scores = dict( ( top, [] ) for top in top_values )
+		for fname in fnames:
+			all_S = self.similarity_matrices( reference_file, files[fname], top_values )
+			for top in top_values:
+				scores[top].append( self.matcher.match( all_S[top] )[0] )
+		result = { "directory" : run_dir, "reference" : os.path.relpath( reference_file.path, self.tree.root_path ), "runs" : len(fnames), "files" : fnames, "stability" : {} }
+		for top in top_values:
+			values = np.array( scores[top] )
+			result["stability"][str(top)] = { "mean" : values.mean(), "min" : values.min(), "max" : values.max(), "scores" : values.tolist() }
+		return result
+
+	def diversity( self, rank_path, top_values ):
+		ranking_file = self.tree.ranking_file( rank_path )
+		k = ranking_file.R.shape[0]
+		all_S = self.similarity_matrices( ranking_file, ranking_file, top_values )
+		upper = np.triu_indices( k, 1 )
+		result = { "path" : rank_path, "diversity" : {} }
+		for top in top_values:
+			result["diversity"][str(top)] = float( np.mean( 1.0 - all_S[top][upper] ) ) if k > 1 else 0.0
+		return result
+
+	def display( self, rank_path, top ):
+		ranking_file = self.tree.ranking_file( rank_path )
+		R = ranking_file.R if top < 1 else ranking_file.R[:,0:top]
+		return { "path" : rank_path, "labels" : list( ranking_file.labels ), "rankings" : self.tree.decode( R ) }
+
+	def positions( self, path, term ):
+		"""
+		Return the position of a term in each topic, for a single ranking file or all files in a directory.
+		Positions start at 1, and are None if the term is not in the stored prefix of the topic.
+		"""
+		if os.path.isdir( self.tree.resolve( path ) ):
+			files = self.tree.directory( path )
+			ranking_files = [( os.path.join( path, fname ), files[fname] ) for fname in sorted( files )]
+		else:
+			ranking_files = [( path, self.tree.ranking_file( path ) )]
+		term_id = self.tree.vocabulary.get_id( term )
+		result = { "term" : term, "positions" : {} }
+		for rel_path, ranking_file in ranking_files:
+			positions = []
+			for row in ranking_file.R:
+				found = np.flatnonzero( row == term_id ) if not term_id is None else []
+				positions.append( int( found[0] ) + 1 if len(found) > 0 else None )
+			result["positions"][rel_path] = positions
+		return result
+
+	def status( self ):
+		with self.tree.lock:
+			return { "root" : self.tree.root_path, "directories" : sorted( os.path.relpath( path, self.tree.root_path ) for path in self.tree.dirs ),
+				"files" : sum( len(files) for files in self.tree.dirs.values() ), "terms" : len(self.tree.vocabulary),
+				"cache" : { "size" : len(self.cache), "hits" : self.cache.hits, "misses" : self.cache.misses } }
+
+	def query( self, name, params ):
+		"""
+		Answer a named query, with a dictionary of string parameters.
+		"""
+		top_values = [int(value) for value in params.get( "top", "10" ).split( "," )]
+		if name == "stability":
+			runs = parse_runs( params["runs"] ) if "runs" in params else None
+			return self.stability( required( params, "dir" ), top_values, params.get( "reference", None ), runs )
+		if name == "diversity":
+			return self.diversity( required( params, "path" ), top_values )
+		if name == "display":
+			return self.display( required( params, "path" ), top_values[0] )
+		if name == "position":
+			return self.positions( required( params, "path" ), required( params, "term" ) )
+		if name == "status":
+			return self.status()
+		raise ValueError( "Unknown query %s" % name )
+
+def required( params, name ):
+	if not name in params:
+		raise ValueError( "Missing parameter %s" % name )
+	return params[name]
+
+# --------------------------------------------------------------
+# HTTP Server
+# --------------------------------------------------------------
+
+def create_handler( service ):
+	"""
+	Create a request handler class which answers queries such as /stability?dir=topic-nmf/nmf_k05&top=10,20
+	with the service, returning the results as JSON.
+	"""
+	class QueryHandler( BaseHTTPRequestHandler ):
+		def do_GET( self ):
+			url = urlparse( self.path )
+			params = dict( ( key, values[-1] ) for key, values in parse_qs( url.query ).items() )
+			try:
+				status, result = 200, service.query( url.path.strip( "/" ) or "status", params )
+			except ( ValueError, KeyError ) as error:
+				status, result = 400, { "error" : str(error) }
+			except Exception as error:
+				# e.g. a truncated ranking file, which should not leave the client without a response
+				log.exception( "Failed to answer query %s" % self.path )
+				status, result = 500, { "error" : "%s: %s" % ( error.__class__.__name__, str(error) ) }
+			body = json.dumps( result, sort_keys = True ).encode( "utf8" )
+			self.send_response( status )
+			self.send_header( "Content-Type", "application/json" )
+			self.send_header( "Content-Length", str(len(body)) )
+			self.end_headers()
+			self.wfile.write( body )
+
+		def log_message( self, format, *args ):
+			log.debug( format % args )
+	return QueryHandler
+
+class ThreadingServer( ThreadingMixIn, HTTPServer ):
+	"""
+	HTTP server which answers each request in a separate thread, so that a long query does not block others.
+	"""
+	daemon_threads = True
+
+def serve( service, host = "127.0.0.1", port = 8765 ):
+	server = ThreadingServer( ( host, port ), create_handler( service ) )
+	log.info( "Serving queries for %s on http://%s:%d/" % ( service.tree.root_path, host, port ) )
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
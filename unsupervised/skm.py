@@ -1,10 +1,9 @@
 import random
 import logging as log
 import numpy as np
-import sklearn.manifold
-import sklearn.metrics.pairwise
-from scipy.spatial.distance import cdist
 from scipy.sparse import issparse
+from unsupervised.sampling import RowSubset, as_matrix
+from unsupervised.util import build_centroids, rank_vector_terms
 
 # --------------------------------------------------------------
 
@@ -37,12 +36,8 @@ class SphericalKMeans:
         """
         if self.centroids is None:
             raise ValueError("No results for previous run available")
-        # ranks the topics, then reverse afterwards
-        top_indices = np.argsort( self.centroids[topic_index,:] ).tolist()[0][::-1]
-        # truncate if necessary
-        if top < 1 or top > len(top_indices):
-            return top_indices
-        return top_indices[0:top]
+        # NB: uses partial selection when only the top terms are required
+        return rank_vector_terms( self.centroids[topic_index], top ).tolist()
 
 # --------------------------------------------------------------
 
@@ -51,10 +46,12 @@ class SpectralSphericalKMeans( SphericalKMeans ):
         SphericalKMeans.__init__( self, max_iters )
 
     def apply( self, X, k = 2 ):
+        import sklearn.manifold, sklearn.metrics.pairwise
         # Build Affinity Matrix
         log.debug( "Computing similarity matrix ..." )
         # TODO: can we assume rows are unit length?
-        S = sklearn.metrics.pairwise.linear_kernel(X)
+        # the affinity matrix needs the concrete rows, so a subset view is materialized here
+        S = sklearn.metrics.pairwise.linear_kernel( as_matrix(X) )
         # set diagonal to zero
         np.fill_diagonal( S, 0 )        
         log.debug( "Constructing spectral embedding ..." )
@@ -64,12 +61,11 @@ class SpectralSphericalKMeans( SphericalKMeans ):
         init_centroid_indices = random.sample( xrange( E.shape[0] ), k )
         init_centroids = E[init_centroid_indices]        
         _, self.partition, _ = kmeans( E, init_centroids, delta=0.001, maxiter=self.max_iters, metric="cosine", verbose=0 )
-        # Create empty cluster x term matrix, and then populate it with centroids from the original space
-        self.centroids = np.matrix( np.zeros( (k, X.shape[1]) ) )
-        for jc in range(k): 
-            c = np.where( self.partition == jc )[0]
-            if len(c) > 0:
-                self.centroids[jc] = X[c].mean( axis=0 )        
+        # Build sparse cluster x term matrix of centroids from the original space
+        if isinstance(X, RowSubset):
+            self.centroids = build_centroids( X.X, self.partition, k, X.rows )
+        else:
+            self.centroids = build_centroids( X, self.partition, k )
 
 # --------------------------------------------------------------
 # Implementation of generalized k-means originally from
@@ -95,7 +91,11 @@ def kmeans( X, centres, delta=.001, maxiter=10, metric="euclidean", p=2, verbose
         distances, N
     see also: kmeanssample below, class Kmeans below.
     """
-    if not issparse(X):
+    if isinstance(X, RowSubset):
+        # row subset views support cosine distances and centre updates without copying rows
+        if metric != "cosine":
+            raise ValueError( "kmeans: row subset views only support the cosine metric" )
+    elif not issparse(X):
         X = np.asanyarray(X)  # ?
     centres = centres.todense() if issparse(centres) \
         else centres.copy()
@@ -107,7 +107,10 @@ def kmeans( X, centres, delta=.001, maxiter=10, metric="euclidean", p=2, verbose
     allx = np.arange(N)
     prevdist = 0
     for jiter in range( 1, maxiter+1 ):
-        D = cdist_sparse( X, centres, metric=metric, p=p )  # |X| x |centres|
+        if isinstance(X, RowSubset):
+            D = X.cosine_distances( centres )
+        else:
+            D = cdist_sparse( X, centres, metric=metric, p=p )  # |X| x |centres|
         xtoc = D.argmin(axis=1)  # X -> nearest centre
         distances = D[allx,xtoc]
         avdist = distances.mean()  # median ?
@@ -115,6 +118,11 @@ def kmeans( X, centres, delta=.001, maxiter=10, metric="euclidean", p=2, verbose
         or jiter == maxiter:
             break
         prevdist = avdist
+        if isinstance(X, RowSubset):
+            # all centres in one sparse product, keeping the previous centre for empty clusters
+            nonempty = np.bincount( xtoc, minlength=k ) > 0
+            centres[nonempty] = X.centroids( xtoc, k )[nonempty]
+            continue
         for jc in range(k):  # (1 pass in C)
             c = np.where( xtoc == jc )[0]
             if len(c) > 0:
@@ -126,6 +134,7 @@ def cdist_sparse( X, Y, **kwargs ):
         X or Y may be sparse -- best csr
     """
         # todense row at a time, v slow if both v sparse
+    from scipy.spatial.distance import cdist
     sxy = 2*issparse(X) + issparse(Y)
     if sxy == 0:
         return cdist( X, Y, **kwargs )
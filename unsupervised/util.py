@@ -1,24 +1,59 @@
+import os, os.path, hashlib, json
+import logging as log
 import numpy as np
-from scipy import sparse as sp
-# note that we use the scikit-learn bundled version of joblib
-from sklearn.externals import joblib
+from text.util import load_joblib
 
 # --------------------------------------------------------------
 
-def build_centroids( X, partition, k ):
+def build_centroids( X, partition, k, rows = None ):
 	"""
-	Build a set of K centroids based on the specified partition memberships.
+	Build a set of K centroids based on the specified partition memberships, with a single sparse 
+	product between a cluster indicator matrix and X. If the partition only covers a subset of the 
+	rows of X, their row indices are given by rows. Documents with a negative membership (e.g. those
+	without a class) are ignored. Returns a sparse K x m matrix, where empty clusters have all-zero
+	centroids.
 	"""
-	# NB: need to convert to a numpy array before we do this...
-	memberships = np.array(partition)
-	n_features = X.shape[1]
-	centroids = np.empty((k, n_features), dtype=np.float64)
-	for i in range(k):
-		center_mask = memberships == i
-		if sp.issparse(X):
-			center_mask = np.where(center_mask)[0]
-		centroids[i] = X[center_mask].mean(axis=0)
-	return centroids
+	from scipy import sparse as sp
+	memberships = np.asarray( partition ).ravel()
+	if rows is None:
+		rows = np.arange( len(memberships) )
+	assigned = memberships >= 0
+	if not assigned.all():
+		memberships, rows = memberships[assigned], np.asarray( rows )[assigned]
+	counts = np.bincount( memberships, minlength = k ).astype( np.float64 )
+	weights = 1.0 / np.maximum( counts, 1 )[memberships]
+	C = sp.csr_matrix( (weights, (memberships, rows)), shape = (k, X.shape[0]) )
+	return sp.csr_matrix( C.dot( X ) )
+
+def rank_centroid_terms( centroids, top = -1 ):
+	"""
+	Return the indices of the top ranked terms for each centroid, using partial selection rather than 
+	sorting all terms. For sparse centroids, only terms with non-zero weights are ranked.
+	"""
+	return [rank_vector_terms( centroids[i], top ) for i in range( centroids.shape[0] )]
+
+def rank_vector_terms( v, top = -1 ):
+	"""
+	Return the indices of the top ranked terms for a single dense or sparse weight vector. As with a 
+	reversed argsort, ties are ranked in descending order of term index.
+	"""
+	from scipy import sparse as sp
+	if sp.issparse( v ):
+		v = sp.csr_matrix( v )
+		indices, values = v.indices, v.data
+	else:
+		values = np.asarray( v ).ravel()
+		indices = np.arange( len(values) )
+	if top > 0 and top < len(values):
+		selected = np.argpartition( -values, top - 1 )[0:top]
+		# make sure we include all terms that are tied with the last selected value
+		cutoff = values[selected].min()
+		selected = np.where( values >= cutoff )[0]
+		indices, values = indices[selected], values[selected]
+	order = np.lexsort( ( -indices, -values ) )
+	if top > 0:
+		order = order[0:top]
+	return indices[order]
 
 def clustermap_to_partition( cluster_map, doc_ids ):
 	"""
@@ -38,49 +73,460 @@ def clustermap_to_partition( cluster_map, doc_ids ):
 			partition[doc_map[doc_id]] = cluster_index
 	return partition
 	
+def corpus_fingerprint( corpus_path ):
+	"""
+	Return a fingerprint of the path, size and modification time of a corpus file or binary corpus directory.
+	"""
+	paths = [corpus_path]
+	if os.path.isdir( corpus_path ):
+		paths = [os.path.join( corpus_path, fname ) for fname in sorted( os.listdir( corpus_path ) )]
+	parts = [os.path.abspath( corpus_path )]
+	for path in paths:
+		stat = os.stat( path )
+		parts.append( "%d:%d" % ( stat.st_size, int(stat.st_mtime) ) )
+	return ":".join( parts )
+
+def file_digest( in_path, block_size = 2**20 ):
+	"""
+	Return the SHA-1 hash of the contents of the specified file.
+	"""
+	h = hashlib.sha1()
+	with open( in_path, "rb" ) as fin:
+		while True:
+			block = fin.read( block_size )
+			if not block:
+				break
+			h.update( block )
+	return h.hexdigest()
+
+def array_digest( *arrays ):
+	"""
+	Return the SHA-1 hash of the contents of one or more arrays.
+	"""
+	h = hashlib.sha1()
+	for values in arrays:
+		values = np.ascontiguousarray( values )
+		h.update( str(values.dtype).encode("utf8") )
+		h.update( values.tobytes() )
+	return h.hexdigest()
+
+def atomic_dump( value, out_path ):
+	"""
+	Save a value using Joblib, writing it to a temporary file which is then renamed, so that an 
+	interrupted write never leaves a partial file at the output path.
+	"""
+	tmp_path = "%s.tmp%d" % ( out_path, os.getpid() )
+	try:
+		load_joblib().dump( value, tmp_path )
+		os.rename( tmp_path, out_path )
+	finally:
+		if os.path.exists( tmp_path ):
+			os.remove( tmp_path )
+
 # --------------------------------------------------------------
 
-def save_term_rankings( out_path, term_rankings, labels = None ):
+def save_term_rankings( out_path, term_rankings, labels = None, vocabulary = None ):
 	"""
-	Save a list of multiple term rankings using Joblib.
+	Save a list of multiple term rankings using Joblib. If a vocabulary is specified, the rankings contain
+	term ids, which are stored as arrays together with the digest of the vocabulary. The vocabulary itself
+	is saved once in the same directory.
 	"""
 	# no labels? generate some standard ones
 	if labels is None:
 		labels = []
 		for i in range( len(term_rankings) ):
 			labels.append( "C%02d" % (i+1) )
-	joblib.dump((term_rankings,labels), out_path ) 
+	if vocabulary is None:
+		atomic_dump( (term_rankings,labels), out_path )
+		return
+	save_vocabulary( os.path.dirname( out_path ), vocabulary )
+	id_rankings = [np.asarray( ranking, dtype=np.int32 ) for ranking in term_rankings]
+	atomic_dump( (id_rankings,labels,vocabulary.digest()), out_path )
 
 def load_term_rankings( in_path ):
 	"""
-	Load a list of multiple term rankings using Joblib.
+	Load a list of multiple term rankings using Joblib, where rankings stored as term ids are
+	resolved to their terms.
+	"""
+	stored = load_joblib().load( in_path )
+	if len(stored) == 2:
+		return stored
+	(id_rankings,labels,digest) = stored
+	vocabulary = load_vocabulary( os.path.dirname( in_path ), digest )
+	return (vocabulary.decode_rankings( id_rankings ),labels)
+
+def load_term_ids( in_path, vocabulary ):
+	"""
+	Load a list of multiple term rankings as arrays of ids from the specified vocabulary. Rankings stored
+	as ids from the same vocabulary are used directly, while rankings of terms and rankings of ids from
+	another vocabulary are translated through their terms.
+	"""
+	stored = load_joblib().load( in_path )
+	if len(stored) == 2:
+		(term_rankings,labels) = stored
+		return ([vocabulary.encode( ranking ) for ranking in term_rankings],labels)
+	(id_rankings,labels,digest) = stored
+	mapping = vocabulary.translate( load_vocabulary( os.path.dirname( in_path ), digest ) )
+	if not mapping is None:
+		id_rankings = [mapping[ranking] for ranking in id_rankings]
+	return (id_rankings,labels)
+
+# vocabularies read from files, indexed by digest
+vocabulary_cache = {}
+
+def vocabulary_path( dir_path, digest ):
+	return os.path.join( dir_path, "vocab_%s.pkl" % digest )
+
+def save_vocabulary( dir_path, vocabulary ):
+	"""
+	Save the terms of a vocabulary in the specified directory, unless they have already been saved there.
+	"""
+	out_path = vocabulary_path( dir_path, vocabulary.digest() )
+	if not os.path.exists( out_path ):
+		atomic_dump( vocabulary.terms, out_path )
+
+def load_vocabulary( dir_path, digest ):
+	"""
+	Load the vocabulary with the specified digest from a directory, reusing vocabularies which have
+	already been read.
 	"""
-	(term_rankings,labels) = joblib.load( in_path )
-	return (term_rankings,labels)
+	if not digest in vocabulary_cache:
+		from unsupervised.rankings import Vocabulary
+		in_path = vocabulary_path( dir_path, digest )
+		if not os.path.exists( in_path ):
+			raise IOError( "Missing vocabulary file %s" % in_path )
+		vocabulary_cache[digest] = Vocabulary( load_joblib().load( in_path ) )
+	return vocabulary_cache[digest]
 
 def save_nmf_factors( out_path, W, H, doc_ids ):
 	"""
 	Save a NMF factorization result using Joblib.
 	"""
-	joblib.dump((W,H,doc_ids), out_path ) 
+	atomic_dump( (W,H,doc_ids), out_path )
 
 def load_nmf_factors( in_path ):
 	"""
 	Load a NMF factorization result using Joblib.
 	"""
-	(W,H,doc_ids) = joblib.load( in_path )
+	(W,H,doc_ids) = load_joblib().load( in_path )
 	return (W,H,doc_ids)
 
 def save_partition( out_path, partition, doc_ids ):
 	"""
-	Save a disjoint partition (clustering) result using Joblib.
+	Save a disjoint partition (clustering) result using Joblib. Documents are identified either
+	by their IDs or by an array of integer row indices into the corpus.
 	"""
-	joblib.dump((partition,doc_ids), out_path ) 
+	atomic_dump( (partition,doc_ids), out_path )
 
 
 def load_partition( in_path):
 	"""
 	Load a disjoint partition (clustering) result using Joblib.
 	"""
-	(partition,doc_ids) = joblib.load( in_path )
+	(partition,doc_ids) = load_joblib().load( in_path )
 	return (partition,doc_ids) 
+
+def ranking_sketch_path( rank_path ):
+	"""
+	Return the path of the sketch file stored alongside a ranking file, e.g. sketch_1000_001.pkl for
+	ranks_1000_001.pkl. The name does not start with ranks_, so that tools do not treat it as rankings.
+	"""
+	dir_path, fname = os.path.split( rank_path )
+	if fname.startswith( "ranks_" ):
+		fname = fname[len("ranks_"):]
+	return os.path.join( dir_path, "sketch_%s" % fname )
+
+def load_ranking_sketch( rank_path, term_rankings, metric ):
+	"""
+	Load the sketch of the term rankings read from a ranking file, using the sketch file stored alongside
+	it. If there is no sketch file, or it was built from a different file or with different settings, the
+	sketch is built using the metric and stored.
+	"""
+	sketch_path = ranking_sketch_path( rank_path )
+	settings = { "m" : metric.m, "resolution" : metric.resolution, "source" : file_digest( rank_path ) }
+	if os.path.exists( sketch_path ):
+		try:
+			(stored_settings, hashes, depths) = load_joblib().load( sketch_path )
+			if stored_settings == settings and depths[-1] == min( len(ranking) for ranking in term_rankings ):
+				from unsupervised.rankings import RankingSketch
+				return RankingSketch( hashes, depths )
+		except Exception:
+			pass
+	sketch = metric.sketch( term_rankings )
+	atomic_dump( (settings, sketch.hashes, sketch.depths), sketch_path )
+	return sketch
+
+# --------------------------------------------------------------
+# Prefetching
+# --------------------------------------------------------------
+
+def prefetch( load, paths, threads = 4, window = None ):
+	"""
+	Load a list of files with a pool of threads, yielding a (path, value) pair for each file in the order
+	of the paths, so that processing each file overlaps with reading the next ones. At most window files
+	(by default, twice the number of threads) are loaded ahead of the one being processed, which bounds
+	the memory used. An error raised while loading a file is raised when that file is reached.
+	"""
+	from collections import deque
+	from multiprocessing.pool import ThreadPool
+	paths = list( paths )
+	if threads < 2 or len(paths) < 2:
+		for path in paths:
+			yield ( path, load( path ) )
+		return
+	window = max( 1, window or 2 * threads )
+	pool = ThreadPool( min( threads, window, len(paths) ) )
+	try:
+		pending = deque()
+		next_index = 0
+		while next_index < len(paths) or len(pending) > 0:
+			while next_index < len(paths) and len(pending) < window:
+				pending.append( ( paths[next_index], pool.apply_async( load, ( paths[next_index], ) ) ) )
+				next_index += 1
+			path, result = pending.popleft()
+			yield ( path, result.get() )
+	finally:
+		pool.terminate()
+
+def add_prefetch_options( parser ):
+	"""
+	Add the standard options for prefetching result files to a script's option parser.
+	"""
+	parser.add_option("--threads", action="store", type="int", dest="load_threads", help="number of threads used to read result files", default=4)
+	parser.add_option("--prefetch", action="store", type="int", dest="prefetch_window", help="maximum number of result files read ahead of processing (default is twice the number of threads)", default=None)
+
+def add_run_options( parser ):
+	"""
+	Add the standard options for sampling, resuming and stopping subsampled runs to the option parser of
+	a tool which generates topic models.
+	"""
+	parser.add_option("-s", "--sample", action="store", type="float", dest="sample_ratio", help="sampling ratio of documents to include in each run (range is 0 to 1, default is 0.8)", default=None)
+	parser.add_option("-m", "--manifest", action="store", type="string", dest="manifest_path", help="sample manifest directory created by sample-corpus.py (default is to generate samples)", default=None)
+	parser.add_option("--force", action="store_true", dest="force", help="recompute runs which have already been completed")
+	parser.add_option("--reference", action="store", type="string", dest="reference_dir", help="reference results directory; if specified, stop adding runs for each k once its stability is known precisely enough", default=None)
+	parser.add_option("--width", action="store", type="float", dest="stop_width", help="with --reference, stop once the stability confidence interval is narrower than this width", default=0.05)
+	parser.add_option("--minruns", action="store", type="int", dest="min_runs", help="with --reference, minimum number of runs for each k", default=5)
+	parser.add_option("--confidence", action="store", type="float", dest="confidence", help="with --reference, confidence level for the stability interval", default=0.95)
+	parser.add_option("--stoptop", action="store", type="int", dest="stop_top", help="with --reference, number of top terms used to score each run", default=20)
+	parser.add_option("--cache", action="store", type="string", dest="cache_dir", help="directory for cached per-sample data shared across algorithms", default=None)
+
+def prepare_runs( options, corpus_path, n_documents, vocabulary ):
+	"""
+	Generate or load the document subsamples for all runs, as specified by the options added by
+	add_run_options(). Returns the sample manifest, the sample cache and the sequential stopping rule,
+	where the latter two are None unless requested. Raises ValueError if the manifest does not match
+	the corpus.
+	"""
+	import unsupervised.profiling, unsupervised.sampling, unsupervised.selection
+	if options.manifest_path is None:
+		if options.sample_ratio is None:
+			options.sample_ratio = 0.8
+		with unsupervised.profiling.stage( "sampling" ):
+			manifest = unsupervised.sampling.generate_sample_manifest( n_documents, options.sample_ratio, options.seed, options.kmin, options.kmax, options.runs )
+	else:
+		if not options.sample_ratio is None:
+			log.warning( "Ignoring the sampling ratio %s, as the samples are read from the manifest %s" % ( options.sample_ratio, options.manifest_path ) )
+		log.info( "Loading sample manifest from %s ..." % options.manifest_path )
+		with unsupervised.profiling.stage( "sampling" ):
+			manifest = unsupervised.sampling.load_sample_manifest( options.manifest_path )
+		if manifest.n_documents != n_documents:
+			raise ValueError( "Sample manifest covers %d documents, but the corpus has %d documents" % ( manifest.n_documents, n_documents ) )
+	cache = None
+	if not options.cache_dir is None:
+		log.info( "Using sample cache in %s" % options.cache_dir )
+		cache = unsupervised.sampling.SampleCache( options.cache_dir, corpus_fingerprint( corpus_path ) )
+	# score runs as they complete, to stop early for each k?
+	stopping = None
+	if not options.reference_dir is None:
+		log.info( "Stopping runs for each k when the stability interval is narrower than %.3f or k is dominated (min runs=%d)" % ( options.stop_width, options.min_runs ) )
+		stopping = unsupervised.selection.SequentialStopping( options.stop_top, options.stop_width, options.min_runs, options.confidence, vocabulary )
+	return ( manifest, cache, stopping )
+
+# --------------------------------------------------------------
+# Partition Batches
+# --------------------------------------------------------------
+
+class PartitionBatch:
+	"""
+	Disjoint partitions produced by multiple runs for the same number of clusters, stored as small-integer
+	arrays of cluster indices together with the corpus row indices of the clustered documents. Partitions
+	for runs that have not been written yet are marked with cluster index -1.
+	"""
+	def __init__( self, clusters, rows ):
+		self.clusters = clusters
+		self.rows = rows
+
+	def __len__( self ):
+		return self.clusters.shape[0]
+
+	def completed( self ):
+		"""
+		Return a boolean array indicating which runs have a partition.
+		"""
+		if self.clusters.shape[1] == 0:
+			return np.zeros( len(self), dtype=bool )
+		return np.asarray( self.clusters[:,0] ) >= 0
+
+	def get( self, run_index ):
+		"""
+		Return the cluster indices and corpus row indices for the specified run.
+		"""
+		return ( self.clusters[run_index], self.rows[run_index] )
+
+	def set( self, run_index, partition, rows ):
+		"""
+		Store the partition for the specified run.
+		"""
+		self.clusters[run_index] = np.asarray( partition ).ravel()
+		self.rows[run_index] = np.asarray( rows )
+
+	def flush( self ):
+		for values in [self.clusters, self.rows]:
+			if hasattr( values, "flush" ):
+				values.flush()
+
+def cluster_index_dtype( k ):
+	"""
+	Return the smallest signed integer type that can hold k cluster indices, and -1.
+	"""
+	for dtype in [np.int8, np.int16]:
+		if k <= np.iinfo(dtype).max:
+			return dtype
+	return np.int32
+
+def create_partition_batch( out_prefix, runs, n_sample, k, n_documents, resume = False ):
+	"""
+	Create a memory-mapped partition batch on disk for the specified number of runs, each clustering
+	n_sample documents into k clusters. When resuming, an existing batch with the same shape is opened 
+	for updating instead, while the partitions in an existing batch for a different number of runs are 
+	copied to the new batch.
+	"""
+	from numpy.lib.format import open_memmap
+	from unsupervised.sampling import row_index_dtype
+	clusters_path, rows_path = "%s.clusters.npy" % out_prefix, "%s.rows.npy" % out_prefix
+	shape = ( runs, n_sample )
+	previous = None
+	if resume and partition_batch_exists( out_prefix ):
+		batch = load_partition_batch( out_prefix, mode = "r+" )
+		if batch.clusters.shape == shape and batch.clusters.dtype == cluster_index_dtype(k):
+			return batch
+		if batch.clusters.shape[1] == n_sample and batch.clusters.dtype == cluster_index_dtype(k):
+			previous = load_partition_batch( out_prefix, mode = None )
+		del batch
+	clusters = open_memmap( clusters_path, mode = "w+", dtype = cluster_index_dtype(k), shape = shape )
+	clusters[:] = -1
+	rows = open_memmap( rows_path, mode = "w+", dtype = row_index_dtype(n_documents), shape = shape )
+	if not previous is None:
+		n_copy = min( runs, len(previous) )
+		clusters[0:n_copy] = previous.clusters[0:n_copy]
+		rows[0:n_copy] = previous.rows[0:n_copy]
+	return PartitionBatch( clusters, rows )
+
+def save_partition_batch( out_prefix, partitions, rows, k, n_documents ):
+	"""
+	Save a list of partitions and the corresponding corpus row indices as a partition batch.
+	"""
+	batch = create_partition_batch( out_prefix, len(partitions), len(rows[0]), k, n_documents )
+	for run_index in range( len(partitions) ):
+		batch.set( run_index, partitions[run_index], rows[run_index] )
+	batch.flush()
+	return batch
+
+def load_partition_batch( in_prefix, mode = "r" ):
+	"""
+	Load a partition batch, memory-mapping its arrays. Use mode=None to read the arrays into memory.
+	"""
+	clusters = np.load( "%s.clusters.npy" % in_prefix, mmap_mode = mode )
+	rows = np.load( "%s.rows.npy" % in_prefix, mmap_mode = mode )
+	return PartitionBatch( clusters, rows )
+
+def partition_batch_exists( in_prefix ):
+	return os.path.exists( "%s.clusters.npy" % in_prefix ) and os.path.exists( "%s.rows.npy" % in_prefix )
+
+def find_run_partition( dir_path, rank_fname ):
+	"""
+	Find the partition produced by the same run as the specified term ranking file. Returns a tuple with
+	either the path of a Joblib partition file and None, or the prefix of a partition batch and the run 
+	index within the batch. Returns None if no partition is available.
+	"""
+	suffix = os.path.splitext( rank_fname )[0][len("ranks_"):]
+	pkl_path = os.path.join( dir_path, "partition_%s.pkl" % suffix )
+	if os.path.exists( pkl_path ):
+		return ( pkl_path, None )
+	if suffix == "reference":
+		batch_name, run_index = "partitions_reference", 0
+	else:
+		parts = suffix.rsplit( "_", 1 )
+		if len(parts) < 2 or not parts[1].isdigit():
+			return None
+		batch_name, run_index = "partitions_%s" % parts[0], int(parts[1]) - 1
+	batch_prefix = os.path.join( dir_path, batch_name )
+	if not partition_batch_exists( batch_prefix ):
+		return None
+	return ( batch_prefix, run_index )
+
+# --------------------------------------------------------------
+# Run Manifests
+# --------------------------------------------------------------
+
+class RunManifest:
+	"""
+	Record of the completed (seed, k, run) units written to an output directory, together with the
+	digests of their outputs and the settings used to produce them. A unit is only treated as 
+	complete if the settings are unchanged and all of its outputs are still present and unmodified.
+	"""
+	def __init__( self, manifest_path ):
+		self.manifest_path = manifest_path
+		self.units = {}
+		if os.path.exists( manifest_path ):
+			with open( manifest_path, "r" ) as fin:
+				self.units = json.load( fin )
+
+	def __len__( self ):
+		return len(self.units)
+
+	def is_complete( self, seed, k, run, settings, paths, arrays = None ):
+		"""
+		Check whether the unit has been completed with the specified settings, where paths is the list of 
+		output files and arrays is an optional dictionary of output arrays, such as the partition.
+		"""
+		unit = self.units.get( unit_key( seed, k, run ), None )
+		if unit is None or unit["settings"] != settings:
+			return False
+		for out_path in paths:
+			name = os.path.basename( out_path )
+			if not name in unit["files"] or not os.path.exists( out_path ):
+				return False
+			if file_digest( out_path ) != unit["files"][name]:
+				return False
+		for name, values in ( arrays or {} ).items():
+			if unit["arrays"].get( name, None ) != array_digest( values ):
+				return False
+		return True
+
+	def add( self, seed, k, run, settings, paths, arrays = None ):
+		"""
+		Record a completed unit, and save the manifest.
+		"""
+		unit = { "settings" : settings, "files" : {}, "arrays" : {} }
+		for out_path in paths:
+			unit["files"][os.path.basename( out_path )] = file_digest( out_path )
+		for name, values in ( arrays or {} ).items():
+			unit["arrays"][name] = array_digest( values )
+		self.units[unit_key( seed, k, run )] = unit
+		self.save()
+
+	def save( self ):
+		tmp_path = "%s.tmp%d" % ( self.manifest_path, os.getpid() )
+		with open( tmp_path, "w" ) as fout:
+			json.dump( self.units, fout, indent = 1, sort_keys = True )
+		os.rename( tmp_path, self.manifest_path )
+
+def unit_key( seed, k, run ):
+	return "%s:%d:%d" % ( seed, k, run )
+
+def load_run_manifest( dir_path, seed ):
+	"""
+	Load the run manifest for the specified seed in an output directory, or create an empty one.
+	"""
+	return RunManifest( os.path.join( dir_path, "runs_%s.json" % seed ) )
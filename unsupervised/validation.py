@@ -1,7 +1,9 @@
-from prettytable import PrettyTable
+import os, os.path
+import logging as log
 import numpy as np
-from sklearn.metrics.cluster import normalized_mutual_info_score, adjusted_mutual_info_score, adjusted_rand_score
-import util, rankings
+import unsupervised.util as util
+import unsupervised.rankings as rankings
+import text.util
 
 # --------------------------------------------------------------
 
@@ -9,26 +11,23 @@ class TermValidator:
 	"""
 	Validation measure, which compares the agreement between term rankings derived from the
 	centroids produced using a 'ground truth' partition, with a specified set of test rankings
-	generated on the same corpus.
+	generated on the same corpus. Test rankings are read as ids from the vocabulary of the corpus terms.
 	"""
-	def __init__( self, X, terms, class_partition ):
+	def __init__( self, X, terms, class_partition, top = 100 ):
 		self.agreement_measure = rankings.RankingSetAgreement()
+		self.vocabulary = rankings.Vocabulary( terms )
 		centroids = util.build_centroids( X, class_partition, max(class_partition) + 1 )
-		# sort centroids for each class
+		# build ranking of the ids of the top terms for each class
 		self.class_rankings = []
-		for class_index, centroid in enumerate(centroids):
-			# build ranking of terms 
-			ranking = [terms[i] for i in centroid.argsort()]
-			ranking.reverse()
-			self.class_rankings.append( ranking )
+		for ranked_term_indices in util.rank_centroid_terms( centroids, top ):
+			self.class_rankings.append( np.asarray( ranked_term_indices, dtype=np.int32 ) )
 
 	def evaluate( self, test_rankings, top_values = [10] ):
 		scores = {}
+		# the agreement for every top value comes from one set of prefix overlaps
+		all_sims = self.agreement_measure.similarities( self.class_rankings, test_rankings, top_values )
 		for top in top_values:
-			trunc_classes = rankings.truncate_term_rankings(self.class_rankings,top)
-			trunc_test = rankings.truncate_term_rankings(test_rankings,top)
-			sim = self.agreement_measure.similarity( trunc_classes, trunc_test )
-			scores[ "terms-%03d" % (top) ] = sim
+			scores[ "terms-%03d" % (top) ] = all_sims[top]
 		return scores
 
 # --------------------------------------------------------------
@@ -43,20 +42,182 @@ class DiversityValidator:
 		self.metric = metric
 
 	def evaluate( self, test_rankings, top_values = [10] ):
-		scores = {}
 		k = len(test_rankings)
+		# metrics that support it compute all top values from a single pass over prefix overlaps
+		if hasattr( self.metric, "similarity_matrices" ):
+			all_S = self.metric.similarity_matrices( test_rankings, test_rankings, top_values )
+		else:
+			all_S = {}
+			for top in top_values:
+				trunc_rankings = rankings.truncate_term_rankings( test_rankings, top )
+				all_S[top] = rankings.pairwise_similarity_matrix( self.metric, trunc_rankings, trunc_rankings )
+		upper = np.triu_indices( k, 1 )
+		scores = {}
 		for top in top_values:
-			trunc_rankings = rankings.truncate_term_rankings( test_rankings, top )
-			pairs = 0
-			diversity = 0.0
-			for ranking_index1 in range(k):
-				for ranking_index2 in range(ranking_index1 + 1, k):
-					pair_dissimilarity = 1.0 - self.metric.similarity( trunc_rankings[ranking_index1], trunc_rankings[ranking_index2] )
-					diversity += pair_dissimilarity
-					pairs += 1
-			scores[ "div-%03d" % (top) ] = diversity / pairs
+			scores[ "div-%03d" % (top) ] = np.mean( 1.0 - all_S[top][upper] ) if k > 1 else 0.0
 		return scores
 
+	def evaluate_batch( self, all_test_rankings, top_values = [10] ):
+		"""
+		Evaluate the diversity of multiple ranking sets, such as those produced by many runs. Returns
+		a list containing the scores for each ranking set.
+		"""
+		all_test_rankings = list(all_test_rankings)
+		if len(all_test_rankings) == 0:
+			return []
+		sizes = set( len(test_rankings) for test_rankings in all_test_rankings )
+		lengths = set( len(ranking) for test_rankings in all_test_rankings for ranking in test_rankings )
+		# fall back to evaluating each set separately, unless the sets can be stacked
+		if not hasattr( self.metric, "prefix_similarities" ) or len(sizes) > 1 or len(lengths) > 1:
+			return [self.evaluate( test_rankings, top_values ) for test_rankings in all_test_rankings]
+		k, depth = sizes.pop(), lengths.pop()
+		# encode each set separately, so that term ids are only unique within each set
+		R = np.empty( (len(all_test_rankings), k, depth), dtype=np.int64 )
+		n_terms = 0
+		for i, test_rankings in enumerate(all_test_rankings):
+			( (R[i],), set_terms ) = rankings.encode_term_rankings( [test_rankings] )
+			n_terms = max( n_terms, set_terms )
+		if rankings.has_duplicate_terms( R ):
+			return [self.evaluate( test_rankings, top_values ) for test_rankings in all_test_rankings]
+		S_all = self.metric.prefix_similarities( rankings.batch_prefix_overlaps( R, n_terms ) )
+		upper = np.triu_indices( k, 1 )
+		all_scores = [{} for i in range(len(all_test_rankings))]
+		for top in top_values:
+			d = depth if ( top < 1 or top > depth ) else top
+			diversity = ( 1.0 - S_all[:,upper[0],upper[1],d-1] ).mean( axis = 1 ) if k > 1 else np.zeros( len(all_scores) )
+			for i, scores in enumerate(all_scores):
+				scores[ "div-%03d" % (top) ] = diversity[i]
+		return all_scores
+
+# --------------------------------------------------------------
+
+class CooccurrenceIndex:
+	"""
+	Sparse counts of the number of documents containing each pair of terms, for a subset of the corpus
+	terms. The counts for single terms are stored on the diagonal.
+	"""
+	def __init__( self, term_ids, C, n_documents ):
+		self.term_ids = np.asarray( term_ids, dtype=np.int64 )
+		self.C = C
+		self.n_documents = n_documents
+		self.doc_counts = np.asarray( C.diagonal(), dtype=np.float64 )
+		# position of each non-zero count in row-major order, for vectorized lookups
+		rows = np.repeat( np.arange( C.shape[0], dtype=np.int64 ), np.diff( C.indptr ) )
+		self.keys = rows * C.shape[1] + C.indices
+
+	def __len__( self ):
+		return len(self.term_ids)
+
+	def covers( self, term_ids ):
+		return bool( np.isin( term_ids, self.term_ids ).all() )
+
+	def positions( self, term_ids ):
+		"""
+		Return the positions in the index of an array of term ids, and a mask of the ids which are indexed.
+		"""
+		term_ids = np.asarray( term_ids, dtype=np.int64 )
+		pos = np.minimum( np.searchsorted( self.term_ids, term_ids ), max( 0, len(self.term_ids) - 1 ) )
+		return ( pos, self.term_ids[pos] == term_ids if len(self.term_ids) > 0 else np.zeros( term_ids.shape, dtype=bool ) )
+
+	def counts( self, pos1, pos2 ):
+		"""
+		Return the number of documents containing both terms, for arrays of pairs of positions.
+		"""
+		keys = pos1 * self.C.shape[1] + pos2
+		found = np.minimum( np.searchsorted( self.keys, keys ), max( 0, len(self.keys) - 1 ) )
+		values = np.zeros( keys.shape )
+		if len(self.keys) > 0:
+			hit = self.keys[found] == keys
+			values[hit] = self.C.data[found[hit]]
+		return values
+
+def build_cooccurrence_index( X, term_ids ):
+	"""
+	Build the co-occurrence index for the specified terms from a document-term matrix, by binarizing
+	the columns for those terms and multiplying them with a single sparse product.
+	"""
+	from scipy import sparse as sp
+	term_ids = np.unique( np.asarray( term_ids, dtype=np.int64 ) )
+	B = sp.csr_matrix( X[:,term_ids] )
+	B.eliminate_zeros()
+	B = sp.csr_matrix( (np.ones( len(B.indices), dtype=np.int32 ), B.indices, B.indptr), shape = B.shape )
+	C = B.T.dot( B ).tocsr()
+	C.sort_indices()
+	return CooccurrenceIndex( term_ids, C, X.shape[0] )
+
+def load_cooccurrence_index( X, term_ids, index_path, corpus_key ):
+	"""
+	Load the co-occurrence index saved for a corpus at the specified path, if it covers all of the
+	specified terms. Otherwise, the index is rebuilt for these terms and all terms already indexed, and
+	saved again. Indexes built from a different corpus are discarded.
+	"""
+	term_ids = np.unique( np.asarray( term_ids, dtype=np.int64 ) )
+	if os.path.exists( index_path ):
+		try:
+			(stored_key, stored_ids, data, indices, indptr, n_documents) = util.load_joblib().load( index_path )
+			if stored_key == corpus_key:
+				from scipy import sparse as sp
+				C = sp.csr_matrix( (data, indices, indptr), shape = (len(stored_ids), len(stored_ids)) )
+				index = CooccurrenceIndex( stored_ids, C, n_documents )
+				if index.covers( term_ids ):
+					return index
+				term_ids = np.union1d( term_ids, stored_ids )
+		except Exception as e:
+			log.warning( "Ignoring unreadable co-occurrence index %s - %s" % ( index_path, str(e) ) )
+	log.info( "Building co-occurrence index for %d terms ..." % len(term_ids) )
+	index = build_cooccurrence_index( X, term_ids )
+	util.atomic_dump( (corpus_key, index.term_ids, index.C.data, index.C.indices, index.C.indptr, index.n_documents), index_path )
+	return index
+
+class CoherenceValidator:
+	"""
+	Validation measure that calculates the NPMI and UMass coherence of the top terms of each topic, based
+	on the number of documents in which pairs of terms co-occur in the corpus. All counts come from a
+	co-occurrence index, which must cover the top terms of the rankings evaluated. Test rankings are arrays
+	of corpus term ids. The coherence of a ranking set is the mean coherence of its topics.
+	"""
+	def __init__( self, index ):
+		self.index = index
+
+	def evaluate( self, test_rankings, top_values = [10] ):
+		scores = {}
+		for top in top_values:
+			depth = min( min( len(ranking) for ranking in test_rankings ), top )
+			( npmi, umass ) = self.coherence( np.array( [ranking[0:depth] for ranking in test_rankings] ) )
+			scores[ "npmi-%03d" % (top) ] = npmi
+			scores[ "umass-%03d" % (top) ] = umass
+		return scores
+
+	def coherence( self, R ):
+		"""
+		Return the mean NPMI and UMass coherence for a 2D array of rankings, where each pair of terms is
+		scored with the higher ranked term as the conditioning term.
+		"""
+		if R.shape[1] < 2:
+			return ( 0.0, 0.0 )
+		( pos, indexed ) = self.index.positions( R )
+		first, second = np.triu_indices( R.shape[1], 1 )
+		pos1, pos2 = pos[:,first], pos[:,second]
+		D1, D2 = self.index.doc_counts[pos1], self.index.doc_counts[pos2]
+		# pairs with a term not indexed or not in any document are ignored
+		valid = indexed[:,first] & indexed[:,second] & ( D1 > 0 ) & ( D2 > 0 )
+		D12 = self.index.counts( pos1, pos2 )
+		umass = np.log( ( D12 + 1.0 ) / np.maximum( D1, 1.0 ) )
+		n = float( self.index.n_documents )
+		with np.errstate( divide = "ignore", invalid = "ignore" ):
+			p12 = D12 / n
+			npmi = np.log( p12 / ( ( D1 / n ) * ( D2 / n ) ) ) / -np.log( p12 )
+		# by convention, terms which never co-occur have NPMI -1, and terms which always co-occur have NPMI 1
+		npmi[D12 == 0] = -1.0
+		npmi[D12 >= n] = 1.0
+		counts = valid.sum( axis = 1 )
+		topics = counts > 0
+		if not topics.any():
+			return ( 0.0, 0.0 )
+		topic_npmi = np.where( valid, npmi, 0.0 ).sum( axis = 1 )[topics] / counts[topics]
+		topic_umass = np.where( valid, umass, 0.0 ).sum( axis = 1 )[topics] / counts[topics]
+		return ( float( topic_npmi.mean() ), float( topic_umass.mean() ) )
+
 # --------------------------------------------------------------
 
 class PartitionValidator:
@@ -67,37 +228,109 @@ class PartitionValidator:
 	def __init__( self, classes, doc_ids ):
 		self.classes = classes
 		self.doc_ids = doc_ids
-		self.class_map = {}
-		class_index = 0
-		# convert classes to membership map
-		for class_id in classes.keys():
-			for doc_id in classes[class_id]:
-				self.class_map[doc_id] = class_index
-			class_index += 1
+		self.class_labels = None
+		self.row_map = None
+		if self.has_class_info():
+			# class index for each corpus row, or -1 if the document has no class
+			self.class_labels = np.asarray( text.util.class_labels( classes, doc_ids )[1] )
 
 	def has_class_info( self ):
 		return not( self.classes is None or len(self.classes) < 2 )
 
 	def evaluate( self, partition, clustered_ids ):
+		"""
+		Evaluate a single partition, where the clustered documents are identified either by their 
+		integer row indices in the corpus or by their document IDs.
+		"""
 		# no class info?
 		if not self.has_class_info():
 			return {}
-		# get two clusterings that we can compare
-		n = len(clustered_ids)
-		classes_subset = np.zeros( n )
-		for row in range(n):
-			classes_subset[row] = self.class_map[clustered_ids[row]]		
+		clustered_ids = np.asarray( clustered_ids )
+		if not np.issubdtype( clustered_ids.dtype, np.integer ):
+			clustered_ids = self.__rows_for_ids( clustered_ids )
+		return self.__score( self.class_labels[clustered_ids], np.asarray( partition ).ravel() )
+
+	def evaluate_batch( self, batch, run_indices = None ):
+		"""
+		Evaluate the completed runs in a partition batch, either all of them or only those with the specified
+		indices, returning a dictionary of scores for each run index.
+		"""
+		if not self.has_class_info():
+			return {}
+		completed = batch.completed()
+		if run_indices is None:
+			run_indices = np.where( completed )[0]
+		else:
+			run_indices = np.asarray( run_indices, dtype=np.intp )
+			run_indices = run_indices[completed[run_indices]]
+		if len(run_indices) == 0:
+			return {}
+		# gather the classes for all runs with a single indexing operation
+		all_classes = self.class_labels[np.asarray( batch.rows[run_indices] )]
+		all_clusters = np.asarray( batch.clusters[run_indices] )
+		results = {}
+		for i, run_index in enumerate(run_indices):
+			results[run_index] = self.__score( all_classes[i], all_clusters[i] )
+		return results
+
+	def __score( self, classes_subset, partition ):
+		from sklearn.metrics.cluster import normalized_mutual_info_score, adjusted_mutual_info_score, adjusted_rand_score
+		# ignore documents without a class
+		mask = classes_subset >= 0
+		if not mask.all():
+			classes_subset, partition = classes_subset[mask], partition[mask]
 		scores = {}
 		scores["external-nmi"] = normalized_mutual_info_score( classes_subset, partition )
 		scores["external-ami"] = adjusted_mutual_info_score( classes_subset, partition )
 		scores["external-ari"] = adjusted_rand_score( classes_subset, partition )
 		return scores
 
+	def __rows_for_ids( self, clustered_ids ):
+		if self.row_map is None:
+			self.row_map = {}
+			for row, doc_id in enumerate( self.doc_ids ):
+				self.row_map[doc_id] = row
+		return np.array( [self.row_map[doc_id] for doc_id in clustered_ids], dtype=np.intp )
+
 	def keys( self ):
 		# no class info?
 		if not self.has_class_info():
 			return set()
-		return set( "external-nmi", "external-ami", "external-ari" )
+		return set( ["external-nmi", "external-ami", "external-ari"] )
+
+# --------------------------------------------------------------
+
+class ScoreCache:
+	"""
+	A persistent cache of the validation scores for individual results, keyed by a fingerprint of the 
+	result files. The cache is discarded if it was created with different validation settings.
+	"""
+	def __init__( self, cache_path, settings_key ):
+		self.cache_path = cache_path
+		self.settings_key = settings_key
+		self.scores = {}
+		self.modified = False
+		if os.path.exists( cache_path ):
+			try:
+				(cached_key, cached_scores) = util.load_joblib().load( cache_path )
+				if cached_key == settings_key:
+					self.scores = cached_scores
+			except Exception as e:
+				log.warning( "Ignoring unreadable score cache %s - %s" % ( cache_path, str(e) ) )
+
+	def get( self, digest ):
+		return self.scores.get( digest, None )
+
+	def add( self, digest, scores ):
+		self.scores[digest] = scores
+		self.modified = True
+
+	def save( self ):
+		if not self.modified:
+			return
+		# an interrupted write cannot corrupt the cache
+		util.atomic_dump( (self.settings_key, self.scores), self.cache_path )
+		self.modified = False
 
 # --------------------------------------------------------------
 
@@ -133,6 +366,7 @@ class ScoreCollection:
 		return (mean_scores,std_scores)
 
 	def create_table( self, include_mean = False, precision = 2 ):
+		from prettytable import PrettyTable
 		fmt = "%%.%df" % precision
 		header = ["experiment"]
 		score_keys = list(self.all_score_keys)
@@ -2,73 +2,236 @@
 import os, os.path, sys
 import logging as log
 from optparse import OptionParser
-import text.util, unsupervised.util, unsupervised.validation
+from multiprocessing import Pool
+import numpy as np
+import text.util, unsupervised.profiling, unsupervised.util, unsupervised.validation
+
+# --------------------------------------------------------------
+
+# validators shared by all worker processes
+worker_state = {}
+
+def init_worker( partition_validator, term_validator, term_top_values, coherence_validator, coherence_top_values ):
+	worker_state["partition_validator"] = partition_validator
+	worker_state["term_validator"] = term_validator
+	worker_state["term_top_values"] = term_top_values
+	worker_state["coherence_validator"] = coherence_validator
+	worker_state["coherence_top_values"] = coherence_top_values
+	worker_state["batches"] = {}
+
+def load_batch( location ):
+	batches = worker_state.setdefault( "batches", {} )
+	if not location in batches:
+		batches[location] = unsupervised.util.load_partition_batch( location )
+	return batches[location]
+
+def load_run_partition( partition_location ):
+	"""
+	Load the partition for a single run, together with the IDs or row indices of the clustered documents.
+	"""
+	location, run_index = partition_location
+	if run_index is None:
+		return unsupervised.util.load_partition( location )
+	batch = load_batch( location )
+	if not batch.completed()[run_index]:
+		return None
+	return batch.get( run_index )
+
+def load_run( path_pair ):
+	"""
+	Load the term rankings and the partition (if any) produced by a single run. Partitions stored in
+	batches are not loaded, as they are scored separately by score_batch_partitions().
+	"""
+	rank_file_path, partition_location = path_pair
+	loaded = None
+	if not partition_location is None and partition_location[1] is None:
+		loaded = load_run_partition( partition_location )
+	(term_rankings,labels) = unsupervised.util.load_term_ids( rank_file_path, worker_state["term_validator"].vocabulary )
+	return ( term_rankings, loaded )
+
+@unsupervised.profiling.timed( "validate_run" )
+def score_run( run ):
+	"""
+	Evaluate the term rankings and the partition (if any) loaded for a single run.
+	"""
+	term_rankings, loaded = run
+	scores = {}
+	# evaluate partition
+	if not loaded is None:
+		scores.update( worker_state["partition_validator"].evaluate( loaded[0], loaded[1] ) )
+	# evaluate topic terms
+	scores.update( worker_state["term_validator"].evaluate( term_rankings, worker_state["term_top_values"] ) )
+	scores.update( worker_state["coherence_validator"].evaluate( term_rankings, worker_state["coherence_top_values"] ) )
+	return scores
+
+def validate_run( path_pair ):
+	return score_run( load_run( path_pair ) )
+
+@unsupervised.profiling.timed( "validate_batch" )
+def score_batch_partitions( partition_locations ):
+	"""
+	Evaluate the partitions of all specified runs which are stored in partition batches, scoring the runs
+	in each batch together. Returns a dictionary of scores for each partition location.
+	"""
+	batch_runs = {}
+	for partition_location in partition_locations:
+		if not partition_location is None and not partition_location[1] is None:
+			batch_runs.setdefault( partition_location[0], [] ).append( partition_location[1] )
+	all_scores = {}
+	for location in batch_runs:
+		batch_scores = worker_state["partition_validator"].evaluate_batch( load_batch( location ), batch_runs[location] )
+		for run_index in batch_scores:
+			all_scores[(location, run_index)] = batch_scores[run_index]
+	return all_scores
+
+def run_digest( path_pair ):
+	"""
+	Return a fingerprint of the contents of the ranking file and partition produced by a single run.
+	"""
+	rank_file_path, partition_location = path_pair
+	parts = [unsupervised.util.file_digest( rank_file_path )]
+	if not partition_location is None:
+		loaded = load_run_partition( partition_location )
+		if not loaded is None:
+			parts.append( unsupervised.util.array_digest( loaded[0], loaded[1] ) )
+	return ":".join( parts )
+
+def find_runs( result_dir_path ):
+	"""
+	Return the ranking file and partition (if any) for each run in a results directory.
+	"""
+	path_pairs = []
+	for fname in os.listdir( result_dir_path ):
+		if fname.startswith( "ranks_" ) and fname.endswith( ".pkl"):
+			# do we have a partition for this rank file?
+			path_pairs.append( (os.path.join( result_dir_path, fname ),unsupervised.util.find_run_partition( result_dir_path, fname )) )
+	return path_pairs
+
+def top_term_ids( rank_paths, vocabulary, top, threads = 4, window = None ):
+	"""
+	Return the ids of all terms which appear in the top terms of the rankings in the specified files.
+	"""
+	all_ids = [np.zeros( 0, dtype=np.int32 )]
+	for rank_path, (term_rankings,labels) in unsupervised.util.prefetch( lambda path : unsupervised.util.load_term_ids( path, vocabulary ), rank_paths, threads, window ):
+		all_ids += [ranking[0:top] for ranking in term_rankings]
+	return np.unique( np.concatenate( all_ids ) )
 
 # --------------------------------------------------------------
 
 def main():
 	parser = OptionParser(usage="usage: %prog [options] corpus_file input_directory1 input_directory2 ...")
 	parser.add_option("-p", "--precision", action="store", type="int", dest="precision", help="precision for results", default=2)
+	parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", help="number of worker processes", default=1)
+	parser.add_option("--nocache", action="store_true", dest="no_cache", help="do not read or write the score cache in each input directory")
+	parser.add_option("-c", "--coherence", action="store", type="string", dest="coherence_top", help="number of top terms used to calculate topic coherence, or a comma-separated list of values", default="10,20")
+	parser.add_option("--index", action="store", type="string", dest="index_path", help="path of the term co-occurrence index used to calculate topic coherence (default is <corpus>-cooccur.pkl, next to the corpus)", default=None)
+	unsupervised.util.add_prefetch_options( parser )
+	unsupervised.profiling.add_options( parser )
 	parser.add_option('-d','--debug',type="int",help="Level of log output; 0 is less, 5 is all", default=3)
 	(options, args) = parser.parse_args()
 	if( len(args) < 2 ):
 		parser.error( "Must specify at least a corpus and one input direct containing topic modeling results" )	
 	log.basicConfig(level=max(50 - (options.debug * 10), 10), format='%(asctime)-18s %(levelname)-10s %(message)s', datefmt='%d/%m/%Y %H:%M',)
+	unsupervised.profiling.configure( options )
+	try:
+		coherence_top_values = [int(value) for value in options.coherence_top.split(",")]
+	except ValueError:
+		parser.error( "Invalid number of top terms '%s'" % options.coherence_top )
 
 	# Read the corpus
 	corpus_path = args[0]
-	print "* Reading %s ..." % corpus_path
-	(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
+	print( "* Reading %s ..." % corpus_path )
+	with unsupervised.profiling.stage( "load_corpus" ):
+		(X,terms,doc_ids,classes) = text.util.load_corpus( corpus_path )
 	if classes is None or len(classes) < 2:
-		print "Error: No ground truth class information for this corpus"
+		print( "Error: No ground truth class information for this corpus" )
 		sys.exit(1)
 	class_partition = unsupervised.util.clustermap_to_partition( classes, doc_ids )
 
-	partition_validator = unsupervised.validation.PartitionValidator( classes, doc_ids )
-	term_validator = unsupervised.validation.TermValidator( X, terms, class_partition )
-	term_top_values = [ 10, 20, 50, 100 ]
+	# NB: class rankings and labels are computed once, and shared by all workers
+	with unsupervised.profiling.stage( "build_validators" ):
+		partition_validator = unsupervised.validation.PartitionValidator( classes, doc_ids )
+		term_top_values = [ 10, 20, 50, 100 ]
+		term_validator = unsupervised.validation.TermValidator( X, terms, class_partition, max(term_top_values) )
+	corpus_key = unsupervised.util.corpus_fingerprint( corpus_path )
+	all_path_pairs = [find_runs( result_dir_path.rstrip(os.sep) ) for result_dir_path in args[1:]]
+
+	# NB: the co-occurrence index only covers the top terms of the runs, and is extended when new terms appear
+	with unsupervised.profiling.stage( "build_coherence_index" ):
+		rank_paths = [path_pair[0] for path_pairs in all_path_pairs for path_pair in path_pairs]
+		term_ids = top_term_ids( rank_paths, term_validator.vocabulary, max( coherence_top_values ), options.load_threads, options.prefetch_window )
+		index_path = options.index_path or os.path.join( os.path.dirname( os.path.abspath( corpus_path.rstrip(os.sep) ) ), "%s-cooccur.pkl" % text.util.corpus_name( corpus_path ) )
+		index = unsupervised.validation.load_cooccurrence_index( X, term_ids[term_ids < X.shape[1]], index_path, corpus_key )
+		coherence_validator = unsupervised.validation.CoherenceValidator( index )
+	log.info( "Co-occurrence index covers %d terms" % len(index) )
+	init_worker( partition_validator, term_validator, term_top_values, coherence_validator, coherence_top_values )
+	pool = None
+	if options.jobs > 1:
+		log.info( "Using %d worker processes" % options.jobs )
+		pool = Pool( options.jobs, init_worker, (partition_validator, term_validator, term_top_values, coherence_validator, coherence_top_values) )
+	# cached scores are only valid for the same corpus and settings
+	settings_key = "%s:%s:%s" % ( corpus_key, term_top_values, coherence_top_values )
 	
 	# Process each directory
 	mean_collection = unsupervised.validation.ScoreCollection()
-	for result_dir_path in args[1:]:
+	for result_dir_path, path_pairs in zip( args[1:], all_path_pairs ):
 		result_dir_path = result_dir_path.rstrip(os.sep)
-		print "* Processing results in directory", result_dir_path
-		fils = os.listdir( result_dir_path )
-		path_pairs = []
-		for fname in fils:
-			if fname.startswith( "ranks_" ) and fname.endswith( ".pkl"):
-				rank_file_path = os.path.join( result_dir_path, fname )	
-				# do we have a partition file for this rank file?
-				partition_file_path = os.path.join( result_dir_path, fname.replace( "ranks_", "partition_" ) )
-				if not os.path.exists(partition_file_path):
-					partition_file_path = None
-				path_pairs.append( (rank_file_path,partition_file_path) )
+		print( "* Processing results in directory %s" % result_dir_path )
 		if len(path_pairs) == 0:
-			print "Warning: No ranking sets found in directory ", result_dir_path
+			print( "Warning: No ranking sets found in directory %s" % result_dir_path )
 			continue
-		print "Validating %d topic ranking sets" % len(path_pairs)
-		collection = unsupervised.validation.ScoreCollection()
+		print( "Validating %d topic ranking sets" % len(path_pairs) )
 		for path_pair in path_pairs:
-			# evaluate partition
 			if path_pair[1] is None:
-				print "Warning: no partition available for", path_pair[0]
-				partition_results = {}
-			else:
-				partition, doc_ids = unsupervised.util.load_partition( path_pair[1] )
-				partition_results = partition_validator.evaluate( partition, doc_ids )
-			# evaluate topic terms
-			(term_rankings,labels) = unsupervised.util.load_term_rankings( path_pair[0] )
-			term_results = term_validator.evaluate( term_rankings, term_top_values )
-			# add all results to the collection
+				print( "Warning: no partition available for %s" % path_pair[0] )
+		# find the runs which have not been scored before
+		cache = None
+		if not options.no_cache:
+			cache = unsupervised.validation.ScoreCache( os.path.join( result_dir_path, "validate-cache.pkl" ), settings_key )
+		all_results = [None] * len(path_pairs)
+		digests = [None] * len(path_pairs)
+		pending = []
+		if not cache is None:
+			# the contents of every file are read to check the cache, so the files are read concurrently
+			for i, (path_pair, digest) in enumerate( unsupervised.util.prefetch( run_digest, path_pairs, options.load_threads, options.prefetch_window ) ):
+				digests[i] = digest
+				all_results[i] = cache.get( digest )
+		for i in range( len(path_pairs) ):
+			if all_results[i] is None:
+				pending.append( i )
+		log.info( "Scoring %d new ranking sets, %d cached" % ( len(pending), len(path_pairs) - len(pending) ) )
+		pending_pairs = [path_pairs[i] for i in pending]
+		partition_scores = score_batch_partitions( [path_pair[1] for path_pair in pending_pairs] )
+		if pool is None:
+			# runs are read ahead while earlier runs are scored
+			pending_results = ( score_run( run ) for path_pair, run in unsupervised.util.prefetch( load_run, pending_pairs, options.load_threads, options.prefetch_window ) )
+		else:
+			pending_results = pool.imap( validate_run, pending_pairs )
+		with unsupervised.profiling.stage( "scoring", directory=os.path.basename(result_dir_path) ):
+			for i, scores in zip( pending, pending_results ):
+				if not path_pairs[i][1] is None:
+					scores.update( partition_scores.get( path_pairs[i][1], {} ) )
+				all_results[i] = scores
+				if not cache is None:
+					cache.add( digests[i], scores )
+		if not cache is None:
+			cache.save()
+		# add all results to the collection
+		collection = unsupervised.validation.ScoreCollection()
+		for path_pair, scores in zip( path_pairs, all_results ):
 			experiment_key = os.path.splitext( os.path.basename( path_pair[0] ) )[0]
-			collection.add( experiment_key, dict( partition_results.items() + term_results.items() )  )
+			collection.add( experiment_key, scores )
 		# finished this directory, so print results for it
-		print collection.create_table( precision = options.precision )
+		print( collection.create_table( precision = options.precision ) )
 		mean_collection.add( os.path.basename(result_dir_path), collection.aggregate_scores()[0] )
+	if not pool is None:
+		pool.close()
+		pool.join()
 
 	# Display mean scores across all experiments
-	print "* Summary - Mean Scores"
-	print mean_collection.create_table( precision = options.precision )
+	print( "* Summary - Mean Scores" )
+	print( mean_collection.create_table( precision = options.precision ) )
+	unsupervised.profiling.finish()
 
 # --------------------------------------------------------------
 